@@ -0,0 +1,108 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from models import db, Drug, DrugBatch, BATCH_IN_STOCK
+from branches import BranchLocal, branch_signals, current_branch
+
+LOW_STOCK_THRESHOLD = 10
+EXPIRY_WARNING_DAYS = 90  # dashboard / reports
+ALERT_EXPIRY_DAYS = 30  # /api/alerts
+ALERT_CACHE_TTL = 15  # seconds
+
+_lock = threading.Lock()
+_caches = BranchLocal(lambda branch: {'counts': None, 'day': None, 'expires': 0.0, 'generation': 0, 'stamp': 0})
+
+# Each branch has its own counters and signal file. Writes in this process wake
+# waiting streams through _changed; writes in other gunicorn workers are picked
+# up through the branch's stock signal.
+_changed = threading.Condition()
+stock_signals = branch_signals('alerts.signal')
+
+def count_alerts(today=None):
+    """Compute every stock and expiry counter in one round trip: stock counters in a
+    single pass over the drug table, expiry counters (drugs with an in-stock batch in
+    the window) from range scans of the partial batch expiry index"""
+    today = today or datetime.now().date()
+    soon_date = today + timedelta(days=EXPIRY_WARNING_DAYS)
+    alert_date = today + timedelta(days=ALERT_EXPIRY_DAYS)
+
+    def count_where(*conditions):
+        return db.func.coalesce(db.func.sum(db.case((db.and_(*conditions), 1), else_=0)), 0)
+
+    def drugs_with_batches(*conditions):
+        return db.select(db.func.count(db.distinct(DrugBatch.drug_id))) \
+            .where(BATCH_IN_STOCK, *conditions).scalar_subquery()
+
+    row = db.session.query(
+        db.func.count(Drug.id),
+        count_where(Drug.quantity < LOW_STOCK_THRESHOLD),
+        drugs_with_batches(DrugBatch.expiry_date <= soon_date, DrugBatch.expiry_date > today),
+        drugs_with_batches(DrugBatch.expiry_date <= alert_date, DrugBatch.expiry_date > today),
+        drugs_with_batches(DrugBatch.expiry_date <= today)
+    ).one()
+    return {
+        'total': int(row[0]),
+        'low_stock': int(row[1]),
+        'expiring_soon': int(row[2]),
+        'expiring_alert': int(row[3]),
+        'expired': int(row[4])
+    }
+
+def alert_counts():
+    """Return the current branch's alert counters, recomputing them at most once per
+    ALERT_CACHE_TTL"""
+    today = datetime.now().date()
+    now = time.monotonic()
+    stamp = stock_signals.stamp()
+    cache = _caches.get()
+    with _lock:
+        if (cache['counts'] is not None and cache['day'] == today
+                and now < cache['expires'] and cache['stamp'] == stamp):
+            return cache['counts']
+        generation = cache['generation']
+
+    counts = count_alerts(today)
+    with _lock:
+        # Don't cache a result that an invalidation raced past
+        if cache['generation'] == generation:
+            cache.update(counts=counts, day=today, expires=now + ALERT_CACHE_TTL, stamp=stamp)
+    return counts
+
+def invalidate_alerts():
+    """Drop the current branch's cached counters after a write that changes stock or
+    expiry and wake every alert stream so it pushes the new counts"""
+    cache = _caches.get()
+    with _lock:
+        cache['counts'] = None
+        cache['generation'] += 1
+    stock_signals.touch()
+    with _changed:
+        _changed.notify_all()
+
+def catalogue_version():
+    """Changes on every drug, sale or purchase write to the current branch: this
+    process's invalidation count for writes made here, the signal file's mtime for
+    other workers'. Versions of different branches never compare equal."""
+    branch = current_branch()
+    cache = _caches.get(branch)
+    with _lock:
+        generation = cache['generation']
+    return branch, stock_signals.get(branch).stamp(), generation
+
+def wait_for_change(timeout):
+    """Block until a write in this process invalidates the alerts or timeout seconds pass"""
+    with _changed:
+        _changed.wait(timeout)
+
+def alert_payload(counts):
+    """The counters sent to clients by /api/alerts and the alert stream"""
+    return {
+        'low_stock': counts['low_stock'],
+        'expiring_soon': counts['expiring_alert'],
+        'expired': counts['expired']
+    }
+
+def alerts_etag(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
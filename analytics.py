@@ -0,0 +1,116 @@
+from datetime import datetime, timedelta
+import numpy as np
+from models import db, Drug, SalesRollup
+
+# Sales velocity and reorder forecasting for the whole catalogue. History is
+# read in bulk from the daily rollup into columnar arrays, and every per-drug
+# figure is computed with array operations rather than a loop over drugs.
+
+WINDOW_DAYS = 90  # days of history the forecast looks at
+SHORT_WINDOW = 7
+LONG_WINDOW = 30
+HALF_LIFE_DAYS = 14  # weight of a day's sales halves every HALF_LIFE_DAYS
+LEAD_TIME_DAYS = 7  # supplier lead time
+REVIEW_DAYS = 30  # cover to order beyond the lead time
+SERVICE_Z = 1.65  # safety stock for ~95% of lead times without a stockout
+MAX_STOCKOUT_DAYS = 3650  # no stockout date is given beyond this
+
+def load_catalogue():
+    """Drug ids (ascending), names and stock levels as aligned arrays"""
+    rows = db.session.execute(db.select(Drug.id, Drug.name, Drug.quantity).order_by(Drug.id)).all()
+    if not rows:
+        return np.zeros(0, np.int64), np.zeros(0, object), np.zeros(0, np.float64)
+    ids, names, quantities = zip(*rows)
+    return np.array(ids, np.int64), np.array(names, object), np.array(quantities, np.float64)
+
+def load_daily_sales(start_day, end_day):
+    """Units sold per (drug, day) in [start_day, end_day) as aligned arrays"""
+    units = db.func.sum(SalesRollup.quantity)
+    rows = db.session.execute(
+        db.select(SalesRollup.drug_id, SalesRollup.day, units)
+        .where(SalesRollup.day >= start_day, SalesRollup.day < end_day)
+        .group_by(SalesRollup.drug_id, SalesRollup.day)
+    ).all()
+    if not rows:
+        return np.zeros(0, np.int64), np.zeros(0, 'datetime64[D]'), np.zeros(0, np.float64)
+    drug_ids, days, quantities = zip(*rows)
+    return np.array(drug_ids, np.int64), np.array(days, 'datetime64[D]'), np.array(quantities, np.float64)
+
+def forecast(drug_ids, stock, sale_drug_ids, sale_days, sale_quantities, today, window=WINDOW_DAYS):
+    """Per-drug velocity, days of cover and suggested reorder quantity.
+
+    drug_ids must be sorted; every returned array is aligned with it. Sales of
+    drugs not in drug_ids, or outside the window ending today, are ignored.
+    """
+    count = len(drug_ids)
+    position = np.searchsorted(drug_ids, sale_drug_ids)
+    known = position < count
+    known[known] = drug_ids[position[known]] == sale_drug_ids[known]
+    age = (np.datetime64(today, 'D') - sale_days).astype(np.int64)  # 0 is today
+    keep = known & (age >= 0) & (age < window)
+    position, age, units = position[keep], age[keep], sale_quantities[keep]
+
+    def per_drug(weights, mask=slice(None)):
+        return np.bincount(position[mask], weights=weights[mask], minlength=count)
+
+    velocity_short = per_drug(units, age < SHORT_WINDOW) / SHORT_WINDOW
+    velocity_long = per_drug(units, age < LONG_WINDOW) / LONG_WINDOW
+    decay = 0.5 ** (np.arange(window) / HALF_LIFE_DAYS)
+    velocity = per_drug(units * decay[age]) / decay.sum()
+
+    # Days without sales count as zero demand
+    mean = per_drug(units) / window
+    deviation = np.sqrt(np.maximum(per_drug(units * units) / window - mean * mean, 0))
+
+    days_of_cover = np.full(count, np.inf)
+    np.divide(stock, velocity, out=days_of_cover, where=velocity > 0)
+    safety_stock = SERVICE_Z * deviation * np.sqrt(LEAD_TIME_DAYS)
+    reorder_point = velocity * LEAD_TIME_DAYS + safety_stock
+    order_up_to = velocity * (LEAD_TIME_DAYS + REVIEW_DAYS) + safety_stock
+    needs_reorder = (velocity > 0) & (stock <= reorder_point)
+    suggested = np.where(needs_reorder, np.ceil(np.maximum(order_up_to - stock, 0)), 0).astype(np.int64)
+
+    return {
+        'velocity': velocity,
+        'velocity_7d': velocity_short,
+        'velocity_30d': velocity_long,
+        'days_of_cover': days_of_cover,
+        'reorder_point': reorder_point,
+        'suggested_order': suggested,
+    }
+
+def reorder_forecast(today=None, window=WINDOW_DAYS):
+    """Load the catalogue and its sales history and forecast every drug (call inside an app context)"""
+    today = today or datetime.now().date()
+    drug_ids, names, stock = load_catalogue()
+    sales = load_daily_sales(today - timedelta(days=window - 1), today + timedelta(days=1))
+    result = forecast(drug_ids, stock, *sales, today=today, window=window)
+    result.update(drug_id=drug_ids, name=names, quantity=stock, today=today)
+    return result
+
+def forecast_rows(result, limit=None, reorder_only=False):
+    """Drugs as dicts, soonest to run out first"""
+    order = np.argsort(result['days_of_cover'], kind='stable')
+    if reorder_only:
+        order = order[result['suggested_order'][order] > 0]
+    if limit is not None:
+        order = order[:limit]
+
+    rows = []
+    for i in order.tolist():
+        cover = float(result['days_of_cover'][i])
+        finite = bool(np.isfinite(cover))
+        rows.append({
+            'drug_id': int(result['drug_id'][i]),
+            'name': result['name'][i],
+            'quantity': int(result['quantity'][i]),
+            'velocity': round(float(result['velocity'][i]), 3),
+            'velocity_7d': round(float(result['velocity_7d'][i]), 3),
+            'velocity_30d': round(float(result['velocity_30d'][i]), 3),
+            'days_of_cover': round(cover, 1) if finite else None,
+            'stockout_date': (result['today'] + timedelta(days=int(cover))).isoformat()
+                             if cover <= MAX_STOCKOUT_DAYS else None,
+            'reorder_point': round(float(result['reorder_point'][i]), 1),
+            'suggested_order': int(result['suggested_order'][i])
+        })
+    return rows
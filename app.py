@@ -1,29 +1,101 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify, session, Response,
+                   stream_with_context, send_file, g)
 from datetime import datetime, timedelta
-from models import db, User, Drug, Sale, Purchase, Supplier
+from markupsafe import Markup
+from models import db, User, Drug, DrugBatch, Sale, Purchase, Supplier, Job, BATCH_IN_STOCK, PASSWORD_HASH_METHOD
+from pagination import keyset_page, page_size
+from dbconfig import configure_database, init_database, branch_engine
+from branches import DEFAULT_BRANCH, branch_codes, is_branch, select_branch, use_branch
+from metrics import init_metrics, metrics
+from auth import (init_auth, authenticate, start_session, end_session, session_user, hash_password,
+                  revoke_user_sessions, invalidate_sessions)
+from queries import sales_with_drug, purchases_with_drug, init_query_budget, uncounted
+from migrations import init_schema
+from query_plans import check_query_plans
+from alerts import alert_counts, invalidate_alerts, alert_payload, alerts_etag, wait_for_change
+from search import drug_search, search_ids
+from catalogue import catalogue_snapshot
+from ledger import record_movements, take_snapshot, stock_at, reconcile
+from stock import (record_sale, record_purchase, checkout_basket, opening_batch, update_drug, remove_drug,
+                   write_off_expired, DrugNotFound, InsufficientStock)
+from bulk import (iter_records, import_drugs, import_purchases, stock_rows, write_records, DRUG_FIELDS,
+                  sales_history, purchase_history, csv_chunks)
+from analytics import reorder_forecast, forecast_rows
+from cache import page_cache, cached_page
+from jobs import init_jobs, runner, enqueue, visible_jobs, job_to_dict, JOB_KINDS
+from reporting import (resolve_period, in_range, rebuild_rollup, sales_summary, sales_by_drug, sales_by_staff,
+                       sales_by_day, consolidated_report)
 from functools import wraps
-import sqlite3
+import click
+import csv
+import os
+import json
+import threading
+import time
 
-app = Flask(__name__)
+app = Flask(__name__, instance_path=os.environ.get('INSTANCE_PATH'))  # absolute; defaults to ./instance
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///pharmacy.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['ALERT_STREAM_TIMEOUT'] = 300  # seconds before the browser reconnects
+# Each open stream holds a worker thread, so only this many per process; the
+# others get a 503 and the page falls back to polling /api/alerts
+app.config['ALERT_STREAM_LIMIT'] = int(os.environ.get('ALERT_STREAM_LIMIT',
+                                                      max(1, int(os.environ.get('THREADS', 16)) // 2)))
+app.config['DRUG_SEARCH_PAGE_LIMIT'] = 500  # most search matches listed on /drugs
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', PASSWORD_HASH_METHOD)
+app.config['METRICS_ENABLED'] = os.environ.get('METRICS_ENABLED', '1') == '1'
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')  # bearer token required by /metrics, if set
+app.config['SLOW_REQUEST_SECONDS'] = float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0))
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 0))  # job threads per web process (see jobs.py)
+app.config['JOB_SWEEP_HOUR'] = int(os.environ.get('JOB_SWEEP_HOUR', 2))  # nightly sweep runs after this hour
+app.config['BRANCH_FANOUT_WORKERS'] = int(os.environ.get('BRANCH_FANOUT_WORKERS', 8))  # branches queried at once
 
+configure_database(app)
 db.init_app(app)
+init_database(app)
+init_query_budget(app)
+init_metrics(app)
+init_auth(app)
+init_jobs(app)
+
+alert_stream_slots = threading.BoundedSemaphore(app.config['ALERT_STREAM_LIMIT'])
 
 # Inject today's date into all templates
 @app.context_processor
 def inject_today():
     return {'today': datetime.now().date()}
 
+@app.context_processor
+def inject_branches():
+    return {'branches': branch_codes()}
+
 # Login required decorator
 def login_required(role=None):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if 'user_id' not in session:
+            # Checked against the server-side session, so logouts, deleted users
+            # and role changes apply at once (cached, usually no query)
+            with uncounted():
+                user = session_user(session.get('session_id'))
+            if not user:
+                session.clear()
                 return redirect(url_for('login'))
-            if role and session.get('role') != role:
+            if session.get('role') != user['role']:
+                session['role'] = user['role']
+            # Users with a home branch always work there; the others pick one
+            branch = user['branch'] or session.get('branch', DEFAULT_BRANCH)
+            if not is_branch(branch):
+                if user['branch']:
+                    session.clear()
+                    flash(f"Branch {user['branch']} is not available.", 'danger')
+                    return redirect(url_for('login'))
+                branch = DEFAULT_BRANCH
+            if session.get('branch') != branch:
+                session['branch'] = branch
+            select_branch(branch)
+            g.home_branch = user['branch']
+            if role and user['role'] != role:
                 flash('Access denied. Insufficient permissions.', 'danger')
                 return redirect(url_for('dashboard'))
             return f(*args, **kwargs)
@@ -42,12 +114,17 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        user = User.query.filter_by(username=username).first()
+        user = authenticate(username, password)
         
-        if user and user.check_password(password):
+        if user and user.branch and not is_branch(user.branch):
+            flash(f'Branch {user.branch} is not available.', 'danger')
+        elif user:
+            session.clear()
+            session['session_id'] = start_session(user)
             session['user_id'] = user.id
             session['username'] = user.username
             session['role'] = user.role
+            session['branch'] = user.branch or DEFAULT_BRANCH
             flash('Login successful!', 'success')
             return redirect(url_for('dashboard'))
         else:
@@ -57,30 +134,38 @@ def login():
 
 @app.route('/logout')
 def logout():
+    end_session(session.get('session_id'))
     session.clear()
     flash('Logged out successfully!', 'success')
     return redirect(url_for('login'))
 
+@app.route('/branch', methods=['POST'])
+@login_required()
+def switch_branch():
+    branch = request.form.get('branch', '')
+    if session_user(session.get('session_id'))['branch']:
+        flash('You can only work at your own branch.', 'danger')
+    elif not is_branch(branch):
+        flash('Unknown branch!', 'danger')
+    else:
+        session['branch'] = branch
+        flash(f'Now working at {branch}.', 'success')
+    return redirect(url_for('dashboard'))
+
 @app.route('/dashboard')
 @login_required()
 def dashboard():
-    # Get dashboard statistics
-    total_drugs = Drug.query.count()
-    low_stock_drugs = Drug.query.filter(Drug.quantity < 10).count()
-    
-    # Expiry alerts
-    soon_date = datetime.now().date() + timedelta(days=90)
-    expiring_soon = Drug.query.filter(Drug.expiry_date <= soon_date, Drug.expiry_date > datetime.now().date()).count()
-    expired_drugs = Drug.query.filter(Drug.expiry_date <= datetime.now().date()).count()
+    # Get dashboard statistics (one cached conditional-aggregate query)
+    counts = alert_counts()
     
     # Recent sales
-    recent_sales = Sale.query.order_by(Sale.sale_date.desc()).limit(5).all()
+    recent_sales = sales_with_drug().order_by(Sale.sale_date.desc()).limit(5).all()
     
     return render_template('dashboard.html', 
-                         total_drugs=total_drugs,
-                         low_stock_drugs=low_stock_drugs,
-                         expiring_soon=expiring_soon,
-                         expired_drugs=expired_drugs,
+                         total_drugs=counts['total'],
+                         low_stock_drugs=counts['low_stock'],
+                         expiring_soon=counts['expiring_soon'],
+                         expired_drugs=counts['expired'],
                          recent_sales=recent_sales)
 
 # Drug Management Routes - FIXED
@@ -92,29 +177,36 @@ def drugs():
     expiry_filter = request.args.get('expiry_filter', '')
     stock_filter = request.args.get('stock_filter', '')
     
-    query = Drug.query
-    
-    if search:
-        query = query.filter(Drug.name.ilike(f'%{search}%'))
-    if category:
-        query = query.filter_by(category=category)
-    if expiry_filter:
-        today = datetime.now().date()
-        if expiry_filter == 'expired':
-            query = query.filter(Drug.expiry_date <= today)
-        elif expiry_filter == 'expiring_soon':
-            soon_date = today + timedelta(days=90)
-            query = query.filter(Drug.expiry_date <= soon_date, Drug.expiry_date > today)
-    if stock_filter == 'low_stock':
-        query = query.filter(Drug.quantity < 10)
-    
-    drugs = query.order_by(Drug.name).all()
-    
-    # Get distinct categories for filter dropdown
-    categories = db.session.query(Drug.category).distinct().all()
-    categories = [cat[0] for cat in categories if cat[0]]  # Extract from tuple and filter None
-    
-    return render_template('drugs.html', drugs=drugs, categories=categories)
+    def build_table():
+        query = Drug.query
+
+        if search:
+            query = query.filter(Drug.id.in_(search_ids(search, app.config['DRUG_SEARCH_PAGE_LIMIT'])))
+        if category:
+            query = query.filter_by(category=category)
+        if expiry_filter:
+            today = datetime.now().date()
+            if expiry_filter == 'expired':
+                query = query.filter(Drug.expiry_date <= today)
+            elif expiry_filter == 'expiring_soon':
+                soon_date = today + timedelta(days=90)
+                query = query.filter(Drug.expiry_date <= soon_date, Drug.expiry_date > today)
+        if stock_filter == 'low_stock':
+            query = query.filter(Drug.quantity < 10)
+
+        return render_template('_drug_table.html', drugs=query.order_by(Drug.name).all())
+
+    # The table is rendered once per catalogue version, day, role and filter set
+    drug_table = page_cache.get_or_build(
+        ('drug_table', datetime.now().date(), session.get('role'), search, category, expiry_filter, stock_filter),
+        build_table)
+    categories = page_cache.get_or_build(('categories',), category_names)
+
+    return render_template('drugs.html', drug_table=Markup(drug_table), categories=categories)
+
+def category_names():
+    """Distinct non-empty categories for the filter dropdown"""
+    return [cat for (cat,) in db.session.query(Drug.category).distinct().order_by(Drug.category) if cat]
 
 @app.route('/add_drug', methods=['GET', 'POST'])
 @login_required(role='admin')
@@ -135,8 +227,13 @@ def add_drug():
                 selling_price=float(request.form['selling_price']),
                 expiry_date=datetime.strptime(request.form['expiry_date'], '%Y-%m-%d').date()
             )
+            drug.batches.append(opening_batch(drug))
             db.session.add(drug)
+            db.session.flush()
+            record_movements({drug.id: drug.quantity}, 'opening')
             db.session.commit()
+            invalidate_alerts()
+            drug_search.update(drug.id, drug.name)
             flash('Drug added successfully!', 'success')
             return redirect(url_for('drugs'))
         except Exception as e:
@@ -152,18 +249,22 @@ def edit_drug(drug_id):
     
     if request.method == 'POST':
         try:
-            drug.name = request.form['name']
-            drug.category = request.form['category']
-            drug.batch_no = request.form['batch_no']
-            drug.manufacturer = request.form['manufacturer']
-            drug.quantity = int(request.form['quantity'])
-            drug.cost_price = float(request.form['cost_price'])
-            drug.selling_price = float(request.form['selling_price'])
-            drug.expiry_date = datetime.strptime(request.form['expiry_date'], '%Y-%m-%d').date()
-            
-            db.session.commit()
+            # Stock, batch, cost and expiry are applied to the named batch
+            drug = update_drug(drug_id,
+                               details={'name': request.form['name'],
+                                        'category': request.form['category'],
+                                        'manufacturer': request.form['manufacturer'],
+                                        'selling_price': float(request.form['selling_price'])},
+                               quantity=int(request.form['quantity']),
+                               batch_no=request.form['batch_no'],
+                               cost_price=float(request.form['cost_price']),
+                               expiry_date=datetime.strptime(request.form['expiry_date'], '%Y-%m-%d').date())
+            invalidate_alerts()
+            drug_search.update(drug.id, drug.name)
             flash('Drug updated successfully!', 'success')
             return redirect(url_for('drugs'))
+        except InsufficientStock:
+            flash('Not enough unexpired stock to take off! Write off expired batches first.', 'danger')
         except Exception as e:
             db.session.rollback()
             flash(f'Error updating drug: {str(e)}', 'danger')
@@ -174,16 +275,30 @@ def edit_drug(drug_id):
 @login_required(role='admin')
 def delete_drug(drug_id):
     try:
-        drug = Drug.query.get_or_404(drug_id)
-        db.session.delete(drug)
-        db.session.commit()
+        remove_drug(drug_id)
+        invalidate_alerts()
+        drug_search.remove(drug_id)
         flash('Drug deleted successfully!', 'success')
+    except DrugNotFound:
+        flash('Drug not found!', 'danger')
     except Exception as e:
         db.session.rollback()
         flash(f'Error deleting drug: {str(e)}', 'danger')
     
     return redirect(url_for('drugs'))
 
+@app.route('/drugs/write_off_expired', methods=['POST'])
+@login_required(role='admin')
+def write_off_expired_stock():
+    # Expired batches are never sold; this is the only way their units leave stock
+    written_off = write_off_expired()
+    if written_off:
+        invalidate_alerts()
+        flash(f'Wrote off {sum(written_off.values())} expired units of {len(written_off)} drugs.', 'success')
+    else:
+        flash('No expired stock to write off.', 'info')
+    return redirect(url_for('reports', type='expiry'))
+
 # Sales Management
 @app.route('/sales', methods=['GET', 'POST'])
 @login_required()
@@ -194,41 +309,30 @@ def sales():
             quantity = int(request.form['quantity'])
             staff_name = session['username']
             
-            drug = Drug.query.get(drug_id)
-            
-            if not drug:
-                flash('Drug not found!', 'danger')
-                return redirect(url_for('sales'))
-            
-            if drug.quantity < quantity:
-                flash('Insufficient stock!', 'danger')
-                return redirect(url_for('sales'))
-            
-            # Update drug quantity
-            drug.quantity -= quantity
-            
-            # Create sale record
-            sale = Sale(
-                drug_id=drug_id,
-                quantity=quantity,
-                unit_price=drug.selling_price,
-                total_price=quantity * drug.selling_price,
-                staff_name=staff_name,
-                sale_date=datetime.now()
-            )
-            
-            db.session.add(sale)
-            db.session.commit()
+            # Conditional UPDATE - safe against concurrent checkouts of the same drug
+            record_sale(drug_id, quantity, staff_name)
+            invalidate_alerts()
             flash('Sale recorded successfully!', 'success')
             return redirect(url_for('sales'))
             
+        except DrugNotFound:
+            flash('Drug not found!', 'danger')
+            return redirect(url_for('sales'))
+        except InsufficientStock:
+            flash('Insufficient stock!', 'danger')
+            return redirect(url_for('sales'))
         except Exception as e:
             db.session.rollback()
             flash(f'Error recording sale: {str(e)}', 'danger')
     
-    drugs = Drug.query.filter(Drug.quantity > 0).all()
-    sales_history = Sale.query.order_by(Sale.sale_date.desc()).all()
-    return render_template('sales.html', drugs=drugs, sales=sales_history)
+    drugs = catalogue_snapshot().rows(in_stock=True)
+    sales_history, next_cursor = keyset_page(sales_with_drug(), Sale.sale_date, Sale.id)
+    return render_template('sales.html', drugs=drugs, sales=sales_history, next_cursor=next_cursor)
+
+@app.route('/sales/export')
+@login_required()
+def export_sales():
+    return csv_response(*sales_history(), 'sales_history.csv')
 
 # Purchase Management
 @app.route('/purchases', methods=['GET', 'POST'])
@@ -241,41 +345,31 @@ def purchases():
             cost_price = float(request.form['cost_price'])
             supplier_name = request.form['supplier_name']
             batch_no = request.form['batch_no']
+            expiry_date = request.form.get('expiry_date')
+            if expiry_date:
+                expiry_date = datetime.strptime(expiry_date, '%Y-%m-%d').date()
             
-            drug = Drug.query.get(drug_id)
-            
-            if not drug:
-                flash('Drug not found!', 'danger')
-                return redirect(url_for('purchases'))
-            
-            # Update drug
-            drug.quantity += quantity
-            drug.cost_price = cost_price
-            drug.batch_no = batch_no
-            
-            # Create purchase record
-            purchase = Purchase(
-                drug_id=drug_id,
-                quantity=quantity,
-                cost_price=cost_price,
-                total_cost=quantity * cost_price,
-                supplier_name=supplier_name,
-                batch_no=batch_no,
-                purchase_date=datetime.now()
-            )
-            
-            db.session.add(purchase)
-            db.session.commit()
+            # Stock goes into its own batch; the drug's other batches are untouched
+            record_purchase(drug_id, quantity, cost_price, supplier_name, batch_no, expiry_date or None)
+            invalidate_alerts()
             flash('Purchase recorded successfully!', 'success')
             return redirect(url_for('purchases'))
             
+        except DrugNotFound:
+            flash('Drug not found!', 'danger')
+            return redirect(url_for('purchases'))
         except Exception as e:
             db.session.rollback()
             flash(f'Error recording purchase: {str(e)}', 'danger')
     
-    drugs = Drug.query.all()
-    purchases_history = Purchase.query.order_by(Purchase.purchase_date.desc()).all()
-    return render_template('purchases.html', drugs=drugs, purchases=purchases_history)
+    drugs = catalogue_snapshot().rows()
+    purchases_history, next_cursor = keyset_page(purchases_with_drug(), Purchase.purchase_date, Purchase.id)
+    return render_template('purchases.html', drugs=drugs, purchases=purchases_history, next_cursor=next_cursor)
+
+@app.route('/purchases/export')
+@login_required(role='admin')
+def export_purchases():
+    return csv_response(*purchase_history(), 'purchase_history.csv')
 
 # Reports - FIXED
 @app.route('/reports')
@@ -284,48 +378,101 @@ def reports():
     report_type = request.args.get('type', 'stock')
     period = request.args.get('period', 'daily')
     
-    data = []
-    template = 'reports.html'
+    def render(etag):
+        nonlocal period
+        data = []
+        template = 'reports.html'
     
-    if report_type == 'stock':
-        data = Drug.query.order_by(Drug.name).all()
-        report_title = "Stock Report"
+        if report_type == 'stock':
+            data = Drug.query.order_by(Drug.name).all()
+            report_title = "Stock Report"
         
-    elif report_type == 'expiry':
-        today = datetime.now().date()
-        soon_date = today + timedelta(days=90)
-        expired = Drug.query.filter(Drug.expiry_date <= today).all()
-        expiring_soon = Drug.query.filter(Drug.expiry_date <= soon_date, Drug.expiry_date > today).all()
-        data = {
-            'expired': expired, 
-            'expiring_soon': expiring_soon,
-            'report_title': 'Expiry Report'
-        }
+        elif report_type == 'expiry':
+            today = datetime.now().date()
+            soon_date = today + timedelta(days=90)
+            # One row per in-stock batch, so a drug's expired lot shows even when newer lots remain
+            batches = db.session.query(Drug.name, Drug.manufacturer, DrugBatch.batch_no,
+                                       DrugBatch.quantity, DrugBatch.expiry_date) \
+                .join(Drug, Drug.id == DrugBatch.drug_id) \
+                .filter(BATCH_IN_STOCK) \
+                .order_by(DrugBatch.expiry_date, Drug.name)
+            expired = batches.filter(DrugBatch.expiry_date <= today).all()
+            expiring_soon = batches.filter(DrugBatch.expiry_date <= soon_date, DrugBatch.expiry_date > today).all()
+            data = {
+                'expired': expired, 
+                'expiring_soon': expiring_soon,
+                'report_title': 'Expiry Report'
+            }
         
-    elif report_type == 'sales':
-        today = datetime.now().date()
-        if period == 'daily':
-            start_date = today
-            sales_data = Sale.query.filter(db.func.date(Sale.sale_date) == start_date).all()
-        elif period == 'weekly':
-            start_date = today - timedelta(days=7)
-            sales_data = Sale.query.filter(Sale.sale_date >= start_date).all()
-        else:  # monthly
-            start_date = today - timedelta(days=30)
-            sales_data = Sale.query.filter(Sale.sale_date >= start_date).all()
+        elif report_type == 'forecast':
+            result = reorder_forecast()
+            data = {
+                'drugs': forecast_rows(result, limit=200, reorder_only=True),
+                'catalogue_size': len(result['drug_id']),
+                'report_title': 'Reorder Forecast'
+            }
         
-        data = {
-            'sales': sales_data,
-            'period': period,
-            'start_date': start_date,
-            'report_title': f'Sales Report - {period.capitalize()}'
-        }
+        elif report_type == 'sales':
+            try:
+                start, end = resolve_period(period, request.args.get('start'), request.args.get('end'))
+            except ValueError:
+                period = 'daily'
+                start, end = resolve_period(period)
+            sales_data, next_cursor = keyset_page(in_range(sales_with_drug(), start, end), Sale.sale_date, Sale.id)
+        
+            data = {
+                'sales': sales_data,
+                'next_cursor': next_cursor,
+                'summary': sales_summary(start, end),
+                'by_drug': sales_by_drug(start, end),
+                'by_staff': sales_by_staff(start, end),
+                'by_day': sales_by_day(start, end),
+                'period': period,
+                'start_date': start.date(),
+                'end_date': (end - timedelta(days=1)).date(),
+                'report_title': f'Sales Report - {period.capitalize()}'
+            }
     
-    return render_template('reports.html', 
-                         data=data, 
-                         report_type=report_type, 
-                         period=period,
-                         today=datetime.now().date())
+        return render_template('reports.html', 
+                             data=data, 
+                             report_type=report_type, 
+                             period=period,
+                             today=datetime.now().date(),
+                             etag=etag)
+
+    # Whole pages are reused until the catalogue changes or the day rolls over;
+    # the page's auto-refresh sends If-None-Match and gets a 304 meanwhile
+    return cached_page((datetime.now().date(),), render)
+
+# Consolidated report - every branch's database is queried at once on a thread pool
+def branch_report_period():
+    period = request.args.get('period', 'monthly')
+    try:
+        start, end = resolve_period(period, request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        period = 'monthly'
+        start, end = resolve_period(period)
+    return period, start, end
+
+@app.route('/reports/branches')
+@login_required(role='admin')
+def branch_report():
+    period, start, end = branch_report_period()
+    return render_template('branch_report.html',
+                           data=consolidated_report(start, end),
+                           period=period,
+                           start_date=start.date(),
+                           end_date=(end - timedelta(days=1)).date())
+
+@app.route('/api/reports/branches')
+@login_required(role='admin')
+def api_branch_report():
+    period, start, end = branch_report_period()
+    report = consolidated_report(start, end)
+    for day in report['by_day']:
+        day['day'] = day['day'].isoformat()
+    return jsonify(dict(report, period=period, start=start.date().isoformat(),
+                        end=(end - timedelta(days=1)).date().isoformat()))
 
 # User Management (Admin only)
 @app.route('/users')
@@ -334,6 +481,13 @@ def users():
     users_list = User.query.all()
     return render_template('users.html', users=users_list)
 
+def form_branch():
+    """The home branch picked on the users page; blank means any branch"""
+    branch = request.form.get('branch') or None
+    if branch is not None and not is_branch(branch):
+        raise ValueError(f'Unknown branch: {branch}')
+    return branch
+
 @app.route('/add_user', methods=['POST'])
 @login_required(role='admin')
 def add_user():
@@ -341,14 +495,14 @@ def add_user():
         username = request.form['username']
         password = request.form['password']
         role = request.form['role']
+        branch = form_branch()
         
         # Check if username already exists
         if User.query.filter_by(username=username).first():
             flash('Username already exists!', 'danger')
             return redirect(url_for('users'))
         
-        user = User(username=username, role=role)
-        user.set_password(password)
+        user = User(username=username, role=role, branch=branch, password_hash=hash_password(password))
         
         db.session.add(user)
         db.session.commit()
@@ -359,48 +513,305 @@ def add_user():
     
     return redirect(url_for('users'))
 
+@app.route('/change_role/<int:user_id>', methods=['POST'])
+@login_required(role='admin')
+def change_role(user_id):
+    user = User.query.get_or_404(user_id)
+    if user.id == session['user_id']:
+        flash('You cannot change your own role!', 'danger')
+        return redirect(url_for('users'))
+    user.role = 'admin' if request.form.get('role') == 'admin' else 'pharmacist'
+    db.session.commit()
+    invalidate_sessions()
+    flash(f'{user.username} is now {user.role}.', 'success')
+    return redirect(url_for('users'))
+
+@app.route('/change_branch/<int:user_id>', methods=['POST'])
+@login_required(role='admin')
+def change_branch(user_id):
+    user = User.query.get_or_404(user_id)
+    try:
+        user.branch = form_branch()
+    except ValueError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('users'))
+    db.session.commit()
+    invalidate_sessions()
+    flash(f"{user.username} now works at {user.branch or 'any branch'}.", 'success')
+    return redirect(url_for('users'))
+
+@app.route('/delete_user/<int:user_id>', methods=['POST'])
+@login_required(role='admin')
+def delete_user(user_id):
+    user = User.query.get_or_404(user_id)
+    if user.id == session['user_id']:
+        flash('You cannot delete your own account!', 'danger')
+        return redirect(url_for('users'))
+    revoke_user_sessions(user.id)
+    db.session.delete(user)
+    db.session.commit()
+    invalidate_sessions()
+    flash(f'User {user.username} deleted and logged out.', 'success')
+    return redirect(url_for('users'))
+
+@app.route('/reports/stock/export')
+@login_required()
+def export_stock():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'):
+        fmt = 'csv'
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(write_records(stock_rows(), DRUG_FIELDS, fmt)), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename=stock_report.{fmt}'})
+
+# Streaming CSV export - rows are written out as they are fetched so memory stays flat
+def csv_response(header, rows, filename):
+    return Response(stream_with_context(csv_chunks(header, rows)), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
 # API endpoints for AJAX calls
+def sale_to_dict(sale):
+    return {
+        'id': sale.id,
+        'sale_date': sale.sale_date.isoformat(),
+        'drug_name': sale.drug.name,
+        'quantity': sale.quantity,
+        'unit_price': float(sale.unit_price),
+        'total_price': float(sale.total_price),
+        'staff_name': sale.staff_name
+    }
+
+def purchase_to_dict(purchase):
+    return {
+        'id': purchase.id,
+        'purchase_date': purchase.purchase_date.isoformat(),
+        'drug_name': purchase.drug.name,
+        'supplier_name': purchase.supplier_name,
+        'batch_no': purchase.batch_no,
+        'quantity': purchase.quantity,
+        'cost_price': float(purchase.cost_price),
+        'total_cost': float(purchase.total_cost)
+    }
+
+@app.route('/api/sales')
+@login_required()
+def api_sales():
+    query = sales_with_drug()
+    period = request.args.get('period')
+    try:
+        if period:
+            query = in_range(query, *resolve_period(period, request.args.get('start'), request.args.get('end')))
+        items, next_cursor = keyset_page(query, Sale.sale_date, Sale.id,
+                                         request.args.get('cursor'), page_size(request.args.get('limit')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'items': [sale_to_dict(sale) for sale in items], 'next_cursor': next_cursor})
+
+@app.route('/api/sales/checkout', methods=['POST'])
+@login_required()
+def api_checkout():
+    payload = request.get_json(silent=True) or {}
+    try:
+        receipt = checkout_basket(payload.get('lines'), session['username'])
+    except DrugNotFound as e:
+        return jsonify({'error': 'Drug not found', 'drug_ids': e.args[0]}), 404
+    except InsufficientStock as e:
+        return jsonify({'error': 'Insufficient stock', 'drug_ids': e.args[0]}), 409
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid basket: {e}'}), 400
+    
+    invalidate_alerts()
+    return jsonify(receipt), 201
+
+@app.route('/api/analytics/reorder')
+@login_required()
+def api_reorder_forecast():
+    try:
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    reorder_only = request.args.get('all') != '1'
+    result = reorder_forecast()
+    return jsonify({
+        'as_of': result['today'].isoformat(),
+        'items': forecast_rows(result, limit=limit, reorder_only=reorder_only)
+    })
+
+@app.route('/api/stock/at')
+@login_required()
+def api_stock_at():
+    """Stock as the ledger stood at ?at=YYYY-MM-DD[THH:MM[:SS]], for every drug with
+    stock or just the given ?drug_id=..."""
+    try:
+        moment = datetime.fromisoformat(request.args['at'])
+        drug_ids = [int(drug_id) for drug_id in request.args.getlist('drug_id')] or None
+    except KeyError:
+        return jsonify({'error': 'at is required'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    stock = stock_at(moment, drug_ids)
+    return jsonify({
+        'at': moment.isoformat(),
+        'items': [{'drug_id': drug_id, 'quantity': quantity} for drug_id, quantity in sorted(stock.items())]
+    })
+
+# Background jobs - slow reports and exports are queued here and downloaded when ready
+@app.route('/jobs', methods=['GET', 'POST'])
+@login_required()
+def jobs():
+    if request.method == 'POST':
+        kind = request.form.get('kind', '')
+        required_role = JOB_KINDS[kind][1] if kind in JOB_KINDS else None
+        if required_role and session.get('role') != required_role:
+            flash('Access denied. Insufficient permissions.', 'danger')
+            return redirect(url_for('jobs'))
+        params = {name: request.form[name] for name in ('period', 'start', 'end') if request.form.get(name)}
+        try:
+            enqueue(kind, params, requested_by=session.get('username'))
+        except ValueError as e:
+            flash(f'Could not queue the job: {e}', 'danger')
+            return redirect(url_for('jobs'))
+        flash(f'{JOB_KINDS[kind][2]} queued. It can be downloaded here when it is ready.', 'info')
+        return redirect(url_for('jobs'))
+
+    jobs_list = visible_jobs(Job.query, session.get('username'), session.get('role')) \
+        .order_by(Job.id.desc()).limit(50).all()
+    return render_template('jobs.html', jobs=jobs_list, kinds=JOB_KINDS)
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required()
+def api_job(job_id):
+    job = visible_jobs(Job.query, session.get('username'), session.get('role')) \
+        .filter(Job.id == job_id).first_or_404()
+    return jsonify(job_to_dict(job))
+
+@app.route('/jobs/<int:job_id>/download')
+@login_required()
+def download_job(job_id):
+    job = visible_jobs(Job.query, session.get('username'), session.get('role')) \
+        .filter(Job.id == job_id, Job.status == 'done', Job.result_name.isnot(None)).first_or_404()
+    return send_file(runner.result_path(job.id), as_attachment=True, download_name=job.result_name)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    token = app.config.get('METRICS_TOKEN')
+    if not app.config.get('METRICS_ENABLED') or (token and request.headers.get('Authorization') != f'Bearer {token}'):
+        return Response('Not found\n', status=404, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Bulk import: the request body is parsed incrementally and written in chunked transactions
+def import_format():
+    fmt = request.args.get('format')
+    if not fmt:
+        fmt = 'jsonl' if 'json' in (request.mimetype or '') else 'csv'
+    return fmt
+
+def run_import(importer):
+    try:
+        report = importer(iter_records(request.stream, import_format()))
+    except (UnicodeDecodeError, ValueError, csv.Error) as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        # Chunks committed before a malformed file broke off change the catalogue too
+        invalidate_alerts()
+        drug_search.invalidate()
+    return jsonify(report.to_dict())
+
+@app.route('/api/import/drugs', methods=['POST'])
+@login_required(role='admin')
+def api_import_drugs():
+    return run_import(import_drugs)
+
+@app.route('/api/import/purchases', methods=['POST'])
+@login_required(role='admin')
+def api_import_purchases():
+    return run_import(import_purchases)
+
+@app.route('/api/purchases')
+@login_required(role='admin')
+def api_purchases():
+    try:
+        items, next_cursor = keyset_page(purchases_with_drug(), Purchase.purchase_date, Purchase.id,
+                                         request.args.get('cursor'), page_size(request.args.get('limit')))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'items': [purchase_to_dict(purchase) for purchase in items], 'next_cursor': next_cursor})
+
 @app.route('/api/drugs/search')
 @login_required()
 def api_drugs_search():
     query = request.args.get('q', '')
-    drugs = Drug.query.filter(Drug.name.ilike(f'%{query}%')).limit(10).all()
-    return jsonify([{
-        'id': drug.id, 
-        'name': drug.name, 
-        'quantity': drug.quantity, 
-        'selling_price': float(drug.selling_price)
-    } for drug in drugs])
+    in_stock = request.args.get('in_stock') == '1'
+    # Stock and prices come from the per-worker snapshot, so no query per keystroke
+    snapshot = catalogue_snapshot()
+    drugs = (snapshot.get(drug_id) for drug_id in search_ids(query, limit=50 if in_stock else 10))
+    drugs = [drug for drug in drugs if drug and (drug.quantity > 0 or not in_stock)][:10]
+    return jsonify([drug.to_dict() for drug in drugs])
 
 @app.route('/api/alerts')
 @login_required()
 def api_alerts():
-    low_stock = Drug.query.filter(Drug.quantity < 10).count()
-    soon_date = datetime.now().date() + timedelta(days=30)
-    expiring_soon = Drug.query.filter(Drug.expiry_date <= soon_date, Drug.expiry_date > datetime.now().date()).count()
-    expired = Drug.query.filter(Drug.expiry_date <= datetime.now().date()).count()
+    payload = alert_payload(alert_counts())
     
-    return jsonify({
-        'low_stock': low_stock,
-        'expiring_soon': expiring_soon,
-        'expired': expired
-    })
+    response = jsonify(payload)
+    response.set_etag(alerts_etag(payload))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+# Server-Sent Events: pushes the alert counters whenever they change
+@app.route('/api/alerts/stream')
+@login_required()
+def api_alerts_stream():
+    timeout = app.config['ALERT_STREAM_TIMEOUT']
+    if not alert_stream_slots.acquire(blocking=False):
+        return Response('Too many alert streams, poll /api/alerts instead', status=503,
+                        mimetype='text/plain', headers={'Retry-After': str(timeout)})
+    released = []
+
+    def release():
+        # Runs when the server closes the response: stream ended or client went away
+        if not released:
+            released.append(True)
+            alert_stream_slots.release()
+    
+    def generate():
+        deadline = time.monotonic() + timeout
+        last_payload = None
+        last_sent = time.monotonic()
+        yield 'retry: 5000\n\n'
+        while time.monotonic() < deadline:
+            payload = alert_payload(alert_counts())
+            # Don't hold a pooled connection while waiting for the next change
+            db.session.close()
+            if payload != last_payload:
+                yield f'data: {json.dumps(payload)}\n\n'
+                last_payload = payload
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > 15:
+                yield ': keep-alive\n\n'
+                last_sent = time.monotonic()
+            wait_for_change(timeout=1)
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(release)
+    return response
 
 # Initialize database
 def init_db():
     with app.app_context():
-        db.create_all()
+        init_schema()
         
         # Create default admin user if not exists
         if not User.query.filter_by(username='admin').first():
             admin = User(username='admin', role='admin')
-            admin.set_password('admin123')
+            admin.set_password('admin123', app.config['PASSWORD_HASH_METHOD'])
             db.session.add(admin)
             
         # Create sample pharmacist user
         if not User.query.filter_by(username='pharmacist').first():
             pharmacist = User(username='pharmacist', role='pharmacist')
-            pharmacist.set_password('pharma123')
+            pharmacist.set_password('pharma123', app.config['PASSWORD_HASH_METHOD'])
             db.session.add(pharmacist)
             
         # Create sample drugs if none exist
@@ -437,11 +848,123 @@ def init_db():
                     expiry_date=datetime(2023, 12, 15).date()
                 )
             ]
+            for drug in sample_drugs:
+                drug.batches.append(opening_batch(drug))
             db.session.add_all(sample_drugs)
+            db.session.flush()
+            record_movements({drug.id: drug.quantity for drug in sample_drugs}, 'opening')
             
         db.session.commit()
         print("Database initialized successfully!")
 
+def branch_option(f):
+    """--branch for commands that work on one branch's data"""
+    @click.option('--branch', default=DEFAULT_BRANCH, show_default=True, help='Branch whose database to use')
+    @wraps(f)
+    def command(branch, **kwargs):
+        if not is_branch(branch):
+            raise click.BadParameter(f'unknown branch {branch}', param_hint='--branch')
+        with use_branch(branch):
+            return f(**kwargs)
+    return command
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Create missing tables and apply pending schema migrations in every branch's database"""
+    for branch, applied in init_schema().items():
+        click.echo(f'{branch}: applied migrations {applied}' if applied else f'{branch}: schema is up to date.')
+
+@app.cli.command('check-indexes')
+@branch_option
+def check_indexes_command():
+    """Verify with EXPLAIN that each route's hot queries use their intended index"""
+    failures = check_query_plans()
+    for route, description, index, plan in failures:
+        click.echo(f'{route}: {description} does not use {index}\n{plan}\n', err=True)
+    if failures:
+        raise SystemExit(1)
+    click.echo('All query plans use their intended indexes.')
+
+@app.cli.command('rollup-sales')
+@branch_option
+@click.option('--start', type=click.DateTime(['%Y-%m-%d']), help='First day to rebuild (default: all)')
+@click.option('--end', type=click.DateTime(['%Y-%m-%d']), help='Last day to rebuild (default: all)')
+def rollup_sales_command(start, end):
+    """Rebuild the daily sales rollup from raw sales"""
+    with branch_engine().begin() as conn:
+        rows = rebuild_rollup(conn, start and start.date(), end and end.date())
+    invalidate_alerts()  # cached sales reports were built from the old rollup
+    click.echo(f'Wrote {rows} rollup rows.')
+
+@app.cli.command('run-jobs')
+@click.option('--threads', default=2, help='Jobs run at once')
+@click.option('--once', is_flag=True, help='Run what is queued now, then exit')
+def run_jobs_command(threads, once):
+    """Run background jobs outside the web processes (pair with JOB_WORKERS=0)"""
+    if once:
+        click.echo(f'Ran {runner.run_pending()} jobs.')
+        return
+    runner.start(threads)
+    click.echo(f'Running jobs with {threads} threads, Ctrl+C to stop.')
+    while True:
+        time.sleep(60)
+
+@app.cli.command('snapshot-stock')
+@branch_option
+def snapshot_stock_command():
+    """Record every drug's stock ledger balance (also run nightly as a job)"""
+    with branch_engine().begin() as conn:
+        snapshot_id = take_snapshot(conn)
+    click.echo(f'Took snapshot {snapshot_id}.' if snapshot_id else 'No movements since the last snapshot.')
+
+@app.cli.command('reconcile-stock')
+@branch_option
+@click.option('--full', is_flag=True, help='Sum the whole ledger instead of starting from the latest snapshot')
+def reconcile_stock_command(full):
+    """Check that every drug's stock ledger adds up to its recorded quantity"""
+    mismatches = reconcile(full)
+    for drug_id, ledger, stock in mismatches:
+        click.echo(f'drug {drug_id}: ledger {ledger}, stock {stock}', err=True)
+    if mismatches:
+        raise SystemExit(1)
+    click.echo('Stock ledger matches every drug.')
+
+def print_import_report(report):
+    click.echo(f'{report.rows} rows: {report.inserted} inserted, {report.updated} updated, '
+               f'{report.error_count} errors')
+    for error in report.errors[:20]:
+        click.echo(f"  line {error['line']}: {error['error']}", err=True)
+
+@app.cli.command('import-drugs')
+@branch_option
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv')
+def import_drugs_command(path, fmt):
+    """Upsert drugs by (name, batch_no) from a CSV or JSON Lines file"""
+    with open(path, 'rb') as f:
+        print_import_report(import_drugs(iter_records(f, fmt)))
+    invalidate_alerts()
+    drug_search.invalidate()
+
+@app.cli.command('import-purchases')
+@branch_option
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv')
+def import_purchases_command(path, fmt):
+    """Record purchases from a CSV or JSON Lines file and restock the matching drugs"""
+    with open(path, 'rb') as f:
+        print_import_report(import_purchases(iter_records(f, fmt)))
+    invalidate_alerts()
+
+@app.cli.command('export-stock')
+@branch_option
+@click.argument('output', type=click.File('w'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default='csv')
+def export_stock_command(output, fmt):
+    """Write the stock report as CSV or JSON Lines (to stdout by default)"""
+    for chunk in write_records(stock_rows(), DRUG_FIELDS, fmt):
+        output.write(chunk)
+
 if __name__ == '__main__':
     init_db()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,117 @@
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+from models import db, User, UserSession, PASSWORD_HASH_METHOD
+from signals import ChangeSignal
+
+SESSION_LIFETIME = timedelta(hours=12)
+SESSION_CACHE_TTL = 60  # seconds a validated session is trusted without a query
+MAX_CACHED_SESSIONS = 10000
+
+_lock = threading.Lock()
+_sessions = {}  # session id -> (expires monotonic, user dict or None)
+_stamp = [0]
+_reference_hashes = {}  # hash method -> hash of a random password
+
+# Logging out, deleting a user or changing a role in one gunicorn worker
+# drops the cached sessions of every worker through users_signal.
+users_signal = ChangeSignal('users.signal')
+
+def init_auth(app):
+    app.config.setdefault('PASSWORD_HASH_METHOD', PASSWORD_HASH_METHOD)
+    app.config.setdefault('SESSION_LIFETIME', SESSION_LIFETIME)
+    users_signal.init_app(app)
+    # The cache starts empty, so nothing signalled before startup concerns it
+    _stamp[0] = users_signal.stamp()
+
+def hash_method():
+    return current_app.config.get('PASSWORD_HASH_METHOD', PASSWORD_HASH_METHOD)
+
+def hash_password(password):
+    return generate_password_hash(password, hash_method())
+
+def reference_hash(method):
+    """A hash of a random password made with method, once per process. It stands in
+    for a missing user's hash, and its prefix is what method's hashes are stored as
+    (werkzeug expands 'scrypt' to 'scrypt:32768:8:1', 'pbkdf2' to 'pbkdf2:sha256:600000')."""
+    if method not in _reference_hashes:
+        _reference_hashes[method] = generate_password_hash(secrets.token_hex(8), method)
+    return _reference_hashes[method]
+
+def hash_params(password_hash):
+    return password_hash.split('$', 1)[0]
+
+def authenticate(username, password):
+    """Return the user if the password matches, upgrading the stored hash when the
+    hash policy has changed since it was made"""
+    user = User.query.filter_by(username=username).first()
+    method = hash_method()
+    if user is None:
+        # Spend the same time as a real check so response times do not reveal usernames
+        check_password_hash(reference_hash(method), password)
+        return None
+    if not check_password_hash(user.password_hash, password):
+        return None
+    if hash_params(user.password_hash) != hash_params(reference_hash(method)):
+        user.password_hash = generate_password_hash(password, method)
+        db.session.commit()
+    return user
+
+def start_session(user):
+    """Record a server-side session for user and return its id for the cookie"""
+    now = datetime.utcnow()
+    UserSession.query.filter(UserSession.expires_at < now).delete(synchronize_session=False)
+    session_id = secrets.token_urlsafe(32)
+    db.session.add(UserSession(id=session_id, user_id=user.id, created_at=now,
+                               expires_at=now + current_app.config['SESSION_LIFETIME']))
+    db.session.commit()
+    with _lock:
+        _sessions[session_id] = (time.monotonic() + SESSION_CACHE_TTL,
+                                 {'id': user.id, 'username': user.username, 'role': user.role,
+                                  'branch': user.branch})
+    return session_id
+
+def end_session(session_id):
+    if session_id:
+        UserSession.query.filter_by(id=session_id).delete(synchronize_session=False)
+        db.session.commit()
+        invalidate_sessions()
+
+def revoke_user_sessions(user_id):
+    """Delete every session of a user (the caller commits, then calls invalidate_sessions)"""
+    UserSession.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+
+def invalidate_sessions():
+    """Drop cached sessions here and, through users_signal, in every other worker"""
+    with _lock:
+        _sessions.clear()
+        _stamp[0] = users_signal.touch()
+
+def session_user(session_id):
+    """The {id, username, role, branch} of a live session, or None. Answered from a
+    per-process cache for up to SESSION_CACHE_TTL seconds; one query on a miss."""
+    if not session_id:
+        return None
+    now = time.monotonic()
+    stamp = users_signal.stamp()
+    with _lock:
+        if stamp != _stamp[0]:
+            _sessions.clear()
+            _stamp[0] = stamp
+        cached = _sessions.get(session_id)
+        if cached and now < cached[0]:
+            return cached[1]
+
+    row = db.session.query(User.id, User.username, User.role, User.branch) \
+        .join(UserSession, UserSession.user_id == User.id) \
+        .filter(UserSession.id == session_id, UserSession.expires_at > datetime.utcnow()).first()
+    user = row._asdict() if row else None
+    with _lock:
+        if _stamp[0] == stamp:
+            if len(_sessions) >= MAX_CACHED_SESSIONS:
+                _sessions.clear()
+            _sessions[session_id] = (now + SESSION_CACHE_TTL, user)
+    return user
@@ -0,0 +1,149 @@
+"""Checkout latency at one branch while another branch runs heavy reports.
+
+Sets up two branches, main and north, each in its own database, with a
+large sales history at main. Report processes then loop over main's
+heaviest work (rollup rebuilds and full sales exports) while a checkout
+process posts single-line baskets to /api/sales/checkout, and the
+checkout latencies are compared for three cases: north with no report
+load, north while main is busy, and main itself while main is busy, which
+is what every store saw when they all shared one database. Separate
+databases remove lock and connection contention, not CPU contention, so
+run it with a core to spare for each process.
+
+Usage: python bench/branch_isolation.py [--checkouts 300] [--reporters 2] [--history 200000]
+       [--database-url ...] [--branch-url ...]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup(history):
+    sys.path.insert(0, ROOT)
+    from app import app, init_db
+    from models import db, User, Drug, Sale
+    from branches import use_branch
+    from stock import opening_batch
+    from ledger import record_movements
+    from reporting import rebuild_rollup
+    from dbconfig import branch_engine
+    init_db()
+    drug_ids = {}
+    with app.app_context():
+        for branch in ('main', 'north'):
+            if not User.query.filter_by(username=f'bench-{branch}').first():
+                user = User(username=f'bench-{branch}', role='pharmacist', branch=branch)
+                user.set_password('bench', app.config['PASSWORD_HASH_METHOD'])
+                db.session.add(user)
+        db.session.commit()
+        for branch in ('main', 'north'):
+            with use_branch(branch):
+                drug = Drug(name='Bench Tablet', category='Bench', batch_no='BENCH', manufacturer='Bench',
+                            quantity=10 ** 7, cost_price=0.5, selling_price=1.0,
+                            expiry_date=datetime(2035, 1, 1).date())
+                drug.batches.append(opening_batch(drug))
+                db.session.add(drug)
+                db.session.flush()
+                record_movements({drug.id: drug.quantity}, 'opening')
+                db.session.commit()
+                drug_ids[branch] = drug.id
+                if branch == 'main':
+                    start = datetime.now() - timedelta(days=365)
+                    rows = [dict(drug_id=drug.id, quantity=1, unit_price=1.0, total_price=1.0,
+                                 staff_name=f'staff{i % 7}', sale_date=start + timedelta(minutes=i % 525600))
+                            for i in range(history)]
+                    for offset in range(0, len(rows), 10000):
+                        db.session.execute(db.insert(Sale), rows[offset:offset + 10000])
+                    db.session.commit()
+                    with branch_engine().begin() as conn:
+                        rebuild_rollup(conn)
+                db.session.remove()
+    return drug_ids
+
+def report_worker(stop):
+    sys.path.insert(0, ROOT)
+    from app import app
+    from branches import use_branch
+    from bulk import sales_history
+    from reporting import rebuild_rollup
+    from dbconfig import branch_engine
+    with app.app_context(), use_branch('main'):
+        while not stop.is_set():
+            with branch_engine().begin() as conn:
+                rebuild_rollup(conn)
+            header, rows = sales_history()
+            for _ in rows:
+                pass
+
+def checkout_worker(branch, drug_id, checkouts, results):
+    sys.path.insert(0, ROOT)
+    from app import app
+    client = app.test_client()
+    client.post('/login', data={'username': f'bench-{branch}', 'password': 'bench'})
+    timings, failures = [], 0
+    for _ in range(checkouts):
+        start = time.perf_counter()
+        response = client.post('/api/sales/checkout', json={'lines': [{'drug_id': drug_id, 'quantity': 1}]})
+        timings.append(time.perf_counter() - start)
+        failures += response.status_code != 201
+    results.put((timings, failures))
+
+def measure(ctx, label, branch, drug_id, checkouts, reporters):
+    stop = ctx.Event()
+    workers = [ctx.Process(target=report_worker, args=(stop,)) for _ in range(reporters)]
+    for worker in workers:
+        worker.start()
+    if workers:
+        time.sleep(2)  # let the reports get going
+    results = ctx.Queue()
+    checkout = ctx.Process(target=checkout_worker, args=(branch, drug_id, checkouts, results))
+    checkout.start()
+    timings, failures = results.get()
+    checkout.join()
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    timings.sort()
+    def percentile(p):
+        return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+    print(f'{label:<36}{percentile(0.5):>9.1f}{percentile(0.95):>9.1f}{percentile(0.99):>9.1f}{failures:>9}')
+    return percentile(0.95)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--checkouts', type=int, default=300)
+    parser.add_argument('--reporters', type=int, default=2, help='processes running main branch reports')
+    parser.add_argument('--history', type=int, default=200000, help='sales already recorded at main')
+    parser.add_argument('--database-url', default=None, help='main branch database')
+    parser.add_argument('--branch-url', default=None, help='north branch database')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{os.path.join(workdir, "main.db")}'
+    os.environ['BRANCH_DATABASES'] = f'north={args.branch_url or "sqlite:///" + os.path.join(workdir, "north.db")}'
+    os.environ['JOB_WORKERS'] = '0'
+    os.environ['METRICS_ENABLED'] = '0'
+
+    # spawn so that no process inherits another's database connections
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        drug_ids = pool.apply(setup, (args.history,))
+
+    if (os.cpu_count() or 1) <= args.reporters:
+        print(f'warning: {os.cpu_count()} CPUs for {args.reporters + 1} busy processes; '
+              'checkouts will also wait for CPU\n')
+    print(f'{"checkout latency (ms)":<36}{"p50":>9}{"p95":>9}{"p99":>9}{"failed":>9}')
+    idle = measure(ctx, 'north, no reports', 'north', drug_ids['north'], args.checkouts, 0)
+    isolated = measure(ctx, 'north, main running reports', 'north', drug_ids['north'], args.checkouts,
+                       args.reporters)
+    measure(ctx, 'main, main running reports', 'main', drug_ids['main'], args.checkouts, args.reporters)
+    print(f'\nnorth p95 under main report load: {isolated / idle:.1f}x its idle p95')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Bulk import/export throughput in rows per second.
+
+Imports a synthetic wholesaler price list (all inserts), imports it again
+(all updates), imports one purchase per drug and streams the stock report
+back out, against a scratch database.
+
+Usage: python bench/bulk_benchmark.py [--rows 50000] [--database-url postgresql://...]
+"""
+import argparse
+import csv
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def price_list(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['name', 'category', 'batch_no', 'manufacturer', 'quantity',
+                     'cost_price', 'selling_price', 'expiry_date'])
+    for i in range(rows):
+        writer.writerow([f'Bench Drug {i}', f'Category {i % 40}', f'LOT{i % 7}', 'Wholesale Ltd',
+                         100 + i % 50, 1.25, 2.5, '2030-06-30'])
+    return buffer.getvalue().encode()
+
+def purchase_list(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['drug_name', 'batch_no', 'supplier_name', 'quantity', 'cost_price', 'purchase_date'])
+    for i in range(rows):
+        writer.writerow([f'Bench Drug {i}', f'LOT{i % 7}', 'Wholesale Ltd', 20, 1.3, '2026-01-15'])
+    return buffer.getvalue().encode()
+
+def report(label, rows, seconds):
+    print(f'{label:<28}{rows:>8} rows {seconds:>8.2f}s {rows / seconds:>10.0f} rows/s')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url or \
+        f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bulk_benchmark.db")}'
+
+    from app import app, init_db
+    from bulk import iter_records, import_drugs, import_purchases, stock_rows, write_records, DRUG_FIELDS
+
+    init_db()
+    drugs_csv = price_list(args.rows)
+    purchases_csv = purchase_list(args.rows)
+
+    with app.app_context():
+        for label in ('drug import (insert)', 'drug import (update)'):
+            start = time.perf_counter()
+            result = import_drugs(iter_records(io.BytesIO(drugs_csv)))
+            report(label, result.rows, time.perf_counter() - start)
+            assert result.error_count == 0, result.errors[:5]
+
+        start = time.perf_counter()
+        result = import_purchases(iter_records(io.BytesIO(purchases_csv)))
+        report('purchase import', result.rows, time.perf_counter() - start)
+        assert result.error_count == 0, result.errors[:5]
+
+        start = time.perf_counter()
+        exported = sum(chunk.count('\n') for chunk in write_records(stock_rows(), DRUG_FIELDS)) - 1
+        report('stock export (csv)', exported, time.perf_counter() - start)
+
+if __name__ == '__main__':
+    main()
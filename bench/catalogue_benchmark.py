@@ -0,0 +1,71 @@
+"""Drug picker data: ORM objects against the catalogue snapshot.
+
+Loads a synthetic catalogue (default 100k drugs) into a scratch database and
+compares what the sales page used to do on every view, loading every in-stock
+drug as an ORM object, with building the per-worker snapshot once and reading
+picker rows from it. Memory is what each approach holds, per tracemalloc.
+
+Usage: python bench/catalogue_benchmark.py [--drugs 100000] [--database-url ...]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, Drug
+from catalogue import Snapshot, catalogue_snapshot
+
+def measured(label, fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f'{label:<34}{elapsed * 1000:>9.1f}ms{held / 1e6:>9.1f}MB')
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drugs', type=int, default=100000)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    app = Flask(__name__, instance_path=workdir)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url or \
+        f'sqlite:///{os.path.join(workdir, "catalogue_benchmark.db")}'
+    db.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(db.insert(Drug), [
+            dict(name=f'Bench Drug {i:06d} 500mg Tablet', category='Bench', batch_no='B', manufacturer='M',
+                 quantity=i % 50, cost_price=1.0, selling_price=2.5, expiry_date=date(2030, 1, 1))
+            for i in range(args.drugs)
+        ])
+        db.session.commit()
+        print(f'{"":<34}{"time":>11}{"held":>11}')
+
+        drugs = measured('ORM in-stock drugs (per view)', lambda: Drug.query.filter(Drug.quantity > 0).all())
+        del drugs
+        db.session.expunge_all()
+
+        rows = db.session.query(Drug.id, Drug.name, Drug.quantity, Drug.selling_price).order_by(Drug.id).all()
+        snapshot = measured('build snapshot (new names)', lambda: Snapshot.build(0, 0, rows))
+        stock = [(drug_id, quantity, price) for drug_id, _, quantity, price in rows]
+        measured('refresh stock (after a sale)', lambda: snapshot.with_stock(1, stock))
+        del rows, stock, snapshot
+        catalogue_snapshot()
+        measured('read current snapshot (per view)', catalogue_snapshot)
+        picker = measured('in-stock picker rows (per view)', lambda: list(catalogue_snapshot().rows(in_stock=True)))
+        print(f'\n{len(picker)} of {args.drugs} drugs in stock')
+
+if __name__ == '__main__':
+    main()
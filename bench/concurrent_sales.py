@@ -0,0 +1,116 @@
+"""Multi-process checkout load test against a single drug.
+
+Every process logs in and posts single-unit sales to /sales through the
+Flask test client, all against the same drug, so the conditional stock
+decrement is exercised under real lock contention. The run fails unless
+the final stock, the recorded Sale rows and the successful checkouts all
+agree exactly.
+
+Usage: python bench/concurrent_sales.py [--processes 8] [--sales 500] [--stock 3000]
+       [--database-url postgresql://...]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup(stock):
+    sys.path.insert(0, ROOT)
+    from app import app, init_db
+    from models import db, Drug, Sale
+    from stock import set_stock_level, write_off_expired
+    init_db()
+    with app.app_context():
+        Sale.query.delete()
+        drug = Drug.query.filter_by(name='Paracetamol 500mg').first()
+        # The sample lot has long expired, and expired stock is never sold
+        write_off_expired([drug.id])
+        set_stock_level(drug.id, stock, 'BENCH', drug.cost_price, date.today() + timedelta(days=365))
+        db.session.commit()
+        return drug.id
+
+def checkout_worker(drug_id, sales, results):
+    sys.path.insert(0, ROOT)
+    from app import app
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    with client.session_transaction() as sess:
+        sess.pop('_flashes', None)
+
+    counts = {'success': 0, 'danger': 0}
+    for _ in range(sales):
+        client.post('/sales', data={'drug_id': drug_id, 'quantity': 1})
+        with client.session_transaction() as sess:
+            for category, message in sess.pop('_flashes', []):
+                if category == 'success':
+                    counts['success'] += 1
+                elif message == 'Insufficient stock!':
+                    counts['danger'] += 1
+                else:
+                    counts.setdefault('errors', []).append(message)
+    results.put(counts)
+
+def final_state(drug_id):
+    sys.path.insert(0, ROOT)
+    from app import app
+    from models import db, Drug, Sale
+    with app.app_context():
+        quantity = db.session.get(Drug, drug_id).quantity
+        sold = db.session.query(db.func.coalesce(db.func.sum(Sale.quantity), 0)).filter_by(drug_id=drug_id).scalar()
+        return quantity, sold
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--sales', type=int, default=500, help='checkouts per process')
+    parser.add_argument('--stock', type=int, default=3000)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url or \
+        f'sqlite:///{os.path.join(tempfile.mkdtemp(), "concurrent_sales.db")}'
+
+    # spawn so that no process inherits another's database connections
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        drug_id = pool.apply(setup, (args.stock,))
+
+    results = ctx.Queue()
+    workers = [ctx.Process(target=checkout_worker, args=(drug_id, args.sales, results))
+               for _ in range(args.processes)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    counts = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    with ctx.Pool(1) as pool:
+        quantity, sold = pool.apply(final_state, (drug_id,))
+
+    succeeded = sum(c['success'] for c in counts)
+    refused = sum(c['danger'] for c in counts)
+    errors = [e for c in counts for e in c.get('errors', [])]
+    attempts = args.processes * args.sales
+
+    print(f'{attempts} checkouts from {args.processes} processes in {elapsed:.1f}s '
+          f'({attempts / elapsed:.0f}/s)')
+    print(f'sold {succeeded}, refused for stock {refused}, errors {len(errors)}')
+    print(f'final stock {quantity}, Sale rows total {sold}')
+
+    expected_sold = min(attempts, args.stock)
+    ok = (not errors and succeeded == sold == expected_sold
+          and quantity == args.stock - expected_sold)
+    print('OK: stock is exact' if ok else 'FAIL: stock does not reconcile')
+    for error in errors[:5]:
+        print('  error:', error)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Reorder forecast over a large catalogue.
+
+Loads synthetic sales history (default 1M sales over 90 days across 50k
+drugs) into a scratch database, builds the daily rollup and times the
+forecast: loading the rollup into arrays and the vectorized pass itself.
+
+Usage: python bench/forecast_benchmark.py [--drugs 50000] [--sales 1000000] [--database-url ...]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, Drug, Sale
+from reporting import rebuild_rollup
+from analytics import WINDOW_DAYS, load_catalogue, load_daily_sales, forecast, forecast_rows
+
+STAFF = ['admin', 'pharmacist', 'alice', 'bob', 'carol']
+INSERT_BATCH = 50000
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    print(f'{label:<34}{time.perf_counter() - start:>8.2f}s')
+    return result
+
+def load_history(drugs, sales, today, rng):
+    db.session.execute(db.insert(Drug), [
+        dict(name=f'Bench Drug {i}', category='Bench', batch_no='B', manufacturer='M',
+             quantity=int(q), cost_price=1.0, selling_price=2.0, expiry_date=date(2030, 1, 1))
+        for i, q in enumerate(rng.integers(0, 500, drugs))
+    ])
+    # Skewed demand: a few drugs sell far more than the rest
+    drug_ids = rng.zipf(1.3, sales) % drugs + 1
+    ages = rng.integers(0, WINDOW_DAYS, sales)
+    quantities = rng.integers(1, 5, sales)
+    start = datetime.combine(today, datetime.min.time()) + timedelta(hours=12)
+    for offset in range(0, sales, INSERT_BATCH):
+        stop = offset + INSERT_BATCH
+        db.session.execute(db.insert(Sale), [
+            dict(drug_id=drug_id, quantity=quantity, unit_price=2.0, total_price=2.0 * quantity,
+                 staff_name=STAFF[drug_id % len(STAFF)], sale_date=start - timedelta(days=age))
+            for drug_id, quantity, age in zip(drug_ids[offset:stop].tolist(), quantities[offset:stop].tolist(),
+                                              ages[offset:stop].tolist())
+        ])
+    db.session.commit()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--drugs', type=int, default=50000)
+    parser.add_argument('--sales', type=int, default=1000000)
+    parser.add_argument('--database-url', default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    app = Flask(__name__, instance_path=workdir)
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database_url or \
+        f'sqlite:///{os.path.join(workdir, "forecast_benchmark.db")}'
+    db.init_app(app)
+    today = date.today()
+    rng = np.random.default_rng(42)
+
+    with app.app_context():
+        db.create_all()
+        timed(f'load {args.sales} sales (setup)', lambda: load_history(args.drugs, args.sales, today, rng))
+        with db.engine.begin() as conn:
+            rows = timed('build daily rollup (setup)', lambda: rebuild_rollup(conn))
+        print(f'{rows} rollup rows\n')
+
+        catalogue = timed('read catalogue into arrays', load_catalogue)
+        sales = timed('read rollup into arrays', lambda: load_daily_sales(
+            today - timedelta(days=WINDOW_DAYS - 1), today + timedelta(days=1)))
+        drug_ids, names, stock = catalogue
+        result = timed('vectorized forecast', lambda: forecast(drug_ids, stock, *sales, today=today))
+        result.update(drug_id=drug_ids, name=names, quantity=stock, today=today)
+        rows = timed('rows for drugs to reorder', lambda: forecast_rows(result, reorder_only=True))
+        print(f'\n{len(rows)} of {len(drug_ids)} drugs need reordering')
+
+if __name__ == '__main__':
+    main()
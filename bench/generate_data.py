@@ -0,0 +1,180 @@
+"""Synthetic pharmacy data at realistic scale.
+
+Builds a catalogue of drugs with one to three batches each, then years of
+sales and purchases: a few drugs sell far more than the rest, trade is
+busier on weekdays and in winter, and the business grows over time. The
+same seed and sizes always give the same data (relative to today).
+
+Usage: python bench/generate_data.py --database-url sqlite:////tmp/pharmacy-big.db
+       [--drugs 10000] [--sales 5000000] [--purchases 200000] [--years 3] [--seed 42]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+STEMS = {
+    'Paracetamol': 'Analgesic', 'Ibuprofen': 'Analgesic', 'Diclofenac': 'Analgesic', 'Aspirin': 'Analgesic',
+    'Amoxicillin': 'Antibiotic', 'Ciprofloxacin': 'Antibiotic', 'Azithromycin': 'Antibiotic',
+    'Doxycycline': 'Antibiotic', 'Metronidazole': 'Antibiotic', 'Fluconazole': 'Antifungal',
+    'Metformin': 'Antidiabetic', 'Omeprazole': 'Gastrointestinal', 'Ranitidine': 'Gastrointestinal',
+    'Atorvastatin': 'Cardiovascular', 'Amlodipine': 'Cardiovascular', 'Losartan': 'Cardiovascular',
+    'Cetirizine': 'Antihistamine', 'Loratadine': 'Antihistamine', 'Salbutamol': 'Respiratory',
+    'Prednisolone': 'Corticosteroid', 'Vitamin C': 'Supplement', 'Folic Acid': 'Supplement',
+    'Ferrous Sulfate': 'Supplement', 'Zinc Sulfate': 'Supplement',
+}
+FORMS = ['Tablet', 'Capsule', 'Syrup', 'Suspension', 'Injection', 'Cream', 'Drops']
+STRENGTHS = ['5mg', '10mg', '20mg', '50mg', '100mg', '250mg', '500mg', '1g']
+MANUFACTURERS = ['Pharma Inc', 'Med Labs', 'Health Plus', 'Generics Co', 'BioCure', 'Wellness Ltd']
+SUPPLIERS = ['Central Wholesale', 'MedSupply Direct', 'Pharma Distributors', 'Regional Health Stores']
+STAFF = ['admin', 'pharmacist', 'alice', 'bob', 'carol', 'dave']
+CHUNK = 50000  # rows per INSERT batch
+
+def drug_names(count, rng):
+    stems = list(STEMS)
+    for i in range(count):
+        stem = rng.choice(stems)
+        yield stem, (f'{stem} {rng.choice(STRENGTHS)} {rng.choice(FORMS)} '
+                     f'{rng.choice("ABCDEFGHJK")}{i}')
+
+def day_weights(days, today):
+    """Relative trade on each of the last `days` days: weekday, winter and growth effects"""
+    offsets = np.arange(days)
+    dates = np.datetime64(today, 'D') - offsets
+    weekday = (dates.astype('datetime64[D]').view('int64') - 4) % 7  # 0 is Monday
+    month = dates.astype('datetime64[M]').view('int64') % 12 + 1
+    weights = np.where(weekday < 5, 1.0, 0.6)
+    weights = weights * np.where((month <= 2) | (month == 12), 1.3, 1.0)
+    weights = weights * (1.0 - 0.3 * offsets / days)
+    return weights / weights.sum()
+
+def timestamps(count, weights, today, rng):
+    """count sorted sale times over the weighted days, during opening hours"""
+    offsets = rng.choice(len(weights), size=count, p=weights)
+    seconds = rng.integers(8 * 3600, 20 * 3600, size=count)
+    start = datetime.combine(today, datetime.min.time())
+    stamps = np.sort(-offsets.astype(np.int64) * 86400 + seconds)
+    return [start + timedelta(seconds=s) for s in stamps.tolist()]
+
+def insert_chunks(table, rows):
+    from models import db
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == CHUNK:
+            db.session.execute(db.insert(table), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(table), batch)
+    db.session.commit()
+
+def generate_catalogue(count, today, rng, seed):
+    from models import db, Drug, DrugBatch
+    from stock import recount_drug_stock, refresh_drug_summary
+    names = random.Random(seed)
+    prices = np.round(rng.lognormal(1.0, 0.8, count), 2) + 0.25
+    insert_chunks(Drug, (
+        dict(name=name, category=STEMS[stem], batch_no='-', manufacturer=names.choice(MANUFACTURERS),
+             quantity=0, cost_price=0, selling_price=float(price), expiry_date=today)
+        for (stem, name), price in zip(drug_names(count, names), prices)
+    ))
+
+    batches_per_drug = rng.integers(1, 4, count)
+    drug_ids = np.repeat(np.arange(1, count + 1), batches_per_drug)
+    total = len(drug_ids)
+    quantities = rng.integers(1, 400, total)
+    # About 3% of batches already expired, the rest spread over the next 2.5 years
+    expiry_days = np.where(rng.random(total) < 0.03, -rng.integers(1, 120, total), rng.integers(20, 900, total))
+    costs = np.round(prices[drug_ids - 1] * rng.uniform(0.5, 0.8, total), 2)
+    insert_chunks(DrugBatch, (
+        dict(drug_id=drug_id, batch_no=f'B{drug_id}-{i}', quantity=quantity, cost_price=cost,
+             expiry_date=today + timedelta(days=expiry))
+        for i, (drug_id, quantity, cost, expiry) in enumerate(zip(
+            drug_ids.tolist(), quantities.tolist(), costs.tolist(), expiry_days.tolist())))
+    )
+    for start in range(1, count + 1, CHUNK):
+        ids = range(start, min(start + CHUNK, count + 1))
+        recount_drug_stock(ids, 'opening')
+        refresh_drug_summary(ids)
+    db.session.commit()
+    return prices
+
+def popularity(count, rng):
+    """Zipf-like share of sales for each drug, in random catalogue order"""
+    weights = 1.0 / np.arange(1, count + 1) ** 1.1
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+def generate_sales(count, prices, demand, weights, today, rng):
+    from models import Sale
+    drug_index = rng.choice(len(prices), size=count, p=demand)
+    quantities = rng.geometric(0.6, count)
+    staff = rng.integers(0, len(STAFF), count)
+    stamps = timestamps(count, weights, today, rng)
+    insert_chunks(Sale, (
+        dict(drug_id=index + 1, quantity=quantity, unit_price=float(prices[index]),
+             total_price=round(float(prices[index]) * quantity, 2), staff_name=STAFF[who], sale_date=stamp)
+        for index, quantity, who, stamp in zip(drug_index.tolist(), quantities.tolist(), staff.tolist(), stamps))
+    )
+
+def generate_purchases(count, prices, demand, weights, today, rng):
+    from models import Purchase
+    drug_index = rng.choice(len(prices), size=count, p=demand)
+    quantities = rng.integers(5, 50, count) * 10
+    suppliers = rng.integers(0, len(SUPPLIERS), count)
+    stamps = timestamps(count, weights, today, rng)
+    insert_chunks(Purchase, (
+        dict(drug_id=index + 1, quantity=quantity, cost_price=round(float(prices[index]) * 0.65, 2),
+             total_cost=round(float(prices[index]) * 0.65 * quantity, 2), supplier_name=SUPPLIERS[supplier],
+             batch_no=f'P{index + 1}-{n}', purchase_date=stamp)
+        for n, (index, quantity, supplier, stamp) in enumerate(zip(
+            drug_index.tolist(), quantities.tolist(), suppliers.tolist(), stamps)))
+    )
+
+def generate(drugs, sales, purchases, years=3, seed=42, today=None, log=print):
+    """Fill the app's (empty) database; call with DATABASE_URL already set"""
+    from app import app, init_db
+    from models import db
+    from migrations import init_schema
+    from reporting import rebuild_rollup
+
+    def timed(label, fn):
+        start = time.perf_counter()
+        result = fn()
+        log(f'{label:<24}{time.perf_counter() - start:>8.1f}s')
+        return result
+
+    today = today or date.today()
+    rng = np.random.default_rng(seed)
+    weights = day_weights(365 * years, today)
+    with app.app_context():
+        init_schema()
+        prices = timed(f'{drugs} drugs', lambda: generate_catalogue(drugs, today, rng, seed))
+        demand = popularity(drugs, rng)
+        timed(f'{sales} sales', lambda: generate_sales(sales, prices, demand, weights, today, rng))
+        timed(f'{purchases} purchases', lambda: generate_purchases(purchases, prices, demand, weights, today, rng))
+        with db.engine.begin() as conn:
+            timed('sales rollup', lambda: rebuild_rollup(conn))
+    init_db()  # users; the catalogue is no longer empty, so no sample drugs
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', required=True)
+    parser.add_argument('--drugs', type=int, default=10000)
+    parser.add_argument('--sales', type=int, default=5000000)
+    parser.add_argument('--purchases', type=int, default=200000)
+    parser.add_argument('--years', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    generate(args.drugs, args.sales, args.purchases, args.years, args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""Latency and throughput of the main routes, with saved baselines.
+
+Drives /dashboard, /sales, the monthly sales report, drug search and the
+alert counters as a logged-in user, either in-process through the Flask
+test client or over HTTP against gunicorn started with gunicorn.conf.py.
+Prints p50/p99 latency and requests per second for each route. Routes served
+from the page or alert caches are measured twice: cold, with the caches
+invalidated before every request the way a stock write does, so the numbers
+cover the queries and rendering behind the page, and warm, as repeat visits
+between writes see it.
+
+With --save-baseline the results are written to the baseline file; later
+runs compare against it and exit non-zero if any route's p50 or p99 got
+slower by more than the tolerance and by more than --min-slowdown-ms, so
+the jitter of sub-millisecond routes is not reported. --repeat N measures
+N times and keeps each route's best run, which steadies the gunicorn mode. Baselines are machine
+specific, so save them on the machine that runs the comparison (see
+bench/README.md).
+
+Usage: python bench/load_test.py [--mode client|gunicorn|both] [--requests 200] [--concurrency 8]
+       [--database-url sqlite:////tmp/pharmacy-big.db]  (default: generate --drugs/--sales fresh)
+       [--save-baseline] [--baseline bench/baselines/load_test.json] [--tolerance 0.25]
+       [--min-slowdown-ms 2] [--repeat 1]
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SEARCH_QUERIES = ['para', 'amoxicillin 500', 'ibuprofn', 'metfor', 'cillin', 'vitamin c syrup']
+# (name, urls, served from caches that every stock write invalidates)
+ROUTES = [
+    ('dashboard', ['/dashboard'], True),
+    ('sales', ['/sales'], True),
+    ('monthly report', ['/reports?type=sales&period=monthly'], True),
+    ('drug search', [f'/api/drugs/search?q={urllib.parse.quote(q)}' for q in SEARCH_QUERIES], False),
+    ('alerts', ['/api/alerts'], True),
+]
+LOGIN = {'username': 'admin', 'password': 'admin123'}
+DEFAULT_BASELINE = os.path.join(ROOT, 'bench', 'baselines', 'load_test.json')
+
+def measured_routes():
+    """(label, urls, cold) for every measurement: cached routes cold and warm"""
+    for name, urls, cached in ROUTES:
+        if cached:
+            yield f'{name} cold', urls, True
+            yield f'{name} warm', urls, False
+        else:
+            yield name, urls, False
+
+def go_cold():
+    """Invalidate the page and alert caches of this process and, through the stock
+    signal file, of every gunicorn worker, as a sale or purchase would"""
+    from app import app
+    from alerts import invalidate_alerts
+    with app.app_context():
+        invalidate_alerts()
+
+def summarize(latencies, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000, 2),
+        'rps': round(len(latencies) / elapsed, 1),
+    }
+
+def run_client(requests, warmup):
+    """Sequential requests through the Flask test client"""
+    from app import app
+    client = app.test_client()
+    client.post('/login', data=LOGIN)
+    results = {}
+    for name, urls, cold in measured_routes():
+        for i in range(warmup):
+            client.get(urls[i % len(urls)])
+        latencies = []
+        start = time.perf_counter()
+        for i in range(requests):
+            if cold:
+                go_cold()
+            began = time.perf_counter()
+            response = client.get(urls[i % len(urls)])
+            latencies.append(time.perf_counter() - began)
+            if response.status_code != 200:
+                raise SystemExit(f'{name}: {urls[i % len(urls)]} returned {response.status_code}')
+        results[name] = summarize(latencies, time.perf_counter() - start)
+    return results
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_gunicorn(port):
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+         '--bind', f'127.0.0.1:{port}', 'app:app'],
+        cwd=ROOT, env=dict(os.environ, METRICS_ENABLED=os.environ.get('METRICS_ENABLED', '1')),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/login', timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('gunicorn did not start')
+
+def logged_in_opener(base):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    opener.open(base + '/login', urllib.parse.urlencode(LOGIN).encode())
+    return opener
+
+def run_gunicorn(requests, warmup, concurrency):
+    """Concurrent HTTP requests, one logged-in session per thread"""
+    port = free_port()
+    base = f'http://127.0.0.1:{port}'
+    process = start_gunicorn(port)
+    try:
+        openers = [logged_in_opener(base) for _ in range(concurrency)]
+        results = {}
+        for name, urls, cold in measured_routes():
+            for i in range(warmup):
+                openers[i % concurrency].open(base + urls[i % len(urls)]).read()
+            latencies, errors = [], []
+            counter = iter(range(requests))
+            lock = threading.Lock()
+
+            def worker(opener):
+                while True:
+                    with lock:
+                        i = next(counter, None)
+                    if i is None:
+                        return
+                    if cold:
+                        go_cold()
+                    began = time.perf_counter()
+                    try:
+                        opener.open(base + urls[i % len(urls)]).read()
+                    except OSError as e:
+                        errors.append(e)
+                        continue
+                    latencies.append(time.perf_counter() - began)
+
+            threads = [threading.Thread(target=worker, args=(opener,)) for opener in openers]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise SystemExit(f'{name}: {len(errors)} failed requests, e.g. {errors[0]}')
+            results[name] = summarize(latencies, time.perf_counter() - start)
+        return results
+    finally:
+        process.terminate()
+        process.wait()
+
+def best_of(runs):
+    """Each route's lowest latencies and highest throughput over several runs"""
+    best = {}
+    for run in runs:
+        for name, result in run.items():
+            if name not in best:
+                best[name] = dict(result)
+                continue
+            for metric in ('p50_ms', 'p99_ms'):
+                best[name][metric] = min(best[name][metric], result[metric])
+            best[name]['rps'] = max(best[name]['rps'], result['rps'])
+    return best
+
+def compare(results, baseline, tolerance, min_slowdown_ms=0):
+    """Lines describing every route whose latency regressed beyond tolerance"""
+    regressions = []
+    for mode, routes in results.items():
+        for name, result in routes.items():
+            before = baseline.get(mode, {}).get(name)
+            if not before:
+                continue
+            for metric in ('p50_ms', 'p99_ms'):
+                if (result[metric] > before[metric] * (1 + tolerance)
+                        and result[metric] - before[metric] > min_slowdown_ms):
+                    regressions.append(f'{mode} {name} {metric}: {before[metric]} -> {result[metric]}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=['client', 'gunicorn', 'both'], default='client')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads against gunicorn')
+    parser.add_argument('--database-url', default=None)
+    parser.add_argument('--drugs', type=int, default=2000, help='catalogue size when generating data')
+    parser.add_argument('--sales', type=int, default=200000, help='sales when generating data')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, 0.25 = 25%%')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per mode, best kept')
+    parser.add_argument('--min-slowdown-ms', type=float, default=2.0,
+                        help='smaller slowdowns are never regressions')
+    args = parser.parse_args()
+
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+        dataset = args.database_url
+    else:
+        os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(tempfile.mkdtemp(), "load_test.db")}'
+        from generate_data import generate
+        print(f'Generating {args.drugs} drugs and {args.sales} sales...')
+        generate(args.drugs, args.sales, args.sales // 25)
+        dataset = f'generated:{args.drugs}x{args.sales}'
+
+    results = {}
+    if args.mode in ('client', 'both'):
+        results['client'] = best_of(run_client(args.requests, args.warmup) for _ in range(args.repeat))
+    if args.mode in ('gunicorn', 'both'):
+        results['gunicorn'] = best_of(run_gunicorn(args.requests, args.warmup, args.concurrency)
+                                      for _ in range(args.repeat))
+
+    for mode, routes in results.items():
+        print(f'\n{mode}')
+        print(f'{"route":<22}{"p50":>10}{"p99":>10}{"req/s":>10}')
+        for name, result in routes.items():
+            print(f'{name:<22}{result["p50_ms"]:>8.1f}ms{result["p99_ms"]:>8.1f}ms{result["rps"]:>10.1f}')
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'dataset': dataset, 'results': results}, f, indent=2)
+        print(f'\nBaseline saved to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'\nNo baseline at {args.baseline}, not compared (save one with --save-baseline)')
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('dataset') != dataset:
+        print(f'\nBaseline was measured on {baseline.get("dataset")}, not compared')
+        return
+    regressions = compare(results, baseline['results'], args.tolerance, args.min_slowdown_ms)
+    for line in regressions:
+        print('REGRESSION', line)
+    if not regressions:
+        print('\nNo regressions against the baseline')
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Drug search latency: in-memory index vs the old ILIKE '%q%' scan.
+
+Usage: python bench/search_benchmark.py [--drugs 100000] [--repeat 200]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask
+from models import db, Drug
+from search import DrugSearchIndex
+
+STEMS = ['Paracetamol', 'Amoxicillin', 'Ibuprofen', 'Metformin', 'Omeprazole', 'Atorvastatin',
+         'Amlodipine', 'Ciprofloxacin', 'Azithromycin', 'Cetirizine', 'Loratadine', 'Diclofenac',
+         'Losartan', 'Salbutamol', 'Prednisolone', 'Doxycycline', 'Fluconazole', 'Metronidazole',
+         'Vitamin C', 'Folic Acid', 'Ferrous Sulfate', 'Zinc Sulfate', 'Ranitidine', 'Aspirin']
+FORMS = ['Tablet', 'Capsule', 'Syrup', 'Suspension', 'Injection', 'Cream', 'Drops']
+STRENGTHS = ['5mg', '10mg', '20mg', '50mg', '100mg', '250mg', '500mg', '1g']
+QUERIES = ['para', 'amoxicillin 500', 'ibuprofn', 'metfor', 'cillin', 'vitamin c syrup', 'azithromicin', 'zz']
+
+def drug_names(count, rng):
+    for i in range(count):
+        yield (f'{rng.choice(STEMS)} {rng.choice(STRENGTHS)} {rng.choice(FORMS)} '
+               f'{rng.choice("ABCDEFGHJK")}{i}')
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.median(samples), samples[int(len(samples) * 0.99) - 1]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--drugs', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    app = Flask(__name__, instance_path=workdir)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(workdir, "bench.db")}'
+    db.init_app(app)
+    rng = random.Random(42)
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Drug.__table__.insert(), [
+            dict(name=name, category='Bench', batch_no='B', manufacturer='M', quantity=50,
+                 cost_price=1.0, selling_price=2.0, expiry_date=date(2030, 1, 1))
+            for name in drug_names(args.drugs, rng)
+        ])
+        db.session.commit()
+
+        index = DrugSearchIndex()
+        index.init_app(app)
+        start = time.perf_counter()
+        index.rebuild()
+        print(f'{args.drugs} drugs, index built in {time.perf_counter() - start:.2f}s\n')
+        print(f'{"query":<20}{"index p50":>12}{"index p99":>12}{"ILIKE p50":>12}{"ILIKE p99":>12}')
+
+        for query in QUERIES:
+            index_p50, index_p99 = timed(lambda: index.search(query, 10), args.repeat)
+            ilike = Drug.query.filter(Drug.name.ilike(f'%{query}%')).limit(10)
+            ilike_p50, ilike_p99 = timed(lambda: ilike.all(), max(args.repeat // 10, 5))
+            print(f'{query:<20}{index_p50:>10.2f}ms{index_p99:>10.2f}ms{ilike_p50:>10.2f}ms{ilike_p99:>10.2f}ms')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context
+from signals import ChangeSignal
+
+# Branches: each pharmacy location keeps its drugs, batches, sales, purchases,
+# rollups and stock ledger in a database of its own, so one deployment serves
+# every store and one branch's reports never hold the locks, pool connections
+# or SQLite write lock another branch's checkouts wait on. Users, login
+# sessions and the job queue are shared and stay in the main database
+# (DATABASE_URL), which also holds the main branch's own data; a deployment
+# without BRANCH_DATABASES is a single branch, exactly as before.
+#
+# db.session sends each statement to the current branch's engine unless it is
+# on a shared table (models.BranchSession). login_required picks the branch
+# for a request from the user's session; jobs, CLI commands and cross-branch
+# reports choose theirs with use_branch().
+
+DEFAULT_BRANCH = 'main'
+BRANCH_CODE_RE = re.compile(r'[a-z0-9_-]{1,40}')
+FANOUT_WORKERS = 8  # branches queried at once by cross-branch reports
+
+logger = logging.getLogger(__name__)
+
+def parse_branch_databases(value):
+    """{code: url} from BRANCH_DATABASES, e.g. 'north=sqlite:///north.db,south=postgresql://...'"""
+    branches = {}
+    for item in filter(None, (part.strip() for part in (value or '').split(','))):
+        code, _, url = item.partition('=')
+        code, url = code.strip().lower(), url.strip()
+        if not url or not BRANCH_CODE_RE.fullmatch(code) or code == DEFAULT_BRANCH:
+            raise ValueError(f'Invalid BRANCH_DATABASES entry: {item!r}')
+        branches[code] = url
+    return branches
+
+def bind_key(branch):
+    """The Flask-SQLAlchemy bind holding a branch's database (None is the main database)"""
+    return None if branch == DEFAULT_BRANCH else f'branch:{branch}'
+
+def branch_codes():
+    """Every configured branch, the main one first"""
+    return [DEFAULT_BRANCH] + sorted(current_app.config.get('BRANCH_DATABASES', {}))
+
+def is_branch(code):
+    return code == DEFAULT_BRANCH or code in current_app.config.get('BRANCH_DATABASES', {})
+
+def current_branch():
+    """The branch this request, job or command works on"""
+    if has_app_context():
+        return g.get('branch', DEFAULT_BRANCH)
+    return DEFAULT_BRANCH
+
+def select_branch(code):
+    """Make code the current branch for the rest of this app context"""
+    if not is_branch(code):
+        raise ValueError(f'Unknown branch: {code}')
+    g.branch = code
+
+@contextmanager
+def use_branch(code):
+    """Work on another branch inside the block. A session only ever talks to one
+    branch's database, so switch before the session is used, not part way through."""
+    previous = g.get('branch')
+    select_branch(code)
+    try:
+        yield code
+    finally:
+        if previous is None:
+            g.pop('branch', None)
+        else:
+            g.branch = previous
+
+def for_each_branch(fn, branches=None):
+    """Run fn() for every branch at once on a thread pool, each call in its own app
+    context and session. Returns [(branch, result, error)] in branch order; a branch
+    that fails reports its exception instead of failing the others."""
+    app = current_app._get_current_object()
+    codes = list(branches or branch_codes())
+
+    def run(code):
+        with app.app_context(), use_branch(code):
+            try:
+                return code, fn(), None
+            except Exception as e:
+                logger.exception('Branch %s failed', code)
+                return code, None, e
+
+    workers = max(1, min(len(codes), app.config.get('BRANCH_FANOUT_WORKERS', FANOUT_WORKERS)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='branch') as pool:
+        return list(pool.map(run, codes))
+
+class BranchLocal:
+    """One instance of something per branch, made by factory(branch) on first use.
+    Like flask.g, attribute access goes to the current branch's instance."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, branch=None):
+        branch = branch or current_branch()
+        item = self._items.get(branch)
+        if item is None:
+            with self._lock:
+                item = self._items.get(branch)
+                if item is None:
+                    item = self._items[branch] = self._factory(branch)
+        return item
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+def branch_signals(filename):
+    """One ChangeSignal per branch: filename for the main branch, name.<branch>.ext
+    beside it for the others (made inside an app context)"""
+    root, ext = os.path.splitext(filename)
+
+    def make(branch):
+        signal = ChangeSignal(filename if branch == DEFAULT_BRANCH else f'{root}.{branch}{ext}')
+        signal.init_app(current_app)
+        return signal
+
+    return BranchLocal(make)
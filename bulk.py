@@ -0,0 +1,343 @@
+import csv
+import io
+import json
+from datetime import datetime
+from itertools import islice
+from models import db, Drug, DrugBatch, Sale, Purchase, BATCH_IN_STOCK
+from pagination import iter_keyset
+from stock import recount_drug_stock, refresh_drug_summary
+from ledger import record_movements
+
+CHUNK_SIZE = 1000  # rows validated and written per transaction
+MAX_REPORTED_ERRORS = 1000
+
+DRUG_FIELDS = ['name', 'category', 'batch_no', 'manufacturer', 'quantity',
+               'cost_price', 'selling_price', 'expiry_date']
+PURCHASE_FIELDS = ['drug_name', 'batch_no', 'supplier_name', 'quantity', 'cost_price', 'purchase_date',
+                   'expiry_date']
+
+class ImportReport:
+    """Counts and per-row errors for one import run"""
+
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.errors = []
+        self.error_count = 0
+
+    def error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def to_dict(self):
+        return {
+            'rows': self.rows,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'error_count': self.error_count,
+            'errors': self.errors
+        }
+
+def iter_records(stream, fmt='csv'):
+    """Yield (line number, dict) pairs from a binary stream of CSV or JSON Lines"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt in ('jsonl', 'json'):
+        for line_no, line in enumerate(text, 1):
+            if line.strip():
+                try:
+                    yield line_no, json.loads(line)
+                except ValueError as e:
+                    yield line_no, e
+    else:
+        raise ValueError(f'Unsupported format: {fmt}')
+
+def chunks(records, size=CHUNK_SIZE):
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+def parse_date(value):
+    return datetime.strptime(str(value).strip()[:10], '%Y-%m-%d').date()
+
+def parse_datetime(value):
+    value = str(value).strip()
+    if len(value) > 10:
+        return datetime.fromisoformat(value)
+    return datetime.combine(parse_date(value), datetime.min.time())
+
+def required(record, field):
+    value = record.get(field)
+    if value is None or str(value).strip() == '':
+        raise ValueError(f'{field} is required')
+    return str(value).strip()
+
+def parse_drug(record):
+    drug = {
+        'name': required(record, 'name'),
+        'category': required(record, 'category'),
+        'batch_no': str(record.get('batch_no') or '').strip() or 'N/A',
+        'manufacturer': str(record.get('manufacturer') or '').strip() or 'Unknown',
+        'quantity': int(required(record, 'quantity')),
+        'cost_price': float(required(record, 'cost_price')),
+        'selling_price': float(required(record, 'selling_price')),
+        'expiry_date': parse_date(required(record, 'expiry_date'))
+    }
+    if drug['quantity'] < 0:
+        raise ValueError('quantity cannot be negative')
+    return drug
+
+def parse_purchase(record):
+    purchase = {
+        'drug_name': required(record, 'drug_name'),
+        'batch_no': required(record, 'batch_no'),
+        'supplier_name': required(record, 'supplier_name'),
+        'quantity': int(required(record, 'quantity')),
+        'cost_price': float(required(record, 'cost_price')),
+        'purchase_date': parse_datetime(record['purchase_date']) if record.get('purchase_date') else datetime.now(),
+        'expiry_date': parse_date(record['expiry_date']) if record.get('expiry_date') else None
+    }
+    if purchase['quantity'] < 1:
+        raise ValueError('quantity must be at least 1')
+    return purchase
+
+def validate(chunk, parse, report):
+    """Parse a chunk of records, recording errors, and return the valid rows"""
+    rows = []
+    for line, record in chunk:
+        report.rows += 1
+        if isinstance(record, Exception):
+            report.error(line, f'Invalid JSON: {record}')
+            continue
+        try:
+            rows.append((line, parse(record)))
+        except (KeyError, TypeError, ValueError) as e:
+            report.error(line, str(e))
+    return rows
+
+def existing_batches(keys):
+    """Map (drug name, batch_no) -> (drug id, batch id) for the keys that already exist, in one query"""
+    if not keys:
+        return {}
+    rows = db.session.query(Drug.name, DrugBatch.batch_no, Drug.id, DrugBatch.id) \
+        .join(Drug, Drug.id == DrugBatch.drug_id) \
+        .filter(db.tuple_(Drug.name, DrugBatch.batch_no).in_(list(keys))).all()
+    return {(name, batch_no): (drug_id, batch_id) for name, batch_no, drug_id, batch_id in rows}
+
+def existing_drugs(names):
+    """Map drug name -> (id, expiry_date) for the names that already exist, in one query
+    (the oldest drug wins if a name is used more than once)"""
+    if not names:
+        return {}
+    rows = db.session.query(Drug.name, Drug.id, Drug.expiry_date) \
+        .filter(Drug.name.in_(list(names))).order_by(Drug.id.desc()).all()
+    return {name: (drug_id, expiry_date) for name, drug_id, expiry_date in rows}
+
+def import_drugs(records, report=None):
+    """Upsert drug batches by (name, batch_no), one transaction per chunk (call inside an app context).
+
+    A row for a known batch replaces its quantity, cost and expiry; a new batch
+    number for a known drug name adds a batch to that drug; an unknown name
+    creates the drug. Drug quantities are then recounted from their batches.
+    """
+    report = report or ImportReport()
+    for chunk in chunks(records):
+        rows = validate(chunk, parse_drug, report)
+        # Later rows for the same key win, as if they had been applied in order
+        latest = {(row['name'], row['batch_no']): row for _, row in rows}
+        if not latest:
+            continue
+        batches = existing_batches(latest.keys())
+        drugs = existing_drugs({name for name, batch_no in latest if (name, batch_no) not in batches})
+        now = datetime.utcnow()
+
+        try:
+            new_drugs = {row['name']: row for key, row in latest.items()
+                         if key not in batches and row['name'] not in drugs}
+            if new_drugs:
+                created = db.session.execute(
+                    db.insert(Drug).returning(Drug.id, sort_by_parameter_order=True),
+                    [dict(row, quantity=0, created_at=now, updated_at=now) for row in new_drugs.values()])
+                drugs.update((name, (drug_id, None)) for name, drug_id in zip(new_drugs, created.scalars()))
+
+            drug_ids = {}
+            batch_updates, batch_inserts = [], []
+            for key, row in latest.items():
+                batch = {'quantity': row['quantity'], 'cost_price': row['cost_price'],
+                         'expiry_date': row['expiry_date']}
+                if key in batches:
+                    drug_id, batch_id = batches[key]
+                    batch_updates.append(dict(batch, batch_id=batch_id))
+                else:
+                    drug_id = drugs[row['name']][0]
+                    batch_inserts.append(dict(batch, drug_id=drug_id, batch_no=row['batch_no'], received_at=now))
+                drug_ids[drug_id] = row
+
+            db.session.execute(
+                db.update(Drug.__table__).where(Drug.__table__.c.id == db.bindparam('drug_id')),
+                [{'drug_id': drug_id, 'category': row['category'], 'manufacturer': row['manufacturer'],
+                  'selling_price': row['selling_price'], 'updated_at': now}
+                 for drug_id, row in drug_ids.items()])
+            if batch_updates:
+                table = DrugBatch.__table__
+                db.session.execute(db.update(table).where(table.c.id == db.bindparam('batch_id')), batch_updates)
+            if batch_inserts:
+                db.session.execute(db.insert(DrugBatch), batch_inserts)
+            recount_drug_stock(drug_ids, 'import')
+            refresh_drug_summary(drug_ids)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for line, _ in rows:
+                report.error(line, f'Chunk rejected: {e}')
+            continue
+        report.inserted += len(batch_inserts)
+        report.updated += len(batch_updates)
+    return report
+
+def import_purchases(records, report=None):
+    """Record purchases and book their quantity into the named batch of the named drug,
+    creating the batch if it is new, one transaction per chunk (call inside an app context).
+    A new batch without an expiry_date takes the drug's current expiry date."""
+    report = report or ImportReport()
+    for chunk in chunks(records):
+        rows = validate(chunk, parse_purchase, report)
+        keys = {(row['drug_name'], row['batch_no']) for _, row in rows}
+        batches = existing_batches(keys)
+        drugs = existing_drugs({name for name, batch_no in keys if (name, batch_no) not in batches})
+
+        purchases, restock, received, new_batches = [], {}, {}, {}
+        for line, row in rows:
+            key = (row['drug_name'], row['batch_no'])
+            if key in batches:
+                drug_id, batch_id = batches[key]
+                added, _, _ = received.get(batch_id, (0, None, None))
+                received[batch_id] = (added + row['quantity'], row['cost_price'], row['expiry_date'])
+            elif row['drug_name'] in drugs:
+                drug_id, drug_expiry = drugs[row['drug_name']]
+                batch = new_batches.setdefault(key, {
+                    'drug_id': drug_id, 'batch_no': row['batch_no'], 'quantity': 0,
+                    'expiry_date': drug_expiry, 'received_at': datetime.utcnow()})
+                batch['quantity'] += row['quantity']
+                batch['cost_price'] = row['cost_price']
+                batch['expiry_date'] = row['expiry_date'] or batch['expiry_date']
+            else:
+                report.error(line, f"No drug named {row['drug_name']!r}")
+                continue
+            purchases.append({
+                'drug_id': drug_id,
+                'quantity': row['quantity'],
+                'cost_price': row['cost_price'],
+                'total_cost': row['quantity'] * row['cost_price'],
+                'supplier_name': row['supplier_name'],
+                'batch_no': row['batch_no'],
+                'purchase_date': row['purchase_date']
+            })
+            restock[drug_id] = restock.get(drug_id, 0) + row['quantity']
+
+        if not purchases:
+            continue
+        drug_table, batch_table = Drug.__table__, DrugBatch.__table__
+        try:
+            db.session.execute(db.insert(Purchase), purchases)
+            if received:
+                db.session.execute(
+                    db.update(batch_table).where(batch_table.c.id == db.bindparam('batch_id')).values(
+                        quantity=batch_table.c.quantity + db.bindparam('added'),
+                        cost_price=db.bindparam('new_cost'),
+                        expiry_date=db.func.coalesce(db.bindparam('new_expiry', type_=db.Date),
+                                                     batch_table.c.expiry_date)),
+                    [{'batch_id': batch_id, 'added': added, 'new_cost': cost, 'new_expiry': expiry}
+                     for batch_id, (added, cost, expiry) in received.items()])
+            if new_batches:
+                db.session.execute(db.insert(DrugBatch), list(new_batches.values()))
+            db.session.execute(
+                db.update(drug_table).where(drug_table.c.id == db.bindparam('drug_id')).values(
+                    quantity=drug_table.c.quantity + db.bindparam('added'),
+                    updated_at=datetime.utcnow()),
+                [{'drug_id': drug_id, 'added': added} for drug_id, added in restock.items()])
+            record_movements(restock, 'purchase')
+            refresh_drug_summary(restock)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            for line, _ in rows:
+                report.error(line, f'Chunk rejected: {e}')
+            continue
+        report.inserted += len(purchases)
+    return report
+
+def stock_rows():
+    """Stream the stock report, one row per in-stock batch in the drug import layout,
+    ordered by name then expiry (call inside an app context)"""
+    columns = {'batch_no': DrugBatch.batch_no, 'quantity': DrugBatch.quantity,
+               'cost_price': DrugBatch.cost_price, 'expiry_date': DrugBatch.expiry_date}
+    query = db.session.query(*[columns.get(field, getattr(Drug, field)) for field in DRUG_FIELDS]) \
+        .join(Drug, Drug.id == DrugBatch.drug_id) \
+        .filter(BATCH_IN_STOCK) \
+        .order_by(Drug.name, Drug.id, DrugBatch.expiry_date, DrugBatch.id) \
+        .execution_options(yield_per=CHUNK_SIZE)
+    for row in query:
+        yield dict(zip(DRUG_FIELDS, row), expiry_date=row.expiry_date.isoformat())
+
+def sales_history():
+    """Header and streamed rows of every sale, newest first"""
+    query = db.session.query(
+        Sale.id, Sale.sale_date, Drug.name, Sale.quantity,
+        Sale.unit_price, Sale.total_price, Sale.staff_name
+    ).join(Drug, Sale.drug_id == Drug.id)
+    header = ['Date', 'Drug', 'Quantity', 'Unit Price', 'Total Price', 'Staff']
+    rows = ([row.sale_date.strftime('%Y-%m-%d %H:%M:%S'), row.name, row.quantity,
+             f'{row.unit_price:.2f}', f'{row.total_price:.2f}', row.staff_name]
+            for row in iter_keyset(query, Sale.sale_date, Sale.id))
+    return header, rows
+
+def purchase_history():
+    """Header and streamed rows of every purchase, newest first"""
+    query = db.session.query(
+        Purchase.id, Purchase.purchase_date, Drug.name, Purchase.supplier_name,
+        Purchase.batch_no, Purchase.quantity, Purchase.cost_price, Purchase.total_cost
+    ).join(Drug, Purchase.drug_id == Drug.id)
+    header = ['Date', 'Drug', 'Supplier', 'Batch No', 'Quantity', 'Cost Price', 'Total Cost']
+    rows = ([row.purchase_date.strftime('%Y-%m-%d %H:%M:%S'), row.name, row.supplier_name,
+             row.batch_no, row.quantity, f'{row.cost_price:.2f}', f'{row.total_cost:.2f}']
+            for row in iter_keyset(query, Purchase.purchase_date, Purchase.id))
+    return header, rows
+
+def csv_chunks(header, rows):
+    """Yield CSV text a few hundred rows at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def write_records(records, fields, fmt='csv'):
+    """Yield text chunks of CSV or JSON Lines for an iterable of dicts"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields) if fmt == 'csv' else None
+    if writer:
+        writer.writeheader()
+    for count, record in enumerate(records, 1):
+        if writer:
+            writer.writerow(record)
+        else:
+            buffer.write(json.dumps(record) + '\n')
+        if count % 500 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,89 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import Response, request, session
+from alerts import catalogue_version
+
+# Per-worker cache of the category list, drug table fragments and report
+# pages. Every drug, sale or purchase write goes through invalidate_alerts(),
+# which moves catalogue_version() on in every worker, so entries are never
+# served stale and need no explicit invalidation.
+
+MAX_ENTRIES = 512
+MAX_BYTES = 32 * 1024 * 1024  # rendered HTML held per worker
+
+class VersionedCache:
+    """LRU cache bounded by entry count and total size. Keys include the catalogue
+    version, so a write makes every older entry unreachable; those age out of
+    the LRU instead of being deleted one by one."""
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, size=1):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def get_or_build(self, key, build, sizeof=len):
+        """The cached value for key at the current catalogue version, building it on a miss"""
+        key = (catalogue_version(),) + tuple(key)
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.set(key, value, sizeof(value))
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+page_cache = VersionedCache()
+
+def cached_page(key, render):
+    """Serve a whole rendered page for the current user from page_cache.
+
+    The ETag is derived from the cache key and catalogue version alone, so a
+    conditional GET for an unchanged page is answered 304 without touching
+    the database or rendering. Pages with pending flash messages bypass the
+    cache: those messages belong to this one response.
+    """
+    version = catalogue_version()
+    key = (version, request.full_path, session.get('username'), session.get('role')) + tuple(key)
+    etag = hashlib.sha1(repr(key).encode()).hexdigest()
+    cacheable = '_flashes' not in session
+
+    if cacheable and request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        html = page_cache.get(key) if cacheable else None
+        if html is None:
+            html = render(etag)
+            if cacheable:
+                page_cache.set(key, html, len(html))
+        response = Response(html, mimetype='text/html')
+    if cacheable:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
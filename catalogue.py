@@ -0,0 +1,129 @@
+import threading
+from array import array
+from bisect import bisect_left
+from models import db, Drug
+from alerts import catalogue_version
+from branches import BranchLocal
+from search import drug_search
+
+# Per-worker snapshot of the columns the drug pickers and autocomplete need.
+# Columns are kept in typed arrays and the names in one string, so 100k drugs
+# take a few MB rather than the tens of MB of ORM objects, and nothing is
+# loaded per request. The snapshot is refreshed with one query the first time
+# it is read after catalogue_version() moves on, i.e. after a drug, sale or
+# purchase write in any worker. Each branch has its own snapshot.
+
+LOAD_BATCH = 5000  # rows fetched at a time while refreshing
+
+class Snapshot:
+    """Immutable column arrays over the catalogue, ordered by id"""
+    __slots__ = ('version', 'names_version', 'ids', 'quantities', 'prices', 'names', 'offsets', 'by_name')
+
+    def __init__(self, version, names_version, ids, quantities, prices, names, offsets, by_name):
+        self.version = version
+        self.names_version = names_version
+        self.ids = ids
+        self.quantities = quantities
+        self.prices = prices
+        self.names = names  # every name in id order, joined
+        self.offsets = offsets  # name i is names[offsets[i]:offsets[i + 1]]
+        self.by_name = by_name  # positions in picker order
+
+    @classmethod
+    def build(cls, version, names_version, rows):
+        ids, quantities, prices, offsets = array('q'), array('q'), array('d'), array('q', [0])
+        names = []
+        for drug_id, name, quantity, price in rows:
+            ids.append(drug_id)
+            quantities.append(quantity)
+            prices.append(price)
+            names.append(name)
+            offsets.append(offsets[-1] + len(name))
+        by_name = array('q', sorted(range(len(names)), key=lambda i: (names[i], ids[i])))
+        return cls(version, names_version, ids, quantities, prices, ''.join(names), offsets, by_name)
+
+    def with_stock(self, version, rows):
+        """A copy with fresh quantities and prices, sharing the names, or None if
+        drugs were added or removed since this snapshot was built"""
+        ids, quantities, prices = array('q'), array('q'), array('d')
+        for drug_id, quantity, price in rows:
+            ids.append(drug_id)
+            quantities.append(quantity)
+            prices.append(price)
+        if ids != self.ids:
+            return None
+        return Snapshot(version, self.names_version, self.ids, quantities, prices,
+                        self.names, self.offsets, self.by_name)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def name(self, position):
+        return self.names[self.offsets[position]:self.offsets[position + 1]]
+
+    def row(self, position):
+        return PickerDrug(self.ids[position], self.name(position), self.quantities[position], self.prices[position])
+
+    def get(self, drug_id):
+        """The drug's picker row, or None"""
+        position = bisect_left(self.ids, drug_id)
+        if position < len(self.ids) and self.ids[position] == drug_id:
+            return self.row(position)
+        return None
+
+    def rows(self, in_stock=False):
+        """Picker rows ordered by name, optionally only drugs with stock"""
+        for position in self.by_name:
+            if not in_stock or self.quantities[position] > 0:
+                yield self.row(position)
+
+class PickerDrug(tuple):
+    """(id, name, quantity, selling_price) with attribute access for templates"""
+    __slots__ = ()
+
+    def __new__(cls, drug_id, name, quantity, selling_price):
+        return tuple.__new__(cls, (drug_id, name, quantity, selling_price))
+
+    id = property(lambda self: self[0])
+    name = property(lambda self: self[1])
+    quantity = property(lambda self: self[2])
+    selling_price = property(lambda self: self[3])
+
+    def to_dict(self):
+        return {'id': self.id, 'name': self.name, 'quantity': self.quantity, 'selling_price': self.selling_price}
+
+_states = BranchLocal(lambda branch: {'lock': threading.Lock(), 'snapshot': None})
+
+def load(*columns):
+    return db.session.query(*columns).order_by(Drug.id).execution_options(yield_per=LOAD_BATCH)
+
+def catalogue_snapshot():
+    """The current branch's snapshot, refreshed if its catalogue changed (call inside an app context).
+    Sales and purchases only move stock, so unless drugs were added, renamed or removed
+    (drug_search's signal) only quantities and prices are reloaded.
+
+    Both versions are checked on every read: a rename moves catalogue_version() a
+    moment before the names signal, and a refresh in between holds the old names."""
+    version = catalogue_version()
+    names_version = drug_search.signal.stamp()
+    state = _states.get()
+
+    def current(snapshot):
+        return snapshot is not None and snapshot.version == version and snapshot.names_version == names_version
+
+    if current(state['snapshot']):
+        return state['snapshot']
+    with state['lock']:
+        # Another thread may have refreshed it while we waited
+        snapshot = state['snapshot']
+        if current(snapshot):
+            return snapshot
+        if snapshot is not None and snapshot.names_version == names_version:
+            snapshot = snapshot.with_stock(version, load(Drug.id, Drug.quantity, Drug.selling_price))
+        else:
+            snapshot = None
+        if snapshot is None:
+            snapshot = Snapshot.build(version, names_version,
+                                      load(Drug.id, Drug.name, Drug.quantity, Drug.selling_price))
+        state['snapshot'] = snapshot
+    return snapshot
@@ -0,0 +1,91 @@
+import os
+from sqlalchemy import event
+from models import db
+from branches import bind_key, current_branch, parse_branch_databases
+
+# Engine settings, all overridable from the environment:
+#   DATABASE_URL              sqlite:///pharmacy.db (in the instance folder) or postgresql://...
+#   BRANCH_DATABASES          further branches as code=url pairs, comma separated (see branches.py)
+#   DB_POOL_SIZE              connections kept open per process (PostgreSQL)
+#   DB_MAX_OVERFLOW           extra connections allowed under bursts (PostgreSQL)
+#   DB_POOL_TIMEOUT           seconds to wait for a free connection before failing
+#   DB_POOL_RECYCLE           seconds before a connection is replaced (PostgreSQL)
+#   DB_STATEMENT_TIMEOUT_MS   longest a single statement may run (PostgreSQL)
+#   DB_LOCK_TIMEOUT_MS        longest a statement may wait for a row lock (PostgreSQL)
+#   SQLITE_BUSY_TIMEOUT_MS    how long a writer waits for the write lock (SQLite)
+#   SQLITE_MMAP_SIZE          bytes of the database file memory-mapped for reads (SQLite)
+DEFAULT_DATABASE_URL = 'sqlite:///pharmacy.db'
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def normalize_url(url):
+    # Hosted PostgreSQL often hands out postgres://, which SQLAlchemy no longer accepts
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def database_url():
+    return normalize_url(os.environ.get('DATABASE_URL', DEFAULT_DATABASE_URL))
+
+def engine_options(url):
+    """SQLALCHEMY_ENGINE_OPTIONS for the database at url"""
+    if url in ('sqlite://', 'sqlite:///:memory:'):
+        return {}
+    if url.startswith('sqlite'):
+        return {
+            'pool_size': env_int('DB_POOL_SIZE', 10),
+            'max_overflow': env_int('DB_MAX_OVERFLOW', 10),
+            'pool_timeout': env_int('DB_POOL_TIMEOUT', 10),
+            # The sqlite3 driver's own lock wait; busy_timeout below replaces it per connection
+            'connect_args': {'timeout': env_int('SQLITE_BUSY_TIMEOUT_MS', 5000) / 1000},
+        }
+    if url.startswith('postgresql'):
+        timeouts = (f"-c statement_timeout={env_int('DB_STATEMENT_TIMEOUT_MS', 30000)} "
+                    f"-c lock_timeout={env_int('DB_LOCK_TIMEOUT_MS', 5000)}")
+        return {
+            # Sized for the gthread workers in gunicorn.conf.py: one connection per
+            # thread, with overflow for streaming exports and bursts
+            'pool_size': env_int('DB_POOL_SIZE', 10),
+            'max_overflow': env_int('DB_MAX_OVERFLOW', 10),
+            'pool_timeout': env_int('DB_POOL_TIMEOUT', 10),
+            'pool_recycle': env_int('DB_POOL_RECYCLE', 1800),
+            'pool_pre_ping': True,
+            'connect_args': {'connect_timeout': 5, 'options': timeouts},
+        }
+    return {'pool_pre_ping': True}
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL lets readers run alongside the single writer, and NORMAL sync is durable in
+    WAL mode except for the last commits on power loss. busy_timeout makes a writer
+    wait for the lock instead of failing at once with 'database is locked'."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={env_int('SQLITE_BUSY_TIMEOUT_MS', 5000)}")
+    cursor.execute(f"PRAGMA mmap_size={env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)}")
+    cursor.close()
+
+def configure_database(app):
+    """Point the app at DATABASE_URL, and each branch at its own database, with tuned
+    engine options (call before db.init_app)"""
+    url = database_url()
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(url)
+    branches = {code: normalize_url(branch_url)
+                for code, branch_url in parse_branch_databases(os.environ.get('BRANCH_DATABASES')).items()}
+    app.config['BRANCH_DATABASES'] = branches
+    # Every bind gets its own pool, so a busy branch cannot starve the others of connections
+    app.config['SQLALCHEMY_BINDS'] = {bind_key(code): {'url': branch_url, **engine_options(branch_url)}
+                                      for code, branch_url in branches.items()}
+
+def init_database(app):
+    """Register per-connection setup on every engine (call after db.init_app)"""
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', set_sqlite_pragmas)
+
+def branch_engine(branch=None):
+    """The engine holding a branch's data, the current branch's by default"""
+    return db.engines[bind_key(branch or current_branch())]
@@ -0,0 +1,36 @@
+# Gunicorn profile, loaded automatically when gunicorn runs from this directory.
+#
+# gthread workers: each worker process serves THREADS requests at once. An
+# open alert stream (/api/alerts/stream) holds one of those threads for up to
+# ALERT_STREAM_TIMEOUT, so at most ALERT_STREAM_LIMIT (THREADS / 2 by default)
+# are open per worker and the rest of the threads stay free for requests;
+# browsers past the limit poll /api/alerts instead.
+#
+# PostgreSQL: scale WEB_CONCURRENCY with the cores available (about 2 per core).
+# Each worker keeps up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections, so keep
+# WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW) under max_connections.
+#
+# SQLite: the file has a single writer however many processes there are, so
+# more workers only add lock waits. Keep WEB_CONCURRENCY at 2 and raise
+# THREADS instead; WAL mode (dbconfig.py) lets reads proceed during writes.
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', '8000')}")
+worker_class = 'gthread'
+threads = int(os.environ.get('THREADS', 16))
+
+if os.environ.get('DATABASE_URL', '').startswith(('postgres://', 'postgresql')):
+    workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2))
+else:
+    workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# gthread workers heartbeat from their main loop, so a long-lived alert stream
+# does not count against the worker timeout
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so slow leaks cannot build up
+max_requests = 5000
+max_requests_jitter = 500
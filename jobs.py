@@ -0,0 +1,348 @@
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import date, datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from models import db, Job, AlertSnapshot
+from alerts import count_alerts, invalidate_alerts
+from analytics import reorder_forecast, forecast_rows
+from bulk import sales_history, purchase_history, stock_rows, csv_chunks, write_records, DRUG_FIELDS
+from reporting import resolve_period, rebuild_rollup, sales_summary, sales_by_drug, sales_by_staff, sales_by_day
+from ledger import take_snapshot
+from branches import branch_codes, current_branch, use_branch
+from dbconfig import branch_engine
+
+# Background jobs: slow reports, exports and rollup rebuilds are queued in the
+# job table instead of running inside a request, and worker threads claim and
+# run them. The table is the queue, so any process can run any job and a job
+# queued by one gunicorn worker may be run by another. The Procfile's worker
+# process (`flask run-jobs`) runs them and the nightly schedule, keeping all of
+# that work out of the web processes; JOB_WORKERS > 0 also starts that many job
+# threads in each web process instead, for single-process deployments. While a
+# job runs its process refreshes the job's heartbeat, and a job whose heartbeat
+# stops for STALE_AFTER lost its worker and is queued again.
+# Files a job produces are kept in instance/jobs for JOB_RESULT_DAYS. The queue
+# is shared by every branch; each job runs against the branch it was queued in.
+
+POLL_SECONDS = 2  # idle workers look for jobs queued by other processes this often
+SCHEDULE_SECONDS = 60
+HEARTBEAT_SECONDS = 30  # running jobs' heartbeats are refreshed this often
+STALE_AFTER = timedelta(minutes=3)  # a running job with a heartbeat this old is queued again
+JOB_RESULT_DAYS = 7
+SWEEP_HOUR = 2  # local hour after which the nightly expiry sweep runs
+
+JOB_KINDS = {}  # kind -> (handler, role needed to queue it, label)
+logger = logging.getLogger('pharmacy.jobs')
+
+def job(kind, label, role=None):
+    """Register handler(params, path) for kind. It may write a file to path and
+    returns that file's download name, or None when it produces no file."""
+    def decorator(f):
+        JOB_KINDS[kind] = (f, role, label)
+        return f
+    return decorator
+
+def write_file(path, chunks):
+    with open(path + '.tmp', 'w', newline='') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(path + '.tmp', path)
+
+@job('sales_report', 'Sales report')
+def sales_report_job(params, path):
+    start, end = resolve_period(params.get('period', 'monthly'), params.get('start'), params.get('end'))
+    summary = sales_summary(start, end)
+    rows = [['summary', 'all', summary['total_items'], f"{summary['total_sales']:.2f}", summary['transactions']]]
+    for row in sales_by_day(start, end):
+        rows.append(['day', row['day'].isoformat(), row['quantity'], f"{row['revenue']:.2f}", row['transactions']])
+    for row in sales_by_drug(start, end, limit=None):
+        rows.append(['drug', row['name'], row['quantity'], f"{row['revenue']:.2f}", row['transactions']])
+    for row in sales_by_staff(start, end):
+        rows.append(['staff', row['staff_name'], row['quantity'], f"{row['revenue']:.2f}", row['transactions']])
+    write_file(path, csv_chunks(['Section', 'Name', 'Quantity', 'Revenue', 'Transactions'], rows))
+    last_day = (end - timedelta(days=1)).date()
+    return f'sales_report_{start.date()}_{last_day}.csv'
+
+@job('forecast_report', 'Reorder forecast')
+def forecast_report_job(params, path):
+    result = reorder_forecast()
+    rows = forecast_rows(result, reorder_only=params.get('reorder_only', False))
+    fields = list(rows[0]) if rows else ['drug_id', 'name', 'quantity']
+    write_file(path, write_records(rows, fields))
+    return f"reorder_forecast_{result['today']}.csv"
+
+@job('export_sales', 'Sales history export')
+def export_sales_job(params, path):
+    write_file(path, csv_chunks(*sales_history()))
+    return 'sales_history.csv'
+
+@job('export_purchases', 'Purchase history export', role='admin')
+def export_purchases_job(params, path):
+    write_file(path, csv_chunks(*purchase_history()))
+    return 'purchase_history.csv'
+
+@job('export_stock', 'Stock export')
+def export_stock_job(params, path):
+    write_file(path, write_records(stock_rows(), DRUG_FIELDS))
+    return 'stock_report.csv'
+
+@job('rollup', 'Sales rollup rebuild', role='admin')
+def rollup_job(params, path):
+    first_day = params.get('start') and date.fromisoformat(params['start'])
+    last_day = params.get('end') and date.fromisoformat(params['end'])
+    with branch_engine().begin() as conn:
+        rebuild_rollup(conn, first_day, last_day)
+    invalidate_alerts()  # cached sales reports were built from the old rollup
+
+@job('expiry_sweep', 'Expiry and low stock sweep', role='admin')
+def expiry_sweep_job(params, path):
+    """Snapshot the alert counters for the day and clear out old job results"""
+    day = date.fromisoformat(params['day']) if params.get('day') else datetime.now().date()
+    db.session.merge(AlertSnapshot(day=day, taken_at=datetime.utcnow(), **count_alerts(day)))
+    db.session.commit()
+    delete_old_jobs(datetime.utcnow() - timedelta(days=JOB_RESULT_DAYS))
+
+@job('stock_snapshot', 'Stock ledger snapshot', role='admin')
+def stock_snapshot_job(params, path):
+    with branch_engine().begin() as conn:
+        take_snapshot(conn)
+
+def check_params(kind, params):
+    """Raise ValueError for parameters the job would fail on, before it is queued"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f'Unknown job kind: {kind}')
+    if kind == 'sales_report':
+        resolve_period(params.get('period', 'monthly'), params.get('start'), params.get('end'))
+    else:
+        for name in ('start', 'end', 'day'):
+            if params.get(name):
+                date.fromisoformat(params[name])
+
+def enqueue(kind, params=None, requested_by=None, key=None, branch=None):
+    """Queue a job for branch (the current one by default) and return it. A key makes
+    the job unique: queueing the same key again returns the existing job."""
+    params = params or {}
+    check_params(kind, params)
+    job_row = Job(kind=kind, params=json.dumps(params, sort_keys=True), requested_by=requested_by, key=key,
+                  branch=branch or current_branch())
+    db.session.add(job_row)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return Job.query.filter_by(key=key).one()
+    runner.notify()
+    return job_row
+
+def claim_job(worker):
+    """Mark the oldest queued job as running in worker and return it, or None.
+    The conditional update means two workers never claim the same job."""
+    while True:
+        job_id = db.session.query(Job.id).filter(Job.status == 'queued').order_by(Job.id).limit(1).scalar()
+        if job_id is None:
+            db.session.rollback()
+            return None
+        claimed = Job.query.filter(Job.id == job_id, Job.status == 'queued').update(
+            {'status': 'running', 'worker': worker, 'started_at': datetime.utcnow(),
+             'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return db.session.get(Job, job_id)
+
+def run_job(job_row):
+    job_id = job_row.id
+    handler = JOB_KINDS.get(job_row.kind, (None,))[0]
+    try:
+        if handler is None:
+            raise ValueError(f'Unknown job kind: {job_row.kind}')
+        with use_branch(job_row.branch):
+            result_name = handler(json.loads(job_row.params), runner.result_path(job_id))
+        status, error = 'done', None
+    except Exception as e:
+        db.session.rollback()
+        logger.exception('Job %s (%s) failed', job_id, job_row.kind)
+        result_name, status, error = None, 'failed', str(e)[:1000]
+    db.session.expunge_all()  # the next job this session runs may be for another branch
+    Job.query.filter_by(id=job_id).update(
+        {'status': status, 'error': error, 'result_name': result_name, 'finished_at': datetime.utcnow()},
+        synchronize_session=False)
+    db.session.commit()
+
+def requeue_stale(now=None):
+    """Queue again the jobs whose worker died mid-run, i.e. stopped beating"""
+    cutoff = (now or datetime.utcnow()) - STALE_AFTER
+    count = Job.query.filter(Job.status == 'running',
+                             db.func.coalesce(Job.heartbeat_at, Job.started_at) < cutoff).update(
+        {'status': 'queued', 'worker': None, 'started_at': None, 'heartbeat_at': None},
+        synchronize_session=False)
+    db.session.commit()
+    return count
+
+def delete_old_jobs(cutoff):
+    """Drop finished jobs older than cutoff and their result files"""
+    old = db.session.query(Job.id).filter(Job.status.in_(['done', 'failed']), Job.finished_at < cutoff).all()
+    for (job_id,) in old:
+        try:
+            os.remove(runner.result_path(job_id))
+        except OSError:
+            pass
+    Job.query.filter(Job.id.in_([job_id for (job_id,) in old])).delete(synchronize_session=False)
+    db.session.commit()
+
+def schedule_jobs(now=None):
+    """Queue each branch's nightly sweep and stock snapshot once per day, whichever
+    process gets there first"""
+    now = now or datetime.now()
+    requeue_stale()
+    if now.hour >= runner.sweep_hour:
+        day = now.date().isoformat()
+        for branch in branch_codes():
+            enqueue('expiry_sweep', {'day': day}, key=f'expiry_sweep:{branch}:{day}', branch=branch)
+            enqueue('stock_snapshot', key=f'stock_snapshot:{branch}:{day}', branch=branch)
+
+def visible_jobs(query, username, role):
+    """The current branch's jobs: admins see all of them, others only the ones they queued"""
+    query = query.filter(Job.branch == current_branch())
+    return query if role == 'admin' else query.filter(Job.requested_by == username)
+
+def job_to_dict(job_row):
+    return {
+        'id': job_row.id,
+        'kind': job_row.kind,
+        'branch': job_row.branch,
+        'label': JOB_KINDS.get(job_row.kind, (None, None, job_row.kind))[2],
+        'status': job_row.status,
+        'error': job_row.error,
+        'result_name': job_row.result_name,
+        'requested_by': job_row.requested_by,
+        'created_at': job_row.created_at.isoformat(),
+        'finished_at': job_row.finished_at.isoformat() if job_row.finished_at else None
+    }
+
+class JobRunner:
+    """Worker threads that claim and run queued jobs, plus the scheduler thread"""
+
+    def __init__(self):
+        self.app = None
+        self.directory = None
+        self.sweep_hour = SWEEP_HOUR
+        self.worker_id = None
+        self._wake = threading.Condition()
+        self._lock = threading.Lock()
+        self._started = False
+        self._running = set()  # ids of the jobs this process is running
+        self._beating = False
+
+    def init_app(self, app):
+        app.config.setdefault('JOB_WORKERS', 0)
+        app.config.setdefault('JOB_SWEEP_HOUR', SWEEP_HOUR)
+        self.app = app
+        self.sweep_hour = app.config['JOB_SWEEP_HOUR']
+        self.directory = os.path.join(app.instance_path, 'jobs')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def result_path(self, job_id):
+        return os.path.join(self.directory, str(job_id))
+
+    def start(self, threads):
+        """Start the threads once per process (after gunicorn has forked it)"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        if threads < 1:
+            return  # a separate `flask run-jobs` process does the work
+        self.worker_id = worker_name()
+        for number in range(threads):
+            threading.Thread(target=self.work, name=f'job-worker-{number}', daemon=True).start()
+        threading.Thread(target=self.schedule, name='job-scheduler', daemon=True).start()
+        atexit.register(self.release)
+
+    def run_pending(self):
+        """Run queued jobs in this thread until none are left (call inside an app context)"""
+        worker = worker_name()
+        count = 0
+        while (job_row := claim_job(worker)) is not None:
+            self.run(job_row)
+            count += 1
+        return count
+
+    def run(self, job_row):
+        """run_job() with the job's heartbeat kept up meanwhile"""
+        job_id = job_row.id  # run_job() detaches job_row
+        with self._lock:
+            self._running.add(job_id)
+            if not self._beating:
+                self._beating = True
+                threading.Thread(target=self.heartbeat, name='job-heartbeat', daemon=True).start()
+        try:
+            run_job(job_row)
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+
+    def heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_SECONDS)
+            with self._lock:
+                running = list(self._running)
+            if not running:
+                continue
+            try:
+                with self.app.app_context():
+                    Job.query.filter(Job.id.in_(running), Job.status == 'running').update(
+                        {'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+                    db.session.commit()
+            except Exception:
+                logger.exception('Job heartbeat error')
+
+    def notify(self):
+        with self._wake:
+            self._wake.notify()
+
+    def work(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    job_row = claim_job(self.worker_id)
+                    if job_row is not None:
+                        self.run(job_row)
+                        continue
+            except Exception:
+                logger.exception('Job worker error')
+            with self._wake:
+                self._wake.wait(POLL_SECONDS)
+
+    def schedule(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    schedule_jobs()
+            except Exception:
+                logger.exception('Job scheduler error')
+            time.sleep(SCHEDULE_SECONDS)
+
+    def release(self):
+        """On exit, queue again the jobs this process was still running"""
+        with self.app.app_context():
+            Job.query.filter_by(worker=self.worker_id, status='running').update(
+                {'status': 'queued', 'worker': None, 'started_at': None, 'heartbeat_at': None},
+                synchronize_session=False)
+            db.session.commit()
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+runner = JobRunner()
+
+def init_jobs(app):
+    runner.init_app(app)
+
+    @app.before_request
+    def start_job_workers():
+        if not runner._started:
+            runner.start(app.config['JOB_WORKERS'])
@@ -0,0 +1,121 @@
+from datetime import datetime
+from sqlalchemy import text
+from models import db, Drug, DrugBatch, StockMovement, StockSnapshot, StockSnapshotLine
+
+# Stock ledger: every change to Drug.quantity appends a StockMovement in the
+# same transaction, so the movements of a drug always add up to its stock.
+# Snapshots record every drug's balance up to a movement id; stock at any
+# moment is the nearest snapshot, before or after it, plus the movements in
+# between, so no question ever replays more than the gap between snapshots.
+
+MOVEMENT_COLUMNS = ['drug_id', 'change', 'reason', 'created_at']
+
+def record_movements(changes, reason, moment=None):
+    """Append a movement for each {drug_id: change} (zero changes are skipped)"""
+    moment = moment or datetime.now()
+    rows = [{'drug_id': drug_id, 'change': change, 'reason': reason, 'created_at': moment}
+            for drug_id, change in changes.items() if change]
+    if rows:
+        db.session.execute(db.insert(StockMovement.__table__), rows)
+
+def record_recount(drug_ids, reason):
+    """Append the difference between each drug's batch total and its Drug.quantity,
+    ahead of recount_drug_stock() setting one to the other"""
+    total = db.select(db.func.coalesce(db.func.sum(DrugBatch.quantity), 0)) \
+        .where(DrugBatch.drug_id == Drug.id).scalar_subquery()
+    change = total - Drug.quantity
+    select = db.select(Drug.id, change, db.literal(reason), db.literal(datetime.now())) \
+        .where(Drug.id.in_(list(drug_ids)), change != 0)
+    db.session.execute(db.insert(StockMovement.__table__).from_select(MOVEMENT_COLUMNS, select))
+
+def balances(snapshot_id=None, after_id=0, upto_id=None):
+    """Rows of (drug_id, quantity) for a snapshot's lines plus the movements in
+    (after_id, upto_id], as one UNION ALL to aggregate"""
+    movements = db.select(StockMovement.drug_id, StockMovement.change.label('quantity')) \
+        .where(StockMovement.id > after_id)
+    if upto_id is not None:
+        movements = movements.where(StockMovement.id <= upto_id)
+    if snapshot_id is None:
+        return [movements]
+    lines = db.select(StockSnapshotLine.drug_id, StockSnapshotLine.quantity) \
+        .where(StockSnapshotLine.snapshot_id == snapshot_id)
+    return [lines, movements]
+
+def take_snapshot(connection):
+    """Record every drug's balance as of the latest movement, from the previous
+    snapshot plus the movements since. Returns the new snapshot's id, or None
+    when nothing moved since the previous one."""
+    if connection.dialect.name == 'postgresql':
+        # Wait for in-flight movements to commit and hold new ones until we are done,
+        # so no movement below the cut can commit after it
+        connection.execute(text('LOCK TABLE stock_movement IN SHARE MODE'))
+    previous = connection.execute(
+        db.select(StockSnapshot.id, StockSnapshot.last_movement_id).order_by(StockSnapshot.id.desc()).limit(1)
+    ).first()
+    previous_id, previous_cut = previous or (None, 0)
+    cut = connection.execute(db.select(db.func.coalesce(db.func.max(StockMovement.id), 0))).scalar()
+    if previous and cut == previous_cut:
+        return None
+
+    snapshot_id = connection.execute(
+        db.insert(StockSnapshot).values(taken_at=datetime.now(), last_movement_id=cut)
+    ).inserted_primary_key[0]
+    rows = db.union_all(*balances(previous_id, previous_cut, cut)).subquery()
+    total = db.func.sum(rows.c.quantity)
+    connection.execute(db.insert(StockSnapshotLine).from_select(
+        ['snapshot_id', 'drug_id', 'quantity'],
+        db.select(db.literal(snapshot_id), rows.c.drug_id, total).group_by(rows.c.drug_id).having(total != 0)))
+    return snapshot_id
+
+def stock_at(moment, drug_ids=None):
+    """{drug_id: quantity} as the ledger stood at moment, for every drug with stock
+    (or just drug_ids). Starts from whichever snapshot is nearer in time and
+    applies the movements between it and moment, forwards or backwards."""
+    before = StockSnapshot.query.filter(StockSnapshot.taken_at <= moment) \
+        .order_by(StockSnapshot.taken_at.desc()).first()
+    after = StockSnapshot.query.filter(StockSnapshot.taken_at > moment) \
+        .order_by(StockSnapshot.taken_at).first()
+    low_cut = before.last_movement_id if before else 0
+
+    movements = db.session.query(StockMovement.drug_id, db.func.sum(StockMovement.change)) \
+        .filter(StockMovement.id > low_cut)
+    if after and (not before or after.taken_at - moment < moment - before.taken_at):
+        base, sign = after, -1
+        movements = movements.filter(StockMovement.id <= after.last_movement_id, StockMovement.created_at > moment)
+    else:
+        base, sign = before, 1
+        movements = movements.filter(StockMovement.created_at <= moment)
+        if after:
+            movements = movements.filter(StockMovement.id <= after.last_movement_id)
+
+    stock = {}
+    if base:
+        lines = db.session.query(StockSnapshotLine.drug_id, StockSnapshotLine.quantity) \
+            .filter(StockSnapshotLine.snapshot_id == base.id)
+        if drug_ids is not None:
+            lines = lines.filter(StockSnapshotLine.drug_id.in_(list(drug_ids)))
+        stock.update(lines)
+    if drug_ids is not None:
+        movements = movements.filter(StockMovement.drug_id.in_(list(drug_ids)))
+    for drug_id, change in movements.group_by(StockMovement.drug_id):
+        stock[drug_id] = stock.get(drug_id, 0) + sign * change
+    if drug_ids is not None:
+        return {drug_id: stock.get(drug_id, 0) for drug_id in drug_ids}
+    return {drug_id: quantity for drug_id, quantity in stock.items() if quantity}
+
+def reconcile(full=False):
+    """(drug_id, ledger balance, Drug.quantity) for every drug where the two differ,
+    deleted drugs included, in one aggregate over the latest snapshot, the
+    movements since and the drug table. full=True ignores the snapshots and
+    sums the whole ledger."""
+    latest = None if full else db.session.query(StockSnapshot.id, StockSnapshot.last_movement_id) \
+        .order_by(StockSnapshot.id.desc()).first()
+    snapshot_id, cut = latest or (None, 0)
+    parts = [part.add_columns(db.literal(0).label('stock')) for part in balances(snapshot_id, cut)]
+    parts.append(db.select(Drug.id, db.literal(0), Drug.quantity))
+    rows = db.union_all(*parts).subquery()
+    ledger, stock = db.func.sum(rows.c.quantity), db.func.sum(rows.c.stock)
+    return db.session.execute(
+        db.select(rows.c.drug_id, ledger, stock).group_by(rows.c.drug_id).having(ledger != stock)
+        .order_by(rows.c.drug_id)
+    ).all()
@@ -0,0 +1,275 @@
+import atexit
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+from models import db
+
+try:
+    import fcntl
+except ImportError:  # Windows: one process, the thread lock is enough
+    fcntl = None
+
+# Per-endpoint request metrics in Prometheus text format. Each gunicorn worker
+# counts in memory and writes a snapshot to the instance folder every few
+# seconds; /metrics adds up the snapshots of every worker. Snapshots of workers
+# that have exited (max_requests recycling, restarts) are folded into
+# retired.json and deleted, so the folder stays small and counters never go
+# backwards. With METRICS_ENABLED off nothing is hooked into requests or the engine.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+FLUSH_INTERVAL = 5  # seconds between snapshot writes
+RETIRED_FILE = 'retired.json'  # totals of workers that have exited
+MAX_STATEMENTS = 200  # SQL statements kept per request for the slow log
+SLOW_STATEMENTS_LOGGED = 5
+
+METRICS = {
+    # name: (type, help, histogram buckets)
+    'pharmacy_requests_total': ('counter', 'Requests served', None),
+    'pharmacy_request_duration_seconds': ('histogram', 'Time to build the response', LATENCY_BUCKETS),
+    'pharmacy_request_sql_queries': ('histogram', 'SQL statements run per request', QUERY_COUNT_BUCKETS),
+    'pharmacy_sql_seconds_total': ('counter', 'Time spent executing SQL', None),
+    'pharmacy_template_render_seconds': ('histogram', 'Template render time', LATENCY_BUCKETS),
+    'pharmacy_slow_requests_total': ('counter', 'Requests slower than SLOW_REQUEST_SECONDS', None),
+}
+
+logger = logging.getLogger('pharmacy.slow_requests')
+_collect_lock = threading.Lock()
+
+class Metrics:
+    """Counters and histograms keyed by (metric name, label pairs)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._last_flush = 0.0
+        self.directory = None
+        self.filename = None
+
+    def init_app(self, app):
+        self.directory = os.path.join(app.instance_path, 'metrics')
+        os.makedirs(self.directory, exist_ok=True)
+        # The token keeps a later process that reuses this pid from overwriting our file
+        self.filename = f'{os.getpid()}-{secrets.token_hex(4)}.json'
+        atexit.register(self.flush, force=True)
+
+    def inc(self, name, labels, amount=1):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                # Per-bucket counts (the last is +Inf), then sum and count
+                histogram = self._values[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+            histogram[bisect_left(buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return [[name, list(labels), value] for (name, labels), value in self._values.items()]
+
+    def flush(self, force=False):
+        """Write this process's snapshot for /metrics, at most every FLUSH_INTERVAL seconds"""
+        now = time.monotonic()
+        if not self.directory or (not force and now - self._last_flush < FLUSH_INTERVAL):
+            return
+        self._last_flush = now
+        write_json(os.path.join(self.directory, self.filename), self.snapshot())
+
+    def collect(self):
+        """Values summed over the snapshots of every live worker plus the retired totals.
+        Snapshots of workers that have exited are folded into the retired totals and
+        deleted on the way."""
+        self.flush(force=True)
+        retired_path = os.path.join(self.directory, RETIRED_FILE)
+        with directory_lock(self.directory):
+            retired = read_json(retired_path) or {'files': [], 'values': []}
+            retired_totals = add_entries({}, retired['values'])
+            totals = {}
+            exited = []
+            for filename in sorted(os.listdir(self.directory)):
+                if filename == RETIRED_FILE or not filename.endswith('.json'):
+                    continue
+                path = os.path.join(self.directory, filename)
+                if filename in retired['files']:
+                    os.remove(path)  # folded in by a collect interrupted before its delete
+                    continue
+                entries = read_json(path)
+                if entries is None:
+                    continue  # a worker is replacing it right now
+                if process_alive(filename):
+                    add_entries(totals, entries)
+                else:
+                    add_entries(retired_totals, entries)
+                    exited.append(filename)
+            if exited:
+                # The totals name the files folded into them, so a delete that never
+                # happened cannot count a file twice
+                write_json(retired_path, {'files': exited, 'values': to_entries(retired_totals)})
+                for filename in exited:
+                    os.remove(os.path.join(self.directory, filename))
+        return add_entries(totals, to_entries(retired_totals))
+
+    def render(self):
+        """Prometheus text exposition format"""
+        by_name = {}
+        for (name, labels), value in sorted(self.collect().items()):
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in by_name.get(name, []):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value[-2]}')
+                lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(path + '.tmp', path)
+
+def to_entries(totals):
+    return [[name, list(labels), value] for (name, labels), value in totals.items()]
+
+def add_entries(totals, entries):
+    """Add snapshot entries [name, labels, value] into totals and return it"""
+    for name, labels, value in entries:
+        key = (name, tuple(tuple(pair) for pair in labels))
+        if isinstance(value, list):
+            total = totals.setdefault(key, [0] * len(value))
+            totals[key] = [a + b for a, b in zip(total, value)]
+        else:
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+def process_alive(filename):
+    """Whether the worker that wrote a snapshot ('<pid>-<token>.json') is still running"""
+    if os.name != 'posix':
+        return True  # os.kill(pid, 0) would not just probe the process there
+    try:
+        os.kill(int(filename.split('.')[0].split('-')[0]), 0)
+    except ValueError:
+        return True
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # alive, just not ours to signal
+    return True
+
+@contextmanager
+def directory_lock(directory):
+    """Serialise collects across workers, so two scrapes never fold the same file"""
+    with _collect_lock, open(os.path.join(directory, 'collect.lock'), 'w') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+metrics = Metrics()
+
+def init_metrics(app):
+    """Time every request, its SQL and its templates (no-op unless METRICS_ENABLED)"""
+    if not app.config.get('METRICS_ENABLED'):
+        return
+    metrics.init_app(app)
+    slow_seconds = app.config.get('SLOW_REQUEST_SECONDS', 1.0)
+
+    def in_timed_request():
+        return has_request_context() and 'metrics_start' in g
+
+    def before_cursor(conn, cursor, statement, parameters, context, executemany):
+        if in_timed_request():
+            conn.info.setdefault('metrics_query_start', []).append(time.perf_counter())
+
+    def after_cursor(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('metrics_query_start')
+        if not starts or not in_timed_request():
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        g.sql_count += 1
+        g.sql_time += elapsed
+        if len(g.sql_statements) < MAX_STATEMENTS:
+            g.sql_statements.append((elapsed, statement))
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', before_cursor)
+            event.listen(engine, 'after_cursor_execute', after_cursor)
+
+    def render_started(sender, template, context, **extra):
+        if in_timed_request():
+            g.template_starts.append(time.perf_counter())
+
+    def render_finished(sender, template, context, **extra):
+        if in_timed_request() and g.template_starts:
+            metrics.observe('pharmacy_template_render_seconds', (('template', template.name),),
+                            time.perf_counter() - g.template_starts.pop())
+
+    before_render_template.connect(render_started, app, weak=False)
+    template_rendered.connect(render_finished, app, weak=False)
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = time.perf_counter()
+        g.sql_count = 0
+        g.sql_time = 0.0
+        g.sql_statements = []
+        g.template_starts = []
+
+    @app.after_request
+    def record_request(response):
+        # Streamed responses (exports, the alert stream) are timed to the first byte
+        if 'metrics_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.metrics_start
+        endpoint = request.endpoint or 'unmatched'
+        labels = (('endpoint', endpoint), ('method', request.method))
+        metrics.inc('pharmacy_requests_total', labels + (('status', str(response.status_code)),))
+        metrics.observe('pharmacy_request_duration_seconds', labels, elapsed)
+        metrics.observe('pharmacy_request_sql_queries', labels, g.sql_count)
+        metrics.inc('pharmacy_sql_seconds_total', labels, g.sql_time)
+
+        if elapsed >= slow_seconds:
+            metrics.inc('pharmacy_slow_requests_total', labels)
+            slowest = sorted(g.sql_statements, key=lambda item: item[0], reverse=True)[:SLOW_STATEMENTS_LOGGED]
+            logger.warning(
+                'Slow request %s %s (%s): %.3fs, %d queries taking %.3fs%s',
+                request.method, request.full_path.rstrip('?'), endpoint, elapsed, g.sql_count, g.sql_time,
+                ''.join(f'\n  {seconds:.3f}s {statement}' for seconds, statement in slowest))
+        metrics.flush()
+        return response
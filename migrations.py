@@ -0,0 +1,126 @@
+from datetime import datetime
+from sqlalchemy import inspect, text
+from models import (db, UserSession, Drug, DrugBatch, Sale, SalesRollup, Purchase, Job, AlertSnapshot,
+                    StockMovement, StockSnapshot, StockSnapshotLine)
+from reporting import rebuild_rollup
+from branches import DEFAULT_BRANCH, branch_codes
+from dbconfig import branch_engine
+
+# Ordered list of schema migrations. A migration's version is its position
+# in this list, so new migrations are only ever appended. db.create_all()
+# runs first and may already have built what a migration adds on a fresh
+# database, so every migration must be safe to run against either schema.
+# Every branch database gets the full schema and the same migrations; the
+# shared tables simply stay empty outside the main database.
+MIGRATIONS = []
+
+def migration(f):
+    MIGRATIONS.append(f)
+    return f
+
+@migration
+def add_query_indexes(conn):
+    """Indexes for the stock, expiry, history and report predicates"""
+    for table in (Drug.__table__, Sale.__table__, Purchase.__table__):
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+@migration
+def add_drug_batches(conn):
+    """Per-batch stock table, seeded with one batch per existing drug"""
+    DrugBatch.__table__.create(conn, checkfirst=True)
+    for index in DrugBatch.__table__.indexes:
+        index.create(conn, checkfirst=True)
+    conn.execute(text(
+        'INSERT INTO drug_batch (drug_id, batch_no, quantity, cost_price, expiry_date, received_at) '
+        'SELECT id, batch_no, quantity, cost_price, expiry_date, created_at FROM drug '
+        'WHERE NOT EXISTS (SELECT 1 FROM drug_batch WHERE drug_batch.drug_id = drug.id)'
+    ))
+
+@migration
+def add_sales_rollup(conn):
+    """Daily sales rollup table, backfilled from existing sales"""
+    SalesRollup.__table__.create(conn, checkfirst=True)
+    for index in SalesRollup.__table__.indexes:
+        index.create(conn, checkfirst=True)
+    rebuild_rollup(conn)
+
+@migration
+def add_user_sessions(conn):
+    """Server-side login sessions, and password hashes long enough for scrypt"""
+    UserSession.__table__.create(conn, checkfirst=True)
+    for index in UserSession.__table__.indexes:
+        index.create(conn, checkfirst=True)
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('ALTER TABLE "user" ALTER COLUMN password_hash TYPE VARCHAR(255)'))
+
+@migration
+def add_jobs(conn):
+    """Background job queue and the nightly alert snapshots"""
+    for table in (Job.__table__, AlertSnapshot.__table__):
+        table.create(conn, checkfirst=True)
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+@migration
+def add_stock_ledger(conn):
+    """Stock movement ledger and snapshots, opened with each drug's current stock"""
+    for table in (StockMovement.__table__, StockSnapshot.__table__, StockSnapshotLine.__table__):
+        table.create(conn, checkfirst=True)
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    conn.execute(text(
+        "INSERT INTO stock_movement (drug_id, change, reason, created_at) "
+        "SELECT id, quantity, 'opening', :now FROM drug "
+        "WHERE quantity != 0 AND NOT EXISTS (SELECT 1 FROM stock_movement WHERE stock_movement.drug_id = drug.id)"
+    ), {'now': datetime.now()})
+
+@migration
+def add_branches(conn):
+    """Home branch for users and the branch each job runs against"""
+    for table, column in (('user', 'branch VARCHAR(40)'),
+                          ('job', f"branch VARCHAR(40) NOT NULL DEFAULT '{DEFAULT_BRANCH}'")):
+        if 'branch' not in {c['name'] for c in inspect(conn).get_columns(table)}:
+            conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column}'))
+
+@migration
+def add_job_heartbeats(conn):
+    """Heartbeat of running jobs, so a long job is not mistaken for one whose worker died"""
+    if 'heartbeat_at' not in {c['name'] for c in inspect(conn).get_columns('job')}:
+        conn.execute(text('ALTER TABLE job ADD COLUMN heartbeat_at TIMESTAMP'))
+
+@migration
+def drop_name_trigram_index(conn):
+    """Drop the gin trigram index on drug names that early installs built: name
+    search runs on the in-memory index (search.py), so it only slowed writes"""
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text('DROP INDEX IF EXISTS ix_drug_name_trgm'))
+
+def current_version(conn):
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    return conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+def migrate(engine):
+    """Apply pending migrations in order and return the version numbers applied"""
+    applied = []
+    with engine.begin() as conn:
+        version = current_version(conn)
+
+    for number, step in enumerate(MIGRATIONS, 1):
+        if number <= version:
+            continue
+        with engine.begin() as conn:
+            step(conn)
+            conn.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': number})
+        applied.append(number)
+    return applied
+
+def init_schema():
+    """Create missing tables and apply pending migrations in every branch's database
+    (call inside an app context). Returns {branch: versions applied}."""
+    applied = {}
+    for branch in branch_codes():
+        engine = branch_engine(branch)
+        db.metadata.create_all(engine)
+        applied[branch] = migrate(engine)
+    return applied
@@ -1,22 +1,62 @@
+import sqlalchemy as sa
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from branches import DEFAULT_BRANCH, bind_key, current_branch
 
-db = SQLAlchemy()
+# Tables every branch shares, kept in the main database; everything else is per branch
+SHARED_TABLES = {'user', 'user_session', 'job'}
+
+def uses_shared_table(mapper, clause):
+    if mapper is not None:
+        return sa.inspect(mapper).local_table.name in SHARED_TABLES
+    if isinstance(clause, sa.Table):
+        tables = [clause]
+    elif getattr(clause, 'table', None) is not None:  # INSERT, UPDATE, DELETE
+        tables = [clause.table]
+    else:
+        tables = getattr(clause, 'get_final_froms', list)()  # SELECT
+    return any(getattr(table, 'name', None) in SHARED_TABLES for table in tables)
+
+class BranchSession(Session):
+    """Sends each statement to the current branch's database, or to the main
+    database for the shared tables (see branches.py)"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not uses_shared_table(mapper, clause):
+            bind = self._db.engines[bind_key(current_branch())]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(session_options={'class_': BranchSession})
+
+# Werkzeug's default (pbkdf2 with 600k iterations) costs ~200ms of CPU per
+# login; this keeps a login around 80ms on a small instance. PASSWORD_HASH_METHOD
+# in the app config overrides it, and older hashes are upgraded at login.
+PASSWORD_HASH_METHOD = 'pbkdf2:sha256:260000'
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
-    password_hash = db.Column(db.String(120), nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)  # room for scrypt hashes
     role = db.Column(db.String(20), nullable=False, default='pharmacist')  # 'admin' or 'pharmacist'
+    branch = db.Column(db.String(40))  # home branch; None may work at any branch
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+    def set_password(self, password, method=PASSWORD_HASH_METHOD):
+        self.password_hash = generate_password_hash(password, method)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+class UserSession(db.Model):
+    """A login; the cookie only carries its id, so deleting the row logs the user out"""
+    __tablename__ = 'user_session'
+    id = db.Column(db.String(64), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
 class Drug(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -32,6 +72,38 @@ class Drug(db.Model):
     
     sales = db.relationship('Sale', backref='drug', lazy=True)
     purchases = db.relationship('Purchase', backref='drug', lazy=True)
+    batches = db.relationship('DrugBatch', backref='drug', lazy=True, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('ix_drug_quantity', 'quantity'),  # low stock counts, in-stock picker
+        db.Index('ix_drug_expiry_date', 'expiry_date'),  # expired / expiring soon
+        db.Index('ix_drug_category_name', 'category', 'name'),  # category filter ordered by name
+        db.Index('ix_drug_name', 'name'),  # catalogue ordered by name
+    )
+
+class DrugBatch(db.Model):
+    """Stock held for one batch (lot) of a drug. Drug.quantity is the sum over its batches."""
+    id = db.Column(db.Integer, primary_key=True)
+    drug_id = db.Column(db.Integer, db.ForeignKey('drug.id'), nullable=False)
+    batch_no = db.Column(db.String(50), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    cost_price = db.Column(db.Float, nullable=False)
+    expiry_date = db.Column(db.Date, nullable=False)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # First-expiry-first-out draw for one drug, skipping empty batches
+        db.Index('ix_drug_batch_fefo', 'drug_id', 'expiry_date', 'id',
+                 sqlite_where=db.text('quantity > 0'), postgresql_where=db.text('quantity > 0')),
+        # Expired / expiring soon counts and report across the catalogue
+        db.Index('ix_drug_batch_expiry', 'expiry_date', 'drug_id',
+                 sqlite_where=db.text('quantity > 0'), postgresql_where=db.text('quantity > 0')),
+        db.Index('ix_drug_batch_drug_batch_no', 'drug_id', 'batch_no'),
+    )
+
+# Use in queries that should hit the partial batch indexes: SQLite only matches
+# a partial index when the query repeats its WHERE term with a literal
+BATCH_IN_STOCK = DrugBatch.quantity > db.literal_column('0')
 
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -42,6 +114,25 @@ class Sale(db.Model):
     staff_name = db.Column(db.String(100), nullable=False)
     sale_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_sale_sale_date_id', 'sale_date', 'id'),  # history pages and report ranges
+        db.Index('ix_sale_drug_id_sale_date', 'drug_id', 'sale_date'),  # per-drug history
+    )
+
+class SalesRollup(db.Model):
+    """Sales totals per day, drug and staff member, maintained as sales commit"""
+    __tablename__ = 'sales_rollup'
+    day = db.Column(db.Date, primary_key=True)
+    drug_id = db.Column(db.Integer, db.ForeignKey('drug.id'), primary_key=True)
+    staff_name = db.Column(db.String(100), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    transactions = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_sales_rollup_drug_id_day', 'drug_id', 'day'),  # per-drug trends
+    )
+
 class Purchase(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     drug_id = db.Column(db.Integer, db.ForeignKey('drug.id'), nullable=False)
@@ -52,6 +143,73 @@ class Purchase(db.Model):
     batch_no = db.Column(db.String(50), nullable=False)
     purchase_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index('ix_purchase_purchase_date_id', 'purchase_date', 'id'),
+        db.Index('ix_purchase_drug_id', 'drug_id'),
+    )
+
+class StockMovement(db.Model):
+    """One change to a drug's stock, appended in the transaction that made it.
+    No foreign key: the ledger outlives deleted drugs."""
+    __tablename__ = 'stock_movement'
+    id = db.Column(db.Integer, primary_key=True)
+    drug_id = db.Column(db.Integer, nullable=False)
+    change = db.Column(db.Integer, nullable=False)  # units, negative for stock going out
+    reason = db.Column(db.String(20), nullable=False)  # opening, sale, purchase, adjustment, import, delete, write_off
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_stock_movement_drug_id_id', 'drug_id', 'id'),  # one drug's history
+    )
+
+class StockSnapshot(db.Model):
+    """Every drug's ledger balance after movement last_movement_id"""
+    __tablename__ = 'stock_snapshot'
+    id = db.Column(db.Integer, primary_key=True)
+    taken_at = db.Column(db.DateTime, nullable=False, index=True)
+    last_movement_id = db.Column(db.Integer, nullable=False)
+
+class StockSnapshotLine(db.Model):
+    """A drug's balance in a snapshot; drugs with no stock have no line"""
+    __tablename__ = 'stock_snapshot_line'
+    snapshot_id = db.Column(db.Integer, db.ForeignKey('stock_snapshot.id'), primary_key=True)
+    drug_id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+
+class Job(db.Model):
+    """Background work queued by the web app and run by the workers in jobs.py"""
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    key = db.Column(db.String(100), unique=True)  # set on scheduled jobs so each runs once
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    requested_by = db.Column(db.String(80))
+    branch = db.Column(db.String(40), nullable=False, default=DEFAULT_BRANCH)  # whose database it runs against
+    worker = db.Column(db.String(100))  # host:pid that claimed it
+    result_name = db.Column(db.String(100))  # download filename, for jobs that produce a file
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # refreshed while it runs; a stale one means the worker died
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_job_status_id', 'status', 'id'),  # claim the oldest queued job
+        db.Index('ix_job_requested_by_id', 'requested_by', 'id'),  # a user's recent jobs
+    )
+
+class AlertSnapshot(db.Model):
+    """Stock and expiry counters as they stood on a day, taken by the nightly sweep"""
+    __tablename__ = 'alert_snapshot'
+    day = db.Column(db.Date, primary_key=True)
+    total = db.Column(db.Integer, nullable=False)
+    low_stock = db.Column(db.Integer, nullable=False)
+    expiring_soon = db.Column(db.Integer, nullable=False)
+    expiring_alert = db.Column(db.Integer, nullable=False)
+    expired = db.Column(db.Integer, nullable=False)
+    taken_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
 class Supplier(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -0,0 +1,62 @@
+import base64
+from datetime import datetime
+from models import db
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+
+def encode_cursor(timestamp, row_id):
+    """Encode the (timestamp, id) of the last row on a page as an opaque cursor"""
+    raw = f'{timestamp.isoformat()}|{row_id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """Decode a cursor produced by encode_cursor, raising ValueError if it is malformed"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        timestamp, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    """Parse a requested page size and clamp it to a sane range"""
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+def keyset_page(query, date_column, id_column, cursor=None, limit=DEFAULT_PAGE_SIZE):
+    """Return one page of rows, newest first, and the cursor for the next page.
+
+    Rows are ordered by (date_column, id_column) descending and the cursor
+    seeks past the last row seen, so every page costs the same no matter
+    how deep into the history it is.
+    """
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        query = query.filter(db.or_(
+            date_column < timestamp,
+            db.and_(date_column == timestamp, id_column < row_id)
+        ))
+
+    rows = query.order_by(date_column.desc(), id_column.desc()).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, date_column.key), getattr(last, id_column.key))
+    return rows, next_cursor
+
+def iter_keyset(query, date_column, id_column, batch_size=EXPORT_BATCH_SIZE):
+    """Yield every row of query newest first, fetching batch_size rows at a time"""
+    cursor = None
+    while True:
+        rows, cursor = keyset_page(query, date_column, id_column, cursor, batch_size)
+        yield from rows
+        if not cursor:
+            break
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+from models import db, Sale, Purchase
+
+# Per-endpoint query budgets enforced when QUERY_BUDGET_ENABLED is set (or in TESTING).
+# They cover the page's own statements: the login check runs uncounted, since
+# whether it needs a query depends on the session cache, not on the page.
+QUERY_BUDGETS = {
+    'dashboard': 2,
+    'drugs': 3,
+    'sales': 2,
+    'purchases': 2,
+    'reports': 5,
+    'api_sales': 1,
+    'api_purchases': 1,
+    'api_alerts': 1,
+    'api_drugs_search': 2,
+    'api_reorder_forecast': 2,
+    'api_job': 1,
+    'api_stock_at': 4,
+}
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a request runs more SQL statements than its budget allows"""
+
+@contextmanager
+def uncounted():
+    """Leave the statements run inside the block out of the request's query budget"""
+    count = g.get('query_count')
+    try:
+        yield
+    finally:
+        if count is not None:
+            g.query_count = count
+
+def sales_with_drug():
+    """Sale query that loads each sale's drug in the same SELECT"""
+    return Sale.query.options(joinedload(Sale.drug))
+
+def purchases_with_drug():
+    """Purchase query that loads each purchase's drug in the same SELECT"""
+    return Purchase.query.options(joinedload(Purchase.drug))
+
+def init_query_budget(app):
+    """Count the SQL statements run by each request and fail when a page goes over budget"""
+    def count_query(conn, cursor, statement, parameters, context, executemany):
+        if 'query_count' in g:
+            g.query_count += 1
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', count_query)
+
+    @app.before_request
+    def start_query_count():
+        if app.config.get('QUERY_BUDGET_ENABLED') or app.config.get('TESTING'):
+            g.query_count = 0
+
+    @app.after_request
+    def check_query_budget(response):
+        if 'query_count' not in g or request.method != 'GET':
+            return response
+        budget = app.config.get('QUERY_BUDGETS', {}).get(request.endpoint, QUERY_BUDGETS.get(request.endpoint))
+        if budget is not None and g.query_count > budget:
+            raise QueryBudgetExceeded(
+                f'{request.endpoint} ran {g.query_count} queries, budget is {budget}')
+        return response
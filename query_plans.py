@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+from sqlalchemy import event, text
+from models import Drug, DrugBatch, Sale, SalesRollup, Purchase, BATCH_IN_STOCK
+from queries import sales_with_drug, purchases_with_drug
+from reporting import period_range, in_range, rollup_in_range
+from dbconfig import branch_engine
+
+def plan_checks():
+    """(route, description, query, expected index, dialects) for every hot query shape"""
+    today = datetime.now().date()
+    soon_date = today + timedelta(days=90)
+    return [
+        ('drugs', 'low stock filter', Drug.query.filter(Drug.quantity < 10), 'ix_drug_quantity', None),
+        ('reports', 'expired batches',
+         DrugBatch.query.filter(BATCH_IN_STOCK, DrugBatch.expiry_date <= today), 'ix_drug_batch_expiry', None),
+        ('reports', 'expiring soon batches',
+         DrugBatch.query.filter(BATCH_IN_STOCK, DrugBatch.expiry_date <= soon_date, DrugBatch.expiry_date > today),
+         'ix_drug_batch_expiry', None),
+        ('sales', 'FEFO batch draw',
+         DrugBatch.query.filter(DrugBatch.drug_id == 1, BATCH_IN_STOCK)
+         .order_by(DrugBatch.expiry_date, DrugBatch.id).limit(8), 'ix_drug_batch_fefo', None),
+        ('dashboard', 'recent sales',
+         sales_with_drug().order_by(Sale.sale_date.desc()).limit(5), 'ix_sale_sale_date_id', None),
+        ('drugs', 'category filter',
+         Drug.query.filter_by(category='Analgesic').order_by(Drug.name), 'ix_drug_category_name', None),
+        ('drugs', 'catalogue order', Drug.query.order_by(Drug.name), 'ix_drug_name', None),
+        ('sales', 'in-stock picker', Drug.query.filter(Drug.quantity > 0), 'ix_drug_quantity', None),
+        ('sales', 'history page',
+         sales_with_drug().order_by(Sale.sale_date.desc(), Sale.id.desc()).limit(51), 'ix_sale_sale_date_id', None),
+        ('purchases', 'history page',
+         purchases_with_drug().order_by(Purchase.purchase_date.desc(), Purchase.id.desc()).limit(51),
+         'ix_purchase_purchase_date_id', None),
+        ('reports', 'monthly sales range',
+         in_range(sales_with_drug(), *period_range('monthly')), 'ix_sale_sale_date_id', None),
+        ('reports', 'quarterly rollup range',
+         rollup_in_range(SalesRollup.query, *period_range('quarterly')), 'sqlite_autoindex_sales_rollup_1', ('sqlite',)),
+        ('reports', 'quarterly rollup range',
+         rollup_in_range(SalesRollup.query, *period_range('quarterly')), 'sales_rollup_pkey', ('postgresql',)),
+    ]
+
+def explain(conn, query):
+    """Return the database's query plan for an ORM query as a single string"""
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+
+    def add_explain(conn, cursor, statement, parameters, context, executemany):
+        return prefix + statement, parameters
+
+    event.listen(conn, 'before_cursor_execute', add_explain, retval=True)
+    try:
+        rows = conn.execute(query.statement).fetchall()
+    finally:
+        event.remove(conn, 'before_cursor_execute', add_explain)
+    return '\n'.join(str(row[-1]) for row in rows)
+
+def check_query_plans():
+    """Explain every hot query and return (route, description, index, plan) for each one
+    whose plan does not use the intended index, against the current branch's database
+    (call inside an app context)"""
+    failures = []
+    with branch_engine().connect() as conn:
+        if conn.dialect.name == 'postgresql':
+            # Small or freshly loaded tables make a sequential scan look cheapest;
+            # disabling it shows whether the index is usable for the predicate at all.
+            conn.execute(text('SET enable_seqscan = off'))
+        for route, description, query, index, dialects in plan_checks():
+            if dialects and conn.dialect.name not in dialects:
+                continue
+            plan = explain(conn, query)
+            if index not in plan:
+                failures.append((route, description, index, plan))
+    return failures
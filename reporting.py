@@ -0,0 +1,199 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Drug, Sale, SalesRollup
+from alerts import alert_counts
+from branches import for_each_branch
+
+# Days before today covered by each rolling period (today is always included)
+PERIOD_DAYS = {'daily': 0, 'weekly': 7, 'monthly': 30, 'quarterly': 91, 'yearly': 365}
+SALES_PERIODS = tuple(PERIOD_DAYS) + ('custom',)
+BRANCH_TOP_DRUGS = 50  # each branch's best sellers merged into the consolidated top drugs
+
+def day_start(day):
+    return datetime.combine(day, datetime.min.time())
+
+def period_range(period, today=None):
+    """Return the [start, end) datetimes covered by a rolling sales report period.
+
+    Ranges are half-open on the raw sale_date column so the filter can use
+    an index instead of wrapping the column in date().
+    """
+    today = today or datetime.now().date()
+    return day_start(today - timedelta(days=PERIOD_DAYS[period])), day_start(today + timedelta(days=1))
+
+def custom_range(first_day, last_day):
+    """Return the [start, end) datetimes covering first_day to last_day inclusive"""
+    if isinstance(first_day, str):
+        first_day = date.fromisoformat(first_day)
+    if isinstance(last_day, str):
+        last_day = date.fromisoformat(last_day)
+    if last_day < first_day:
+        raise ValueError('end date is before start date')
+    return day_start(first_day), day_start(last_day + timedelta(days=1))
+
+def resolve_period(period, first_day=None, last_day=None):
+    """[start, end) for a period name, or for the first_day..last_day strings of a
+    custom range. Raises ValueError for unknown periods and bad dates."""
+    if period == 'custom':
+        if not first_day or not last_day:
+            raise ValueError('custom period needs start and end dates')
+        return custom_range(first_day, last_day)
+    if period not in PERIOD_DAYS:
+        raise ValueError(f'Unknown period: {period}')
+    return period_range(period)
+
+def in_range(query, start, end):
+    return query.filter(Sale.sale_date >= start, Sale.sale_date < end)
+
+# Daily rollup. Reports read whole days of pre-aggregated rows, so their cost
+# depends on the number of days, drugs and staff, not on the number of sales.
+
+def rollup_in_range(query, start, end):
+    return query.filter(SalesRollup.day >= start.date(), SalesRollup.day < end.date())
+
+def upsert(table):
+    insert = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}[db.session.get_bind().dialect.name]
+    return insert(table)
+
+def add_to_rollup(sales):
+    """Add sales (dicts of Sale columns) to the daily rollup, in the caller's transaction"""
+    totals = {}
+    for sale in sales:
+        key = (sale['sale_date'].date(), sale['drug_id'], sale['staff_name'])
+        quantity, revenue, transactions = totals.get(key, (0, 0.0, 0))
+        totals[key] = (quantity + sale['quantity'], revenue + sale['total_price'], transactions + 1)
+
+    table = SalesRollup.__table__
+    insert = upsert(table)
+    db.session.execute(
+        insert.on_conflict_do_update(
+            index_elements=[table.c.day, table.c.drug_id, table.c.staff_name],
+            set_={
+                'quantity': table.c.quantity + insert.excluded.quantity,
+                'revenue': table.c.revenue + insert.excluded.revenue,
+                'transactions': table.c.transactions + insert.excluded.transactions
+            }),
+        [{'day': day, 'drug_id': drug_id, 'staff_name': staff_name,
+          'quantity': quantity, 'revenue': revenue, 'transactions': transactions}
+         for (day, drug_id, staff_name), (quantity, revenue, transactions) in totals.items()]
+    )
+
+def rebuild_rollup(connection, first_day=None, last_day=None):
+    """Recompute the rollup from raw sales for first_day..last_day (default: all days)
+    and return the number of rollup rows written. Sales committed meanwhile are
+    neither lost nor double counted."""
+    table = SalesRollup.__table__
+    if connection.dialect.name == 'postgresql':
+        # Wait for in-flight sales to commit and hold new ones until we are done
+        connection.execute(text('LOCK TABLE sales_rollup IN EXCLUSIVE MODE'))
+
+    day = db.func.date(Sale.sale_date)
+    select = db.select(
+        day, Sale.drug_id, Sale.staff_name,
+        db.func.sum(Sale.quantity), db.func.sum(Sale.total_price), db.func.count(Sale.id)
+    ).group_by(day, Sale.drug_id, Sale.staff_name)
+    delete = db.delete(table)
+    if first_day:
+        select = select.where(Sale.sale_date >= day_start(first_day))
+        delete = delete.where(table.c.day >= first_day)
+    if last_day:
+        select = select.where(Sale.sale_date < day_start(last_day + timedelta(days=1)))
+        delete = delete.where(table.c.day <= last_day)
+
+    connection.execute(delete)
+    result = connection.execute(db.insert(table).from_select(
+        ['day', 'drug_id', 'staff_name', 'quantity', 'revenue', 'transactions'], select))
+    return result.rowcount
+
+def sales_summary(start, end):
+    """Total revenue, items sold and transaction count for the range"""
+    row = rollup_in_range(db.session.query(
+        db.func.coalesce(db.func.sum(SalesRollup.revenue), 0),
+        db.func.coalesce(db.func.sum(SalesRollup.quantity), 0),
+        db.func.coalesce(db.func.sum(SalesRollup.transactions), 0)
+    ), start, end).one()
+    return {
+        'total_sales': float(row[0]),
+        'total_items': int(row[1]),
+        'transactions': int(row[2])
+    }
+
+def sales_by_drug(start, end, limit=20):
+    """Top drugs in the range by revenue"""
+    revenue = db.func.sum(SalesRollup.revenue)
+    rows = rollup_in_range(db.session.query(
+        Drug.id, Drug.name,
+        db.func.sum(SalesRollup.quantity).label('quantity'),
+        revenue.label('revenue'),
+        db.func.sum(SalesRollup.transactions).label('transactions')
+    ).join(Drug, SalesRollup.drug_id == Drug.id), start, end) \
+        .group_by(Drug.id, Drug.name).order_by(revenue.desc()).limit(limit).all()
+    return [row._asdict() for row in rows]
+
+def sales_by_staff(start, end):
+    """Revenue and item counts per staff member in the range"""
+    revenue = db.func.sum(SalesRollup.revenue)
+    rows = rollup_in_range(db.session.query(
+        SalesRollup.staff_name,
+        db.func.sum(SalesRollup.quantity).label('quantity'),
+        revenue.label('revenue'),
+        db.func.sum(SalesRollup.transactions).label('transactions')
+    ), start, end).group_by(SalesRollup.staff_name).order_by(revenue.desc()).all()
+    return [row._asdict() for row in rows]
+
+def sales_by_day(start, end):
+    """Revenue and item counts per calendar day in the range"""
+    rows = rollup_in_range(db.session.query(
+        SalesRollup.day,
+        db.func.sum(SalesRollup.quantity).label('quantity'),
+        db.func.sum(SalesRollup.revenue).label('revenue'),
+        db.func.sum(SalesRollup.transactions).label('transactions')
+    ), start, end).group_by(SalesRollup.day).order_by(SalesRollup.day).all()
+    return [row._asdict() for row in rows]
+
+# Cross-branch
+
+def branch_figures(start, end):
+    """The current branch's part of the consolidated report"""
+    return {
+        'summary': sales_summary(start, end),
+        'alerts': alert_counts(),
+        'by_day': sales_by_day(start, end),
+        'by_drug': sales_by_drug(start, end, limit=BRANCH_TOP_DRUGS)
+    }
+
+def consolidated_report(start, end, limit=20):
+    """Sales and stock alerts for every branch over [start, end), each branch queried
+    on its own database at the same time, then merged: a row per branch, totals, revenue
+    per day and the top drugs by name (from each branch's top BRANCH_TOP_DRUGS).
+    A branch that cannot be reached is listed with its error and left out of the totals."""
+    counters = ('total_sales', 'total_items', 'transactions', 'low_stock', 'expiring_soon', 'expired')
+    totals = dict.fromkeys(counters, 0)
+    branches, days, drugs = [], {}, {}
+    for branch, figures, error in for_each_branch(lambda: branch_figures(start, end)):
+        if error is not None:
+            branches.append({'branch': branch, 'error': str(error)})
+            continue
+        alerts = figures['alerts']
+        row = dict(figures['summary'], branch=branch, error=None, low_stock=alerts['low_stock'],
+                   expiring_soon=alerts['expiring_soon'], expired=alerts['expired'])
+        branches.append(row)
+        for name in counters:
+            totals[name] += row[name]
+        for day in figures['by_day']:
+            merged = days.setdefault(day['day'], {'day': day['day'], 'quantity': 0, 'revenue': 0.0, 'transactions': 0})
+            for name in ('quantity', 'revenue', 'transactions'):
+                merged[name] += day[name]
+        for drug in figures['by_drug']:
+            merged = drugs.setdefault(drug['name'], {'name': drug['name'], 'quantity': 0, 'revenue': 0.0,
+                                                     'transactions': 0, 'branches': 0})
+            for name in ('quantity', 'revenue', 'transactions'):
+                merged[name] += drug[name]
+            merged['branches'] += 1
+    return {
+        'branches': branches,
+        'totals': totals,
+        'by_day': [days[day] for day in sorted(days)],
+        'by_drug': sorted(drugs.values(), key=lambda drug: -drug['revenue'])[:limit]
+    }
@@ -0,0 +1,204 @@
+import bisect
+import heapq
+import math
+import re
+import threading
+from collections import Counter
+from models import db, Drug
+from signals import ChangeSignal
+from branches import BranchLocal, branch_signals
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+FUZZY_THRESHOLD = 0.3
+
+def normalize(text):
+    return ' '.join(TOKEN_RE.findall(text.lower()))
+
+def trigrams(text):
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class DrugSearchIndex:
+    """In-memory prefix and trigram index over drug names.
+
+    Ranks exact matches first, then names starting with the query, names
+    whose words start with every query word, plain substrings and finally
+    typo-tolerant trigram matches. Only ids and names are indexed; callers
+    load stock and prices for the handful of ids returned.
+    """
+
+    def __init__(self, signal=None):
+        self.signal = signal or ChangeSignal('catalogue.signal')
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._names = {}  # id -> normalized name
+        self._token_keys = []  # sorted name words, with _token_ids in step,
+        self._token_ids = []  # so a prefix maps to one contiguous slice
+        self._trigrams = {}  # trigram -> set of ids
+        self._gram_counts = {}  # id -> number of trigrams in the name
+
+    def init_app(self, app):
+        self.signal.init_app(app)
+
+    # Index maintenance
+
+    def rebuild(self):
+        """Reload every drug name from the database (call inside an app context)"""
+        stamp = self.signal.stamp()
+        rows = db.session.query(Drug.id, Drug.name).all()
+        names, pairs, grams, counts = {}, [], {}, {}
+        for drug_id, name in rows:
+            text = normalize(name)
+            names[drug_id] = text
+            pairs.extend((token, drug_id) for token in set(text.split()))
+            name_grams = trigrams(text)
+            counts[drug_id] = len(name_grams)
+            for gram in name_grams:
+                grams.setdefault(gram, set()).add(drug_id)
+        pairs.sort()
+        with self._lock:
+            self._names, self._trigrams, self._gram_counts = names, grams, counts
+            self._token_keys = [token for token, _ in pairs]
+            self._token_ids = [drug_id for _, drug_id in pairs]
+            self._stamp = stamp
+
+    def ensure_current(self):
+        """Rebuild if another worker changed drug names since the last load"""
+        if self._stamp != self.signal.stamp():
+            self.rebuild()
+
+    def invalidate(self):
+        """Force a rebuild in every worker after a bulk change to drug names"""
+        with self._lock:
+            self._stamp = None
+        self.signal.touch()
+
+    def update(self, drug_id, name):
+        """Add or rename one drug after a committed write"""
+        with self._lock:
+            self._remove(drug_id)
+            text = normalize(name)
+            self._names[drug_id] = text
+            for token in set(text.split()):
+                i = self._token_position(token, drug_id)
+                self._token_keys.insert(i, token)
+                self._token_ids.insert(i, drug_id)
+            name_grams = trigrams(text)
+            self._gram_counts[drug_id] = len(name_grams)
+            for gram in name_grams:
+                self._trigrams.setdefault(gram, set()).add(drug_id)
+            self._touch()
+
+    def remove(self, drug_id):
+        """Drop one drug after a committed delete"""
+        with self._lock:
+            self._remove(drug_id)
+            self._touch()
+
+    def _remove(self, drug_id):
+        text = self._names.pop(drug_id, None)
+        if text is None:
+            return
+        del self._gram_counts[drug_id]
+        for token in set(text.split()):
+            i = self._token_position(token, drug_id)
+            if i < len(self._token_ids) and self._token_ids[i] == drug_id and self._token_keys[i] == token:
+                del self._token_keys[i]
+                del self._token_ids[i]
+        for gram in trigrams(text):
+            ids = self._trigrams.get(gram)
+            if ids:
+                ids.discard(drug_id)
+
+    def _token_position(self, token, drug_id):
+        i = bisect.bisect_left(self._token_keys, token)
+        while i < len(self._token_keys) and self._token_keys[i] == token and self._token_ids[i] < drug_id:
+            i += 1
+        return i
+
+    def _touch(self):
+        # Only skip our own rebuild if nobody else wrote since we last synced
+        current = self._stamp == self.signal.stamp()
+        stamp = self.signal.touch()
+        if current:
+            self._stamp = stamp
+
+    # Queries
+
+    def _prefix_ids(self, prefix):
+        # Words only hold [a-z0-9], so '{' sorts after every word sharing the prefix
+        start = bisect.bisect_left(self._token_keys, prefix)
+        end = bisect.bisect_left(self._token_keys, prefix + '{', start)
+        return set(self._token_ids[start:end])
+
+    def search(self, query, limit=10):
+        """Return up to limit drug ids ranked by how well their names match query"""
+        text = normalize(query)
+        if not text:
+            return []
+
+        with self._lock:
+            names = self._names
+            scored = {}
+
+            # Every query word is a prefix of some word in the name
+            words = sorted(set(text.split()), key=len, reverse=True)
+            candidates = self._prefix_ids(words[0])
+            for word in words[1:]:
+                if not candidates:
+                    break
+                candidates &= self._prefix_ids(word)
+            for drug_id in candidates:
+                name = names[drug_id]
+                scored[drug_id] = (0 if name == text else 1 if name.startswith(text) else 2, 0.0)
+
+            # Substrings: the name contains every trigram of the query
+            if len(scored) < limit and len(text) >= 3:
+                inner = {text[i:i + 3] for i in range(len(text) - 2)}
+                postings = sorted((self._trigrams.get(g, set()) for g in inner), key=len)
+                for drug_id in postings[0].intersection(*postings[1:]):
+                    if drug_id not in scored and text in names[drug_id]:
+                        scored[drug_id] = (3, 0.0)
+
+            # Typos: enough trigrams in common. Trigrams shared by a large part
+            # of the catalogue (form and strength words) say little about a
+            # match and dominate the cost, so they are left out of the count.
+            if len(scored) < limit:
+                common = max(len(names) // 5, 100)
+                postings = [ids for ids in (self._trigrams.get(g) for g in trigrams(text))
+                            if ids and len(ids) <= common]
+                need = max(2, math.ceil(FUZZY_THRESHOLD * len(postings)))
+                counts = Counter()
+                for ids in postings:
+                    counts.update(ids)
+                for drug_id, count in counts.items():
+                    if count < need or drug_id in scored:
+                        continue
+                    similarity = count / (len(postings) + self._gram_counts[drug_id] - count)
+                    if similarity >= FUZZY_THRESHOLD:
+                        scored[drug_id] = (4, -similarity)
+
+            # The id settles full ties, so every worker returns the same order
+            def rank(drug_id):
+                return scored[drug_id], len(names[drug_id]), names[drug_id], drug_id
+
+            if limit:
+                return heapq.nsmallest(limit, scored, key=rank)
+            return sorted(scored, key=rank)
+
+# One index per branch, each rebuilt when its own branch's drug names change
+catalogue_signals = branch_signals('catalogue.signal')
+drug_search = BranchLocal(lambda branch: DrugSearchIndex(catalogue_signals.get(branch)))
+
+def search_ids(query, limit=10):
+    """Ids of drugs matching query, best match first (call inside an app context)"""
+    drug_search.ensure_current()
+    return drug_search.search(query, limit)
+
+def search_drugs(query, limit=10):
+    """Drugs matching query, best match first (call inside an app context)"""
+    ids = search_ids(query, limit)
+    if not ids:
+        return []
+    drugs = {drug.id: drug for drug in Drug.query.filter(Drug.id.in_(ids))}
+    return [drugs[i] for i in ids if i in drugs]
@@ -0,0 +1,31 @@
+import os
+
+class ChangeSignal:
+    """Cross-process change notification for in-process caches.
+
+    Each gunicorn worker keeps its own caches, so a write in one worker
+    touches a file in the instance folder and the others compare its
+    mtime with the one they last saw. A stat call is cheap enough to make
+    on every cache lookup.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = None
+
+    def init_app(self, app):
+        os.makedirs(app.instance_path, exist_ok=True)
+        self.path = os.path.join(app.instance_path, self.filename)
+
+    def stamp(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except (TypeError, OSError):
+            return 0
+
+    def touch(self):
+        if self.path:
+            with open(self.path, 'a'):
+                pass
+            os.utime(self.path)
+        return self.stamp()
@@ -1,8 +1,8 @@
 // Pharmacy Management System JavaScript
 
 $(document).ready(function() {
-    // Auto-update alerts every 30 seconds
-    setInterval(updateAlerts, 30000);
+    // Live alert updates (server push, falling back to 30 second polling)
+    startAlertUpdates();
     
     // Initialize tooltips
     $('[data-bs-toggle="tooltip"]').tooltip();
@@ -13,43 +13,67 @@ $(document).ready(function() {
     }, 5000);
 });
 
-function updateAlerts() {
-    $.get('/api/alerts', function(data) {
-        let alertsHtml = '';
-        
-        if (data.low_stock > 0) {
-            alertsHtml += `
-                <div class="alert alert-warning">
-                    <i class="fas fa-exclamation-triangle"></i>
-                    ${data.low_stock} drugs are low in stock
-                </div>
-            `;
-        }
-        
-        if (data.expiring_soon > 0) {
-            alertsHtml += `
-                <div class="alert alert-danger">
-                    <i class="fas fa-clock"></i>
-                    ${data.expiring_soon} drugs are expiring soon
-                </div>
-            `;
-        }
-        
-        if (data.expired > 0) {
-            alertsHtml += `
-                <div class="alert alert-dark">
-                    <i class="fas fa-skull-crossbones"></i>
-                    ${data.expired} drugs have expired
-                </div>
-            `;
-        }
-        
-        if (alertsHtml === '') {
-            alertsHtml = '<div class="alert alert-success"><i class="fas fa-check-circle"></i> No alerts at this time.</div>';
+function startAlertUpdates() {
+    if (!$('#alerts-container').length) return;
+
+    if (!window.EventSource) {
+        setInterval(updateAlerts, 30000);
+        return;
+    }
+
+    const source = new EventSource('/api/alerts/stream');
+    source.onmessage = function(event) {
+        renderAlerts(JSON.parse(event.data));
+    };
+    source.onerror = function() {
+        // The browser reconnects by itself unless the stream was refused outright
+        // (a 503 when the server has no stream slots left)
+        if (source.readyState === EventSource.CLOSED) {
+            updateAlerts();
+            setInterval(updateAlerts, 30000);
         }
-        
-        $('#alerts-container').html(alertsHtml);
-    });
+    };
+}
+
+function updateAlerts() {
+    $.get('/api/alerts', renderAlerts);
+}
+
+function renderAlerts(data) {
+    let alertsHtml = '';
+    
+    if (data.low_stock > 0) {
+        alertsHtml += `
+            <div class="alert alert-warning">
+                <i class="fas fa-exclamation-triangle"></i>
+                ${data.low_stock} drugs are low in stock
+            </div>
+        `;
+    }
+    
+    if (data.expiring_soon > 0) {
+        alertsHtml += `
+            <div class="alert alert-danger">
+                <i class="fas fa-clock"></i>
+                ${data.expiring_soon} drugs are expiring soon
+            </div>
+        `;
+    }
+    
+    if (data.expired > 0) {
+        alertsHtml += `
+            <div class="alert alert-dark">
+                <i class="fas fa-skull-crossbones"></i>
+                ${data.expired} drugs have expired
+            </div>
+        `;
+    }
+    
+    if (alertsHtml === '') {
+        alertsHtml = '<div class="alert alert-success"><i class="fas fa-check-circle"></i> No alerts at this time.</div>';
+    }
+    
+    $('#alerts-container').html(alertsHtml);
 }
 
 // Drug search functionality
@@ -117,6 +141,59 @@ function exportToCSV(tableId, filename) {
     document.body.removeChild(link);
 }
 
+// Escape text before inserting it into generated HTML
+function escapeHtml(text) {
+    return $('<div>').text(text).html();
+}
+
+// "Load more" for keyset-paginated history tables
+function loadMoreRows(button, renderRow) {
+    const $button = $(button);
+    $button.prop('disabled', true);
+
+    $.get($button.data('url'), { cursor: $button.data('cursor') }, function(data) {
+        const $body = $($button.data('target'));
+        data.items.forEach(function(item) {
+            $body.append(renderRow(item));
+        });
+
+        if (data.next_cursor) {
+            $button.data('cursor', data.next_cursor).prop('disabled', false);
+        } else {
+            $button.remove();
+        }
+    }).fail(function() {
+        $button.prop('disabled', false);
+    });
+}
+
+function renderSaleRow(sale) {
+    return `
+        <tr>
+            <td>${sale.sale_date.slice(0, 16).replace('T', ' ')}</td>
+            <td>${escapeHtml(sale.drug_name)}</td>
+            <td>${sale.quantity}</td>
+            <td>${formatCurrency(sale.unit_price)}</td>
+            <td>${formatCurrency(sale.total_price)}</td>
+            <td>${escapeHtml(sale.staff_name)}</td>
+        </tr>
+    `;
+}
+
+function renderPurchaseRow(purchase) {
+    return `
+        <tr>
+            <td>${purchase.purchase_date.slice(0, 10)}</td>
+            <td>${escapeHtml(purchase.drug_name)}</td>
+            <td>${escapeHtml(purchase.supplier_name)}</td>
+            <td>${escapeHtml(purchase.batch_no)}</td>
+            <td>${purchase.quantity}</td>
+            <td>${formatCurrency(purchase.cost_price)}</td>
+            <td>${formatCurrency(purchase.total_cost)}</td>
+        </tr>
+    `;
+}
+
 // Sales calculation
 function calculateSaleTotal() {
     const quantity = parseInt($('#quantity').val()) || 0;
@@ -158,8 +235,10 @@ function formatCurrency(amount) {
 $(document).ready(function() {
     checkInventoryLevels();
     
-    // Add today's date to expiry date field by default
-    const today = new Date();
-    const nextMonth = new Date(today.getFullYear(), today.getMonth() + 1, today.getDate());
-    $('#expiry_date').val(nextMonth.toISOString().split('T')[0]);
+    // Default an empty expiry date field to a month from today
+    if ($('#expiry_date').length && !$('#expiry_date').val()) {
+        const today = new Date();
+        const nextMonth = new Date(today.getFullYear(), today.getMonth() + 1, today.getDate());
+        $('#expiry_date').val(nextMonth.toISOString().split('T')[0]);
+    }
 });
\ No newline at end of file
@@ -0,0 +1,397 @@
+import random
+import time
+from datetime import datetime
+from sqlalchemy.exc import DBAPIError, OperationalError
+from models import db, Drug, DrugBatch, Sale, Purchase, BATCH_IN_STOCK
+from reporting import add_to_rollup
+from ledger import record_movements, record_recount
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 0.05  # seconds, doubled after every failed attempt
+
+# SQLSTATEs PostgreSQL uses for serialization failures, deadlocks and lock_timeout
+RETRYABLE_PGCODES = {'40001', '40P01', '55P03'}
+
+FEFO_PAGE = 8  # batches fetched per round trip when drawing stock
+
+class DrugNotFound(Exception):
+    pass
+
+class InsufficientStock(Exception):
+    pass
+
+def is_retryable(error):
+    """True for write conflicts that succeed if the transaction is simply run again"""
+    if isinstance(error, OperationalError) and 'database is locked' in str(error.orig):
+        return True
+    return getattr(error.orig, 'pgcode', None) in RETRYABLE_PGCODES
+
+def with_retries(transaction, attempts=MAX_ATTEMPTS):
+    """Run transaction(), rolling back and retrying with jittered backoff on lock and
+    serialization conflicts. transaction must commit itself."""
+    delay = RETRY_DELAY
+    for attempt in range(1, attempts + 1):
+        try:
+            return transaction()
+        except DBAPIError as e:
+            db.session.rollback()
+            if attempt == attempts or not is_retryable(e):
+                raise
+            time.sleep(delay * (0.5 + random.random()))
+            delay *= 2
+        except Exception:
+            db.session.rollback()
+            raise
+
+def decrement_stock(drug_id, quantity):
+    """Take quantity units off a drug's stock in one conditional UPDATE.
+
+    Returns False, without changing anything, if fewer than quantity units are
+    left. The check and the write happen in the same statement, so concurrent
+    checkouts can never oversell or overwrite each other's decrement.
+    """
+    result = db.session.execute(
+        db.update(Drug)
+        .where(Drug.id == drug_id, Drug.quantity >= quantity)
+        .values(quantity=Drug.quantity - quantity, updated_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == 1
+
+# Batches
+
+def opening_batch(drug):
+    """The batch holding a newly created drug's initial stock"""
+    return DrugBatch(batch_no=drug.batch_no, quantity=drug.quantity, cost_price=drug.cost_price,
+                     expiry_date=drug.expiry_date)
+
+def receive_batch(drug_id, batch_no, quantity, cost_price, expiry_date):
+    """Add received stock to the drug's batch with this number, creating it if needed.
+    The caller adds quantity to Drug.quantity in the same transaction."""
+    result = db.session.execute(
+        db.update(DrugBatch)
+        .where(DrugBatch.drug_id == drug_id, DrugBatch.batch_no == batch_no)
+        .values(quantity=DrugBatch.quantity + quantity, cost_price=cost_price, expiry_date=expiry_date)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount == 0:
+        db.session.add(DrugBatch(drug_id=drug_id, batch_no=batch_no, quantity=quantity,
+                                 cost_price=cost_price, expiry_date=expiry_date))
+
+def draw_batches(drug_id, quantity):
+    """Take quantity units from a drug's unexpired batches, earliest expiry first.
+
+    Only the batches actually drawn from are read, a few at a time, through
+    the partial (drug_id, expiry_date, id) index, so a drug with hundreds of
+    lots costs no more than one with a single lot. Expired lots are never
+    drawn: they leave stock through write_off_expired(), and a draw that only
+    they could cover raises InsufficientStock. Returns True if a batch was
+    emptied, i.e. the drug's next-to-expire batch changed.
+    """
+    today = datetime.now().date()
+    remaining = quantity
+    emptied = False
+    while remaining > 0:
+        batches = db.session.query(DrugBatch.id, DrugBatch.quantity) \
+            .filter(DrugBatch.drug_id == drug_id, BATCH_IN_STOCK, DrugBatch.expiry_date > today) \
+            .order_by(DrugBatch.expiry_date, DrugBatch.id).limit(FEFO_PAGE).all()
+        if not batches:
+            raise InsufficientStock([drug_id])
+        for batch_id, available in batches:
+            take = min(available, remaining)
+            result = db.session.execute(
+                db.update(DrugBatch)
+                .where(DrugBatch.id == batch_id, DrugBatch.quantity >= take)
+                .values(quantity=DrugBatch.quantity - take)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 0:
+                break  # changed under us; read the batches again
+            remaining -= take
+            emptied = emptied or take == available
+            if remaining == 0:
+                break
+    return emptied
+
+def write_off_expired(drug_ids=None):
+    """Take every expired batch (of drug_ids, or of the whole catalogue) out of stock,
+    ledgered as 'write_off', in one transaction retried on write conflicts.
+    Returns {drug_id: units written off}."""
+    def transaction():
+        today = datetime.now().date()
+        expired = db.session.query(DrugBatch.id, DrugBatch.drug_id, DrugBatch.quantity) \
+            .filter(BATCH_IN_STOCK, DrugBatch.expiry_date <= today)
+        if drug_ids is not None:
+            expired = expired.filter(DrugBatch.drug_id.in_(list(drug_ids)))
+        written_off = {}
+        for batch_id, drug_id, quantity in expired.all():
+            result = db.session.execute(
+                db.update(DrugBatch)
+                .where(DrugBatch.id == batch_id, DrugBatch.quantity == quantity)
+                .values(quantity=0)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount == 1:
+                written_off[drug_id] = written_off.get(drug_id, 0) + quantity
+        if written_off:
+            units = db.case(written_off, value=Drug.id)
+            db.session.execute(
+                db.update(Drug)
+                .where(Drug.id.in_(written_off))
+                .values(quantity=Drug.quantity - units, updated_at=datetime.utcnow())
+                .execution_options(synchronize_session=False)
+            )
+            record_movements({drug_id: -units for drug_id, units in written_off.items()}, 'write_off')
+            refresh_drug_summary(written_off)
+        db.session.commit()
+        return written_off
+
+    return with_retries(transaction)
+
+def refresh_drug_summary(drug_ids):
+    """Point Drug.batch_no, expiry_date and cost_price at each drug's next-to-expire
+    batch that still has stock (drugs with no stock keep their last values)"""
+    head = db.select(DrugBatch).where(DrugBatch.drug_id == Drug.id, BATCH_IN_STOCK) \
+        .order_by(DrugBatch.expiry_date, DrugBatch.id).limit(1)
+    db.session.execute(
+        db.update(Drug)
+        .where(Drug.id.in_(list(drug_ids)), head.exists())
+        .values(batch_no=head.with_only_columns(DrugBatch.batch_no).scalar_subquery(),
+                expiry_date=head.with_only_columns(DrugBatch.expiry_date).scalar_subquery(),
+                cost_price=head.with_only_columns(DrugBatch.cost_price).scalar_subquery())
+        .execution_options(synchronize_session=False)
+    )
+
+def recount_drug_stock(drug_ids, reason='recount'):
+    """Set Drug.quantity to the total of each drug's batches, ledgering the differences"""
+    record_recount(drug_ids, reason)
+    total = db.select(db.func.coalesce(db.func.sum(DrugBatch.quantity), 0)) \
+        .where(DrugBatch.drug_id == Drug.id).scalar_subquery()
+    db.session.execute(
+        db.update(Drug)
+        .where(Drug.id.in_(list(drug_ids)))
+        .values(quantity=total)
+        .execution_options(synchronize_session=False)
+    )
+
+def lock_stock(drug_id):
+    """Write-lock a drug's row and return its quantity as of the lock, or None if the
+    drug is gone. The quantity is read FOR UPDATE and then touched with an UPDATE
+    conditional on it, so it cannot be stale on SQLite either, where FOR UPDATE is
+    ignored and the write lock is only taken by the UPDATE."""
+    while True:
+        seen = db.session.execute(
+            db.select(Drug.quantity).where(Drug.id == drug_id).with_for_update()
+        ).scalar()
+        if seen is None:
+            return None
+        result = db.session.execute(
+            db.update(Drug)
+            .where(Drug.id == drug_id, Drug.quantity == seen)
+            .values(updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 1:
+            return seen
+
+def set_stock_level(drug_id, quantity, batch_no, cost_price, expiry_date):
+    """Apply a manual stock correction from the edit form: the named batch takes the
+    given cost and expiry, an increase is booked to it and a decrease is drawn FEFO.
+    The change is worked out from the stock under the row lock, not from a copy
+    loaded earlier, so a sale committed meanwhile is not overwritten."""
+    current = lock_stock(drug_id)
+    if current is None:
+        raise DrugNotFound([drug_id])
+    delta = quantity - current
+    receive_batch(drug_id, batch_no, max(delta, 0), cost_price, expiry_date)
+    db.session.flush()
+    if delta < 0:
+        draw_batches(drug_id, -delta)
+    record_movements({drug_id: delta}, 'adjustment')
+    db.session.execute(
+        db.update(Drug)
+        .where(Drug.id == drug_id)
+        .values(quantity=quantity, batch_no=batch_no, cost_price=cost_price, expiry_date=expiry_date)
+        .execution_options(synchronize_session=False)
+    )
+    refresh_drug_summary([drug_id])
+
+def update_drug(drug_id, details, quantity, batch_no, cost_price, expiry_date):
+    """Save the edit form: details ({column: value}) go on the drug as given, the stock
+    level through set_stock_level(), in one transaction retried on write conflicts"""
+    def transaction():
+        drug = db.session.get(Drug, drug_id)
+        if not drug:
+            raise DrugNotFound([drug_id])
+        for column, value in details.items():
+            setattr(drug, column, value)
+        set_stock_level(drug_id, quantity, batch_no, cost_price, expiry_date)
+        db.session.commit()
+        return drug
+
+    return with_retries(transaction)
+
+def remove_drug(drug_id):
+    """Delete a drug, its batches and, in the ledger, whatever stock it had left at
+    the moment of deletion"""
+    def transaction():
+        drug = db.session.get(Drug, drug_id)
+        current = lock_stock(drug_id) if drug else None
+        if current is None:
+            raise DrugNotFound([drug_id])
+        record_movements({drug_id: -current}, 'delete')
+        db.session.delete(drug)
+        db.session.commit()
+
+    return with_retries(transaction)
+
+def record_sale(drug_id, quantity, staff_name):
+    """Decrement stock, insert the Sale and add it to the daily rollup and the stock
+    ledger in one transaction, retrying on write conflicts"""
+    if quantity < 1:
+        raise ValueError('Quantity must be at least 1')
+
+    def transaction():
+        drug = db.session.get(Drug, drug_id)
+        if not drug:
+            raise DrugNotFound([drug_id])
+        if not decrement_stock(drug_id, quantity):
+            raise InsufficientStock([drug_id])
+        if draw_batches(drug_id, quantity):
+            refresh_drug_summary([drug_id])
+
+        row = {
+            'drug_id': drug_id,
+            'quantity': quantity,
+            'unit_price': drug.selling_price,
+            'total_price': quantity * drug.selling_price,
+            'staff_name': staff_name,
+            'sale_date': datetime.now()
+        }
+        sale = Sale(**row)
+        db.session.add(sale)
+        add_to_rollup([row])
+        record_movements({drug_id: -quantity}, 'sale', row['sale_date'])
+        db.session.commit()
+        return sale
+
+    return with_retries(transaction)
+
+def record_purchase(drug_id, quantity, cost_price, supplier_name, batch_no, expiry_date=None):
+    """Book received stock into its batch, insert the Purchase and ledger the movement in
+    one transaction. expiry_date defaults to the drug's current expiry date."""
+    if quantity < 1:
+        raise ValueError('Quantity must be at least 1')
+
+    def transaction():
+        drug = db.session.get(Drug, drug_id)
+        if not drug:
+            raise DrugNotFound([drug_id])
+
+        receive_batch(drug_id, batch_no, quantity, cost_price, expiry_date or drug.expiry_date)
+        db.session.execute(
+            db.update(Drug)
+            .where(Drug.id == drug_id)
+            .values(quantity=Drug.quantity + quantity, updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        db.session.flush()
+        refresh_drug_summary([drug_id])
+
+        purchase = Purchase(
+            drug_id=drug_id,
+            quantity=quantity,
+            cost_price=cost_price,
+            total_cost=quantity * cost_price,
+            supplier_name=supplier_name,
+            batch_no=batch_no,
+            purchase_date=datetime.now()
+        )
+        db.session.add(purchase)
+        record_movements({drug_id: quantity}, 'purchase', purchase.purchase_date)
+        db.session.commit()
+        return purchase
+
+    return with_retries(transaction)
+
+def whole_number(value, field):
+    """value as an int; JSON bools and fractions are refused rather than truncated"""
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError(f'{field} must be a whole number')
+    return int(value)
+
+def merge_lines(lines):
+    """Validate basket lines and combine repeated drugs into {drug_id: quantity}"""
+    if not lines:
+        raise ValueError('Basket is empty')
+    basket = {}
+    for line in lines:
+        drug_id = whole_number(line['drug_id'], 'drug_id')
+        quantity = whole_number(line['quantity'], 'quantity')
+        if quantity < 1:
+            raise ValueError('Quantity must be at least 1')
+        basket[drug_id] = basket.get(drug_id, 0) + quantity
+    return basket
+
+def checkout_basket(lines, staff_name):
+    """Sell every line of a basket in one transaction and return the receipt.
+
+    Stock for all lines is read with one SELECT and taken off with one
+    conditional UPDATE; if any line is short nothing is sold. The Sale rows
+    are written with a single bulk INSERT and added to the daily rollup.
+    """
+    basket = merge_lines(lines)
+
+    def transaction():
+        drugs = {drug.id: drug for drug in Drug.query.filter(Drug.id.in_(basket))}
+        missing = [drug_id for drug_id in basket if drug_id not in drugs]
+        if missing:
+            raise DrugNotFound(missing)
+        short = [drug_id for drug_id, quantity in basket.items() if drugs[drug_id].quantity < quantity]
+        if short:
+            raise InsufficientStock(short)
+
+        needed = db.case(basket, value=Drug.id)
+        result = db.session.execute(
+            db.update(Drug)
+            .where(Drug.id.in_(basket), Drug.quantity >= needed)
+            .values(quantity=Drug.quantity - needed, updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != len(basket):
+            # Another checkout took the stock between our read and the update
+            db.session.rollback()
+            raise InsufficientStock(list(basket))
+        emptied = [drug_id for drug_id, quantity in basket.items() if draw_batches(drug_id, quantity)]
+        if emptied:
+            refresh_drug_summary(emptied)
+
+        sale_date = datetime.now()
+        rows = [{
+            'drug_id': drug_id,
+            'quantity': quantity,
+            'unit_price': drugs[drug_id].selling_price,
+            'total_price': quantity * drugs[drug_id].selling_price,
+            'staff_name': staff_name,
+            'sale_date': sale_date
+        } for drug_id, quantity in basket.items()]
+        receipt = {
+            'sale_date': sale_date.isoformat(),
+            'staff_name': staff_name,
+            'lines': [{
+                'drug_id': row['drug_id'],
+                'name': drugs[row['drug_id']].name,
+                'quantity': row['quantity'],
+                'unit_price': float(row['unit_price']),
+                'total_price': float(row['total_price'])
+            } for row in rows],
+            'total_items': sum(row['quantity'] for row in rows),
+            'total_price': float(sum(row['total_price'] for row in rows))
+        }
+        db.session.execute(db.insert(Sale), rows)
+        add_to_rollup(rows)
+        record_movements({drug_id: -quantity for drug_id, quantity in basket.items()}, 'sale', sale_date)
+        db.session.commit()
+        return receipt
+
+    return with_retries(transaction)
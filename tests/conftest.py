@@ -0,0 +1,79 @@
+import os
+import tempfile
+from datetime import date
+import pytest
+
+# The app reads its settings at import, so point it at a scratch instance
+# folder and databases before anything imports it: the main branch, which the
+# tests use unless they switch, and a second branch, north. Jobs and metrics stay off.
+_workdir = tempfile.mkdtemp(prefix='pharmacy-tests-')
+DATABASE_PATH = os.path.join(_workdir, 'pharmacy.db')
+NORTH_DATABASE_PATH = os.path.join(_workdir, 'north.db')
+os.environ['INSTANCE_PATH'] = _workdir
+os.environ['DATABASE_URL'] = f'sqlite:///{DATABASE_PATH}'
+os.environ['BRANCH_DATABASES'] = f'north=sqlite:///{NORTH_DATABASE_PATH}'
+os.environ['JOB_WORKERS'] = '0'
+os.environ['METRICS_ENABLED'] = '0'
+
+from app import app as flask_app, init_db  # noqa: E402
+from models import db, Drug, DrugBatch  # noqa: E402
+from alerts import invalidate_alerts  # noqa: E402
+from auth import invalidate_sessions  # noqa: E402
+from cache import page_cache  # noqa: E402
+from search import drug_search  # noqa: E402
+from branches import use_branch  # noqa: E402
+
+@pytest.fixture
+def app():
+    """The app on a freshly created database holding init_db()'s sample data"""
+    with flask_app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+    for path in (DATABASE_PATH, NORTH_DATABASE_PATH):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    flask_app.config['TESTING'] = True
+    init_db()
+    with flask_app.app_context():
+        # The in-process caches still hold the previous test's catalogues
+        for branch in ('main', 'north'):
+            with use_branch(branch):
+                invalidate_alerts()
+                drug_search.invalidate()
+        invalidate_sessions()
+        page_cache.clear()
+        yield flask_app
+        db.session.remove()
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+def login(client, username='admin', password='admin123'):
+    response = client.post('/login', data={'username': username, 'password': password})
+    assert response.status_code == 302
+    return client
+
+def add_drug(name, batches, selling_price=1.0):
+    """Create a drug from [(batch_no, quantity, expiry_date)], ledgered as opening stock"""
+    from ledger import record_movements
+    first = batches[0]
+    drug = Drug(name=name, category='Test', batch_no=first[0], manufacturer='Test',
+                quantity=sum(quantity for _, quantity, _ in batches), cost_price=0.5,
+                selling_price=selling_price, expiry_date=first[2])
+    for batch_no, quantity, expiry_date in batches:
+        drug.batches.append(DrugBatch(batch_no=batch_no, quantity=quantity, cost_price=0.5,
+                                      expiry_date=expiry_date))
+    db.session.add(drug)
+    db.session.flush()
+    record_movements({drug.id: drug.quantity}, 'opening')
+    db.session.commit()
+    return drug.id
+
+def batch_total(drug_id):
+    return db.session.query(db.func.coalesce(db.func.sum(DrugBatch.quantity), 0)) \
+        .filter(DrugBatch.drug_id == drug_id).scalar()
+
+FAR_EXPIRY = date(2035, 1, 1)
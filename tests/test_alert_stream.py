@@ -0,0 +1,16 @@
+import app as app_module
+from conftest import login
+
+def test_streams_past_the_limit_are_refused(client, monkeypatch):
+    login(client)
+    monkeypatch.setattr(app_module, 'alert_stream_slots', app_module.threading.BoundedSemaphore(1))
+
+    first = client.get('/api/alerts/stream')
+    assert first.status_code == 200
+    assert client.get('/api/alerts/stream').status_code == 503
+    assert client.get('/api/alerts').status_code == 200  # the polling fallback still works
+
+    first.close()  # the browser went away; its slot is free again
+    second = client.get('/api/alerts/stream')
+    assert second.status_code == 200
+    second.close()
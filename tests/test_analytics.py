@@ -0,0 +1,83 @@
+import math
+from datetime import date, timedelta
+import numpy as np
+import pytest
+from models import db, SalesRollup
+from analytics import (forecast, reorder_forecast, forecast_rows, WINDOW_DAYS, HALF_LIFE_DAYS, LEAD_TIME_DAYS,
+                       REVIEW_DAYS, SERVICE_Z)
+from conftest import add_drug, FAR_EXPIRY
+
+TODAY = date(2026, 6, 30)
+
+def sell(drug_id, daily_units):
+    """Seed the rollup with {days before TODAY: units}"""
+    for age, units in daily_units.items():
+        db.session.add(SalesRollup(day=TODAY - timedelta(days=age), drug_id=drug_id, staff_name='till',
+                                   quantity=units, revenue=units, transactions=1))
+    db.session.commit()
+
+def rows_by_id(result):
+    return {row['drug_id']: row for row in forecast_rows(result)}
+
+def test_steady_seller(app):
+    drug_id = add_drug('Steady', [('A', 20, FAR_EXPIRY)])
+    sell(drug_id, {age: 4 for age in range(WINDOW_DAYS)})
+
+    row = rows_by_id(reorder_forecast(TODAY))[drug_id]
+    # Same sales every day: every velocity is the daily rate and there is no safety stock
+    assert (row['velocity'], row['velocity_7d'], row['velocity_30d']) == (4, 4, 4)
+    assert row['days_of_cover'] == 5.0
+    assert row['stockout_date'] == '2026-07-05'
+    assert row['reorder_point'] == 4 * LEAD_TIME_DAYS
+    assert row['suggested_order'] == 4 * (LEAD_TIME_DAYS + REVIEW_DAYS) - 20
+
+def test_single_sale_today(app):
+    drug_id = add_drug('Lumpy', [('A', 3, FAR_EXPIRY)])
+    sell(drug_id, {0: 10, WINDOW_DAYS: 500})  # the second is a day too old to count
+
+    decay_total = sum(0.5 ** (age / HALF_LIFE_DAYS) for age in range(WINDOW_DAYS))
+    velocity = 10 / decay_total
+    mean = 10 / WINDOW_DAYS
+    safety = SERVICE_Z * math.sqrt(100 / WINDOW_DAYS - mean * mean) * math.sqrt(LEAD_TIME_DAYS)
+
+    result = reorder_forecast(TODAY)
+    row = rows_by_id(result)[drug_id]
+    assert row['velocity'] == round(velocity, 3)
+    assert row['velocity_7d'] == round(10 / 7, 3)
+    assert row['velocity_30d'] == round(10 / 30, 3)
+    assert row['days_of_cover'] == round(3 / velocity, 1)
+    assert row['reorder_point'] == round(velocity * LEAD_TIME_DAYS + safety, 1)
+    assert row['suggested_order'] == math.ceil(velocity * (LEAD_TIME_DAYS + REVIEW_DAYS) + safety - 3)
+
+def test_drug_without_sales_is_never_reordered(app):
+    drug_id = add_drug('Idle', [('A', 2, FAR_EXPIRY)])
+    result = reorder_forecast(TODAY)
+    row = rows_by_id(result)[drug_id]
+    assert (row['velocity'], row['velocity_7d'], row['velocity_30d']) == (0, 0, 0)
+    assert row['days_of_cover'] is None and row['stockout_date'] is None
+    assert (row['reorder_point'], row['suggested_order']) == (0, 0)
+    assert drug_id not in {row['drug_id'] for row in forecast_rows(result, reorder_only=True)}
+
+def test_well_stocked_seller_is_not_reordered_and_rows_sort_by_cover(app):
+    low = add_drug('Low', [('A', 10, FAR_EXPIRY)])
+    high = add_drug('High', [('A', 1000, FAR_EXPIRY)])
+    for drug_id in (low, high):
+        sell(drug_id, {age: 2 for age in range(WINDOW_DAYS)})
+
+    result = reorder_forecast(TODAY)
+    rows = rows_by_id(result)
+    assert rows[high]['days_of_cover'] == 500.0
+    assert rows[high]['suggested_order'] == 0
+    assert rows[low]['suggested_order'] == 2 * (LEAD_TIME_DAYS + REVIEW_DAYS) - 10
+    ordered = [row['drug_id'] for row in forecast_rows(result)]
+    assert ordered.index(low) < ordered.index(high)
+    assert [row['drug_id'] for row in forecast_rows(result, reorder_only=True)] == [low]
+
+def test_sales_of_unknown_drugs_and_future_days_are_ignored():
+    today = np.datetime64(TODAY, 'D')
+    result = forecast(np.array([1, 3]), np.array([5.0, 5.0]),
+                      np.array([3, 2, 3, 1]), np.array([today, today, today + 1, today - 1]),
+                      np.array([7.0, 100.0, 100.0, 7.0]), TODAY)
+    assert result['velocity_7d'].tolist() == [1.0, 1.0]
+    assert result['velocity'][1] > result['velocity'][0]  # newer sales weigh more
+    assert result['velocity'][1] == pytest.approx(7 / sum(0.5 ** (age / HALF_LIFE_DAYS) for age in range(WINDOW_DAYS)))
@@ -0,0 +1,18 @@
+import pytest
+from models import db, User
+from auth import authenticate
+
+@pytest.mark.parametrize('method', ['scrypt', 'pbkdf2', 'pbkdf2:sha256:260000'])
+def test_hash_is_upgraded_once(app, monkeypatch, method):
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', method)
+    assert authenticate('admin', 'admin123')
+    upgraded = User.query.filter_by(username='admin').one().password_hash
+    assert upgraded.startswith(method)
+
+    assert authenticate('admin', 'admin123')
+    db.session.expire_all()
+    assert User.query.filter_by(username='admin').one().password_hash == upgraded
+
+def test_wrong_password_and_unknown_user(app):
+    assert authenticate('admin', 'wrong') is None
+    assert authenticate('nobody', 'admin123') is None
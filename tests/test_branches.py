@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import text
+import reporting
+from models import db, User
+from alerts import catalogue_version, invalidate_alerts
+from auth import invalidate_sessions
+from branches import current_branch, use_branch
+from dbconfig import branch_engine
+from reporting import consolidated_report
+from stock import record_sale
+from conftest import add_drug, login, FAR_EXPIRY
+
+@contextmanager
+def at_branch(app, branch):
+    """A fresh app context and session working on branch"""
+    with app.app_context(), use_branch(branch):
+        yield
+
+def count(branch, sql, **params):
+    with branch_engine(branch).connect() as connection:
+        return connection.execute(text(sql), params).scalar()
+
+def add_north_drug(client, name):
+    client.post('/add_drug', data={'name': name, 'category': 'Test', 'batch_no': 'N1', 'manufacturer': 'Test',
+                                   'quantity': 40, 'cost_price': 1, 'selling_price': 2,
+                                   'expiry_date': FAR_EXPIRY.isoformat()})
+
+def test_branch_writes_go_to_the_branch_and_shared_writes_to_main(app, client):
+    login(client)
+    client.post('/branch', data={'branch': 'north'})
+    add_north_drug(client, 'Northol')
+    drug_id = count('north', "SELECT id FROM drug WHERE name = 'Northol'")
+    response = client.post('/api/sales/checkout', json={'lines': [{'drug_id': drug_id, 'quantity': 5}]})
+    assert response.status_code == 201
+    client.post('/add_user', data={'username': 'northy', 'password': 'pw', 'role': 'pharmacist', 'branch': 'north'})
+    client.post('/jobs', data={'kind': 'export_stock'})
+
+    assert count('north', "SELECT quantity FROM drug WHERE name = 'Northol'") == 35
+    assert count('north', 'SELECT COUNT(*) FROM sale') == 1
+    assert count('north', 'SELECT SUM(change) FROM stock_movement WHERE drug_id = :id', id=drug_id) == 35
+    assert count('main', "SELECT COUNT(*) FROM drug WHERE name = 'Northol'") == 0
+    assert count('main', 'SELECT COUNT(*) FROM sale') == 0
+
+    assert count('main', "SELECT branch FROM user WHERE username = 'northy'") == 'north'
+    assert count('main', "SELECT branch FROM job WHERE kind = 'export_stock'") == 'north'
+    assert count('north', 'SELECT COUNT(*) FROM user') == 0
+    assert count('north', 'SELECT COUNT(*) FROM job') == 0
+
+def test_user_with_a_home_branch_is_kept_there(app, client):
+    with at_branch(app, 'north'):
+        add_drug('Northol', [('N1', 10, FAR_EXPIRY)])
+    user = User(username='northy', role='pharmacist', branch='north')
+    user.set_password('pw')
+    db.session.add(user)
+    db.session.commit()
+
+    login(client, 'northy', 'pw')
+    assert 'Northol' in client.get('/sales').get_data(as_text=True)
+    client.post('/branch', data={'branch': 'main'})
+    page = client.get('/sales').get_data(as_text=True)
+    assert 'Northol' in page and 'Paracetamol' not in page
+
+    # A home branch taken out of BRANCH_DATABASES logs the user out
+    user.branch = 'closed'
+    db.session.commit()
+    invalidate_sessions()
+    response = client.get('/dashboard')
+    assert response.status_code == 302 and response.location.endswith('/login')
+    response = client.post('/login', data={'username': 'northy', 'password': 'pw'})
+    assert response.status_code == 200
+    assert 'Branch closed is not available.' in response.get_data(as_text=True)
+
+def test_caches_and_versions_are_kept_per_branch(app, client):
+    login(client)
+    main_alerts = client.get('/api/alerts').get_json()
+    assert 'Paracetamol' in client.get('/drugs').get_data(as_text=True)
+    assert client.get('/api/drugs/search?q=para').get_json()
+
+    client.post('/branch', data={'branch': 'north'})
+    assert 'Paracetamol' not in client.get('/drugs').get_data(as_text=True)
+    assert client.get('/api/alerts').get_json() != main_alerts
+    assert client.get('/api/drugs/search?q=para').get_json() == []
+    add_north_drug(client, 'Paramol')
+    assert [drug['name'] for drug in client.get('/api/drugs/search?q=para').get_json()] == ['Paramol']
+
+    with use_branch('main'):
+        main_version = catalogue_version()
+    with use_branch('north'):
+        north_version = catalogue_version()
+        invalidate_alerts()
+    with use_branch('main'):
+        assert catalogue_version() == main_version != north_version
+
+    client.post('/branch', data={'branch': 'main'})
+    page = client.get('/drugs').get_data(as_text=True)
+    assert 'Paracetamol' in page and 'Paramol' not in page
+    assert client.get('/api/alerts').get_json() == main_alerts
+    assert 'Paramol' not in [drug['name'] for drug in client.get('/api/drugs/search?q=para').get_json()]
+
+def test_consolidated_report_merges_every_branch(app, monkeypatch):
+    for branch, sales in (('main', {'Shared': 3}), ('north', {'Shared': 2, 'Northol': 4})):
+        with at_branch(app, branch):
+            for name, quantity in sales.items():
+                record_sale(add_drug(name, [('A', 10, FAR_EXPIRY)], selling_price=2.0), quantity, branch)
+
+    start = datetime.combine(datetime.now().date(), datetime.min.time())
+    report = consolidated_report(start, start + timedelta(days=1))
+    assert [(row['branch'], row['total_items']) for row in report['branches']] == [('main', 3), ('north', 6)]
+    assert (report['totals']['total_items'], report['totals']['transactions']) == (9, 3)
+    assert report['totals']['total_sales'] == 18.0
+    assert [(day['quantity'], day['transactions']) for day in report['by_day']] == [(9, 3)]
+    assert [(drug['name'], drug['quantity'], drug['branches']) for drug in report['by_drug']] == \
+        [('Shared', 5, 2), ('Northol', 4, 1)]
+
+    # A branch that fails is reported and left out of the totals
+    real_figures = reporting.branch_figures
+
+    def figures(start, end):
+        if current_branch() == 'north':
+            raise RuntimeError('north is down')
+        return real_figures(start, end)
+
+    monkeypatch.setattr(reporting, 'branch_figures', figures)
+    report = consolidated_report(start, start + timedelta(days=1))
+    assert report['branches'][1] == {'branch': 'north', 'error': 'north is down'}
+    assert report['totals']['total_items'] == 3
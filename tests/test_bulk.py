@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+from datetime import date
+from models import db, Drug, DrugBatch, Purchase
+from ledger import reconcile
+from bulk import iter_records, import_drugs, import_purchases, stock_rows, write_records, DRUG_FIELDS
+from conftest import add_drug, batch_total, login
+
+def drug_row(name, batch_no, quantity, expiry='2030-01-01', **extra):
+    return dict({'name': name, 'category': 'Test', 'batch_no': batch_no, 'manufacturer': 'Maker',
+                 'quantity': quantity, 'cost_price': 0.5, 'selling_price': 1.0, 'expiry_date': expiry}, **extra)
+
+def records(rows, fmt='jsonl'):
+    text = ''.join(write_records(rows, DRUG_FIELDS, fmt))
+    return iter_records(io.BytesIO(text.encode()), fmt)
+
+def batches_by_key():
+    rows = db.session.query(Drug.name, DrugBatch.batch_no, DrugBatch.quantity).join(Drug)
+    return {(name, batch_no): quantity for name, batch_no, quantity in rows}
+
+def test_import_drugs_upserts_batches_and_recounts_stock(app):
+    existing = add_drug('Known', [('K1', 10, date(2031, 1, 1))])
+    report = import_drugs(records([
+        drug_row('Known', 'K1', 4),              # replaces the known batch's quantity
+        drug_row('Known', 'K2', 6, '2029-06-01'),  # a new batch of a known drug
+        drug_row('Fresh', 'F1', 5),
+        drug_row('Fresh', 'F1', 7),              # a later row for the same batch wins
+        drug_row('Broken', 'B1', -1),
+        drug_row('', 'X', 1),
+    ], 'csv'))
+
+    assert (report.rows, report.inserted, report.updated, report.error_count) == (6, 2, 1, 2)
+    assert [error['line'] for error in report.errors] == [6, 7]
+    keys = batches_by_key()
+    assert {key: keys[key] for key in [('Known', 'K1'), ('Known', 'K2'), ('Fresh', 'F1')]} == \
+        {('Known', 'K1'): 4, ('Known', 'K2'): 6, ('Fresh', 'F1'): 7}
+    known = db.session.get(Drug, existing)
+    assert known.quantity == batch_total(existing) == 10
+    assert known.batch_no == 'K2'  # next to expire
+    assert not Drug.query.filter_by(name='Broken').count()
+    assert reconcile() == []
+
+def test_stock_export_imports_back_unchanged(app):
+    add_drug('Round trip', [('A', 3, date(2030, 1, 1)), ('B', 8, date(2031, 1, 1))])
+    before = batches_by_key()
+    report = import_drugs(records(list(stock_rows()), 'csv'))
+    assert report.error_count == 0
+    assert report.inserted == 0
+    assert batches_by_key() == before
+    assert reconcile() == []
+
+def test_import_purchases_books_stock_into_batches(app):
+    drug_id = add_drug('Bought', [('A', 2, date(2030, 1, 1))])
+    lines = [
+        {'drug_name': 'Bought', 'batch_no': 'A', 'supplier_name': 'S', 'quantity': 3, 'cost_price': 0.6},
+        {'drug_name': 'Bought', 'batch_no': 'N', 'supplier_name': 'S', 'quantity': 4, 'cost_price': 0.7,
+         'expiry_date': '2032-01-01', 'purchase_date': '2026-01-15'},
+        {'drug_name': 'Bought', 'batch_no': 'N', 'supplier_name': 'S', 'quantity': 1, 'cost_price': 0.7},
+        {'drug_name': 'Nobody', 'batch_no': 'Z', 'supplier_name': 'S', 'quantity': 1, 'cost_price': 1},
+        {'drug_name': 'Bought', 'batch_no': 'A', 'supplier_name': 'S', 'quantity': 0, 'cost_price': 1},
+    ]
+    stream = io.BytesIO(''.join(json.dumps(line) + '\n' for line in lines).encode())
+    report = import_purchases(iter_records(stream, 'jsonl'))
+
+    assert (report.inserted, report.error_count) == (3, 2)
+    assert batches_by_key()[('Bought', 'A')] == 5
+    assert batches_by_key()[('Bought', 'N')] == 5
+    assert db.session.get(Drug, drug_id).quantity == batch_total(drug_id) == 10
+    assert Purchase.query.filter_by(drug_id=drug_id).count() == 3
+    assert reconcile() == []
+
+def test_malformed_upload_is_a_400_not_a_500(app, client):
+    login(client)
+    huge = 'x' * (csv.field_size_limit() + 1)
+    body = f'name,category,batch_no\n"{huge}",Test,A\n'
+    response = client.post('/api/import/drugs?format=csv', data=body.encode(), content_type='text/csv')
+    assert response.status_code == 400
+    assert 'field larger than field limit' in response.get_json()['error']
+
+    response = client.post('/api/import/drugs?format=csv', data=b'\xff\xfe\x00bad', content_type='text/csv')
+    assert response.status_code == 400
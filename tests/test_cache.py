@@ -0,0 +1,56 @@
+from cache import VersionedCache
+from conftest import add_drug, login, FAR_EXPIRY
+
+REPORT = '/reports?type=sales&period=monthly'
+
+def test_unchanged_report_is_answered_304(app, client):
+    login(client)
+    client.get('/dashboard')  # show the login flash, which keeps pages out of the cache
+    first = client.get(REPORT)
+    assert first.status_code == 200 and first.headers['ETag']
+
+    again = client.get(REPORT, headers={'If-None-Match': first.headers['ETag']})
+    assert again.status_code == 304
+    assert again.get_data() == b''
+    assert again.headers['ETag'] == first.headers['ETag']
+    assert client.get(REPORT).get_data() == first.get_data()
+
+def test_sale_and_purchase_change_the_etag_and_the_page(app, client):
+    drug_id = add_drug('Cached Drug', [('A', 20, FAR_EXPIRY)], selling_price=3.0)
+    login(client)
+    client.get('/dashboard')
+    before = client.get(REPORT)
+    assert 'Cached Drug' not in before.get_data(as_text=True)
+
+    response = client.post('/api/sales/checkout', json={'lines': [{'drug_id': drug_id, 'quantity': 2}]})
+    assert response.status_code == 201
+    after_sale = client.get(REPORT, headers={'If-None-Match': before.headers['ETag']})
+    assert after_sale.status_code == 200
+    assert after_sale.headers['ETag'] != before.headers['ETag']
+    assert 'Cached Drug' in after_sale.get_data(as_text=True)
+
+    client.post('/purchases', data={'drug_id': drug_id, 'quantity': 5, 'cost_price': 1.0,
+                                    'supplier_name': 'S', 'batch_no': 'B', 'expiry_date': ''})
+    client.get('/dashboard')
+    after_purchase = client.get(REPORT, headers={'If-None-Match': after_sale.headers['ETag']})
+    assert after_purchase.status_code == 200
+    assert after_purchase.headers['ETag'] not in (before.headers['ETag'], after_sale.headers['ETag'])
+
+def test_page_with_pending_flash_is_not_cached(app, client):
+    login(client)  # leaves 'Login successful!' to show
+    response = client.get(REPORT)
+    assert 'Login successful!' in response.get_data(as_text=True)
+    assert 'ETag' not in response.headers
+    assert 'Login successful!' not in client.get(REPORT).get_data(as_text=True)
+
+def test_versioned_cache_evicts_least_recently_used_within_its_bounds():
+    cache = VersionedCache(max_entries=2, max_bytes=10)
+    cache.set('a', 'aaaa', 4)
+    cache.set('b', 'bbbb', 4)
+    cache.get('a')
+    cache.set('c', 'cc', 2)
+    assert (cache.get('a'), cache.get('b'), cache.get('c')) == ('aaaa', None, 'cc')
+    cache.set('d', 'd' * 9, 9)
+    assert (cache.get('a'), cache.get('c'), cache.get('d')) == (None, None, 'd' * 9)
+    cache.set('e', 'e' * 11, 11)  # larger than the whole cache
+    assert cache.get('e') is None
@@ -0,0 +1,33 @@
+from models import db, Drug
+from alerts import invalidate_alerts
+from catalogue import catalogue_snapshot
+from search import drug_search
+from stock import record_sale
+from conftest import add_drug, FAR_EXPIRY
+
+def test_refresh_between_rename_steps_does_not_keep_the_old_name(app):
+    drug_id = add_drug('Old Name', [('A', 5, FAR_EXPIRY)])
+    drug_search.update(drug_id, 'Old Name')
+    assert catalogue_snapshot().get(drug_id).name == 'Old Name'
+
+    # edit_drug: commit, invalidate_alerts(), then drug_search.update(), with a
+    # request in another thread refreshing the snapshot in between
+    db.session.get(Drug, drug_id).name = 'New Name'
+    db.session.commit()
+    invalidate_alerts()
+    catalogue_snapshot()
+    drug_search.update(drug_id, 'New Name')
+
+    assert catalogue_snapshot().get(drug_id).name == 'New Name'
+    assert [row.name for row in catalogue_snapshot().rows() if row.id == drug_id] == ['New Name']
+
+def test_sale_reloads_stock_and_keeps_the_names(app):
+    drug_id = add_drug('Sold', [('A', 5, FAR_EXPIRY)])
+    before = catalogue_snapshot()
+    record_sale(drug_id, 2, 'till')
+    invalidate_alerts()
+
+    after = catalogue_snapshot()
+    assert after is not before
+    assert after.get(drug_id).quantity == 3
+    assert after.names is before.names  # only quantities and prices were reloaded
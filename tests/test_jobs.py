@@ -0,0 +1,39 @@
+import time
+from datetime import datetime, timedelta
+import jobs
+from models import db, Job
+from jobs import enqueue, requeue_stale, runner, STALE_AFTER
+
+def running_job(started, heartbeat):
+    job_row = Job(kind='export_stock', status='running', worker='elsewhere:1', started_at=started,
+                  heartbeat_at=heartbeat)
+    db.session.add(job_row)
+    db.session.commit()
+    return job_row.id
+
+def test_only_jobs_that_stopped_beating_are_requeued(app):
+    now = datetime.utcnow()
+    long_running = running_job(now - timedelta(hours=3), now - timedelta(seconds=10))
+    dead = running_job(now - timedelta(minutes=10), now - STALE_AFTER - timedelta(seconds=1))
+
+    assert requeue_stale(now) == 1
+    assert db.session.get(Job, long_running).status == 'running'
+    assert db.session.get(Job, dead).status == 'queued'
+
+def test_running_job_keeps_its_heartbeat(app, monkeypatch):
+    monkeypatch.setattr(jobs, 'HEARTBEAT_SECONDS', 0.05)
+    beats = []
+
+    def slow_job(params, path):
+        claimed = db.session.get(Job, job_id).heartbeat_at
+        time.sleep(0.5)
+        db.session.expire_all()
+        beats.append((claimed, db.session.get(Job, job_id).heartbeat_at))
+
+    monkeypatch.setitem(jobs.JOB_KINDS, 'slow', (slow_job, None, 'Slow'))
+    job_id = enqueue('slow').id
+    assert runner.run_pending() == 1
+
+    claimed, latest = beats[0]
+    assert latest > claimed
+    assert db.session.get(Job, job_id).status == 'done'
@@ -0,0 +1,103 @@
+import io
+import json
+from datetime import datetime, timedelta
+import pytest
+import ledger
+import stock
+from models import db, Drug, StockSnapshot
+from ledger import reconcile, stock_at, take_snapshot
+from dbconfig import branch_engine
+from stock import record_sale, record_purchase, checkout_basket, update_drug, remove_drug
+from bulk import iter_records, import_drugs, import_purchases
+from conftest import add_drug, FAR_EXPIRY
+
+START = datetime(2026, 4, 1, 9, 0)
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Pins datetime.now() in the stock and ledger modules to clock[0]"""
+    moment = [START]
+    fixed = type('FixedClock', (datetime,), {'now': staticmethod(lambda: moment[0])})
+    monkeypatch.setattr(stock, 'datetime', fixed)
+    monkeypatch.setattr(ledger, 'datetime', fixed)
+    return moment
+
+def snapshot():
+    db.session.commit()
+    with branch_engine().begin() as connection:
+        return take_snapshot(connection)
+
+def imported(lines):
+    return iter_records(io.BytesIO(''.join(json.dumps(line) + '\n' for line in lines).encode()), 'jsonl')
+
+def test_ledger_balances_after_every_kind_of_change(app):
+    sold = add_drug('Sold', [('A', 30, FAR_EXPIRY)])
+    edited = add_drug('Edited', [('A', 20, FAR_EXPIRY)])
+    deleted = add_drug('Deleted', [('A', 5, FAR_EXPIRY)])
+    assert reconcile() == []
+
+    record_sale(sold, 4, 'alice')
+    assert reconcile() == []
+    checkout_basket([{'drug_id': sold, 'quantity': 2}, {'drug_id': edited, 'quantity': 3}], 'bob')
+    assert reconcile() == []
+    record_purchase(sold, 10, 0.4, 'Supplier', 'B', FAR_EXPIRY)
+    assert reconcile() == []
+    update_drug(edited, {'name': 'Edited'}, 25, 'A', 0.5, FAR_EXPIRY)
+    assert reconcile() == []
+    update_drug(edited, {'name': 'Edited'}, 9, 'A', 0.5, FAR_EXPIRY)
+    assert reconcile() == []
+    remove_drug(deleted)
+    assert reconcile() == []
+
+    import_drugs(imported([{'name': 'Edited', 'category': 'Test', 'batch_no': 'C', 'manufacturer': 'Test',
+                            'quantity': 7, 'cost_price': 0.5, 'selling_price': 1.0, 'expiry_date': '2034-01-01'}]))
+    assert reconcile() == []
+    import_purchases(imported([{'drug_name': 'Sold', 'batch_no': 'B', 'supplier_name': 'S',
+                                'quantity': 6, 'cost_price': 0.4}]))
+    assert reconcile() == []
+
+    assert snapshot() is not None
+    assert reconcile() == reconcile(full=True) == []
+    record_sale(sold, 1, 'alice')
+    assert reconcile() == reconcile(full=True) == []
+    assert stock_at(datetime.now() + timedelta(days=1), [sold, edited, deleted]) == \
+        {sold: 39, edited: 16, deleted: 0}
+
+def test_reconcile_reports_stock_changed_outside_the_ledger(app):
+    drug_id = add_drug('Drifted', [('A', 12, FAR_EXPIRY)])
+    snapshot()
+    db.session.execute(db.update(Drug).where(Drug.id == drug_id).values(quantity=15))
+    db.session.commit()
+
+    assert [tuple(row) for row in reconcile()] == [(drug_id, 12, 15)]
+    assert [tuple(row) for row in reconcile(full=True)] == [(drug_id, 12, 15)]
+
+def test_snapshot_is_skipped_when_nothing_moved(app):
+    assert snapshot() is not None
+    assert snapshot() is None
+    add_drug('Moved', [('A', 1, FAR_EXPIRY)])
+    assert snapshot() is not None
+    assert StockSnapshot.query.count() == 2
+
+def test_stock_at_before_between_and_after_snapshots(app, clock):
+    drug_id = add_drug('Timed', [('A', 40, FAR_EXPIRY)])
+    clock[0] = START + timedelta(hours=1)
+    record_sale(drug_id, 5, 'alice')
+    clock[0] = START + timedelta(hours=2)
+    first = snapshot()
+    clock[0] = START + timedelta(hours=3)
+    record_sale(drug_id, 3, 'alice')
+    clock[0] = START + timedelta(hours=4)
+    assert snapshot() > first
+
+    def at(**offset):
+        return stock_at(START + timedelta(**offset), [drug_id])[drug_id]
+
+    assert at(hours=-1) == 0           # before the opening stock
+    assert at(minutes=30) == 40        # forwards from no snapshot
+    assert at(minutes=90) == 35        # backwards from the first snapshot
+    assert at(minutes=150) == 35       # forwards from the first snapshot
+    assert at(minutes=210) == 32       # backwards from the second snapshot
+    assert at(hours=5) == 32           # after the last snapshot
+    assert stock_at(START + timedelta(minutes=30))[drug_id] == 40
+    assert drug_id not in stock_at(START - timedelta(hours=1))
@@ -0,0 +1,47 @@
+import json
+import os
+import subprocess
+import sys
+from types import SimpleNamespace
+from metrics import Metrics, RETIRED_FILE
+
+LABELS = (('endpoint', 'dashboard'), ('method', 'GET'), ('status', '200'))
+
+def exited_pid():
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+def write_snapshot(directory, filename, requests):
+    with open(os.path.join(directory, filename), 'w') as f:
+        json.dump([['pharmacy_requests_total', [list(pair) for pair in LABELS], requests]], f)
+
+def requests_total(metrics):
+    return metrics.collect().get(('pharmacy_requests_total', LABELS), 0)
+
+def test_exited_workers_are_folded_into_retired_totals(tmp_path):
+    metrics = Metrics()
+    metrics.init_app(SimpleNamespace(instance_path=str(tmp_path)))
+    directory = metrics.directory
+    metrics.inc('pharmacy_requests_total', LABELS, 2)
+    write_snapshot(directory, f'{exited_pid()}-abcd1234.json', 5)
+    write_snapshot(directory, f'{exited_pid()}.json', 3)  # written before snapshots had tokens
+
+    assert requests_total(metrics) == 10
+    assert sorted(os.listdir(directory)) == sorted([metrics.filename, RETIRED_FILE, 'collect.lock'])
+    # Counters never go backwards, and nothing is counted twice
+    metrics.inc('pharmacy_requests_total', LABELS)
+    assert requests_total(metrics) == 11
+    assert requests_total(metrics) == 11
+
+def test_interrupted_fold_is_not_counted_twice(tmp_path):
+    metrics = Metrics()
+    metrics.init_app(SimpleNamespace(instance_path=str(tmp_path)))
+    dead = f'{exited_pid()}-abcd1234.json'
+    write_snapshot(metrics.directory, dead, 5)
+    assert requests_total(metrics) == 5
+
+    # As if the collect had stopped between writing the retired totals and deleting
+    write_snapshot(metrics.directory, dead, 5)
+    assert requests_total(metrics) == 5
+    assert dead not in os.listdir(metrics.directory)
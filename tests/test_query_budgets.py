@@ -0,0 +1,55 @@
+import pytest
+from datetime import date
+from models import Job
+from auth import invalidate_sessions
+from queries import QUERY_BUDGETS
+from conftest import login
+
+PERIODS = ['daily', 'weekly', 'monthly', 'quarterly', 'yearly']
+
+def budgeted_urls(job_id):
+    """A GET for every endpoint in QUERY_BUDGETS, each report variant included"""
+    today = date.today().isoformat()
+    return {
+        'dashboard': ['/dashboard'],
+        'drugs': ['/drugs', '/drugs?search=para', '/drugs?category=Analgesic&stock_filter=low_stock',
+                  '/drugs?expiry_filter=expired'],
+        'sales': ['/sales'],
+        'purchases': ['/purchases'],
+        'reports': ['/reports?type=stock', '/reports?type=expiry', '/reports?type=forecast'] +
+                   [f'/reports?type=sales&period={period}' for period in PERIODS],
+        'api_sales': ['/api/sales'],
+        'api_purchases': ['/api/purchases'],
+        'api_alerts': ['/api/alerts'],
+        'api_drugs_search': ['/api/drugs/search?q=para', '/api/drugs/search?q=a&in_stock=1'],
+        'api_reorder_forecast': ['/api/analytics/reorder'],
+        'api_job': [f'/api/jobs/{job_id}'],
+        'api_stock_at': [f'/api/stock/at?at={today}'],
+    }
+
+@pytest.fixture
+def busy_client(client):
+    """An admin session on a store with some sales, purchases and a queued job"""
+    login(client)
+    for drug_id, quantity in ((1, 2), (3, 1), (1, 1)):
+        assert client.post('/sales', data={'drug_id': drug_id, 'quantity': quantity}).status_code == 302
+    client.post('/purchases', data={'drug_id': 2, 'quantity': 10, 'cost_price': 1.0,
+                                    'supplier_name': 'Test Supplier', 'batch_no': 'P1'})
+    client.post('/jobs', data={'kind': 'export_stock'})
+    return client
+
+def test_every_budget_is_exercised(busy_client):
+    assert set(budgeted_urls(0)) == set(QUERY_BUDGETS)
+
+@pytest.mark.parametrize('cache', ['cold', 'warm'])
+def test_budgeted_routes_stay_within_budget(app, busy_client, cache):
+    job_id = Job.query.order_by(Job.id.desc()).first().id
+    for endpoint, urls in budgeted_urls(job_id).items():
+        for url in urls:
+            if cache == 'cold':
+                invalidate_sessions()  # as after the cache TTL, a logout or a role change
+            else:
+                busy_client.get(url)
+            # QueryBudgetExceeded propagates out of the test client under TESTING
+            response = busy_client.get(url)
+            assert response.status_code in (200, 304), f'{url} answered {response.status_code}'
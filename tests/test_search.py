@@ -0,0 +1,70 @@
+from search import DrugSearchIndex, search_ids
+from conftest import add_drug, login, FAR_EXPIRY
+
+NAMES = {
+    1: 'Amoxicillin 500mg',
+    2: 'Amoxicillin',
+    3: 'Ampicillin 250mg',
+    4: 'Ibuprofen 400mg',
+    5: 'Co-Amoxiclav 625mg',
+    6: 'Paracetamol 500mg',
+    7: 'Paracetamol Syrup',
+}
+
+def index_of(names):
+    index = DrugSearchIndex()
+    for drug_id, name in names.items():
+        index.update(drug_id, name)
+    return index
+
+def test_exact_then_prefix_then_word_prefix_then_substring():
+    index = index_of(NAMES)
+    assert index.search('amoxicillin') == [2, 1, 3]  # exact, name prefix, then a close spelling
+    assert index.search('amox') == [2, 1, 5]  # name prefixes before a later word's prefix
+    assert index.search('cillin') == [2, 3, 1]  # substrings, shortest name first
+    assert index.search('para 500') == [6]  # every word must match a word's start
+
+def test_typos_match_by_trigrams():
+    index = index_of(NAMES)
+    assert index.search('ibuprofn') == [4]
+    assert index.search('paracetmol')[:2] == [6, 7]
+    assert index.search('zzzz') == []
+    assert index.search('  ') == []
+
+def test_limit_keeps_the_best_matches():
+    index = index_of(NAMES)
+    assert index.search('amox', limit=2) == [2, 1]
+    assert index.search('amox', limit=0) == [2, 1, 5]
+
+def test_full_ties_are_ordered_by_id_whatever_the_insertion_order():
+    ids = [1000, 8, 72, 3]
+    for order in (ids, ids[::-1]):
+        index = index_of({drug_id: 'Saline 0.9%' for drug_id in order})
+        assert index.search('saline') == [3, 8, 72, 1000]
+        assert index.search('salin') == [3, 8, 72, 1000]
+        assert index.search('saline 0 9', limit=2) == [3, 8]
+
+def test_rename_and_delete_update_the_index():
+    index = index_of(NAMES)
+    index.update(4, 'Naproxen 250mg')
+    assert index.search('ibuprofen') == []
+    assert index.search('naproxen') == [4]
+    assert index.search('250') == [4, 3]
+
+    index.remove(6)
+    assert index.search('paracetamol') == [7]
+    assert index.search('500mg') == [1]
+    index.remove(99)  # unknown ids are ignored
+
+def test_search_follows_renames_and_deletes_made_through_the_app(app, client):
+    drug_id = add_drug('Oldname Tablets', [('A', 5, FAR_EXPIRY)])
+    assert search_ids('oldname') == [drug_id]
+    login(client)
+    client.post(f'/edit_drug/{drug_id}', data={'name': 'Newname Tablets', 'category': 'Test', 'manufacturer': 'Test',
+                                               'selling_price': 1, 'quantity': 5, 'batch_no': 'A', 'cost_price': 0.5,
+                                               'expiry_date': FAR_EXPIRY.isoformat()})
+    assert search_ids('oldname') == []
+    assert [drug['name'] for drug in client.get('/api/drugs/search?q=newname').get_json()] == ['Newname Tablets']
+
+    client.get(f'/delete_drug/{drug_id}')
+    assert search_ids('newname') == []
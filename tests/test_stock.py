@@ -0,0 +1,163 @@
+import threading
+from datetime import date, timedelta
+import pytest
+from models import db, Drug, DrugBatch, Sale
+from ledger import reconcile
+from stock import (record_sale, update_drug, remove_drug, draw_batches, refresh_drug_summary, checkout_basket,
+                   write_off_expired, InsufficientStock, FEFO_PAGE)
+from conftest import add_drug, batch_total, login, FAR_EXPIRY
+
+def edit(drug_id, quantity, batch_no='A'):
+    return update_drug(drug_id, details={'name': 'Edited'}, quantity=quantity, batch_no=batch_no,
+                       cost_price=0.5, expiry_date=FAR_EXPIRY)
+
+def elsewhere(app, change, *args):
+    """Commit change(*args) from another thread, as a concurrent request would"""
+    def run():
+        with app.app_context():
+            change(*args)
+            db.session.remove()
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+
+def test_edit_after_concurrent_sale_keeps_the_sale(app):
+    drug_id = add_drug('Edited', [('A', 40, FAR_EXPIRY)])
+    loaded = db.session.get(Drug, drug_id)  # the copy edit_drug loads for the form
+    assert loaded.quantity == 40
+
+    elsewhere(app, record_sale, drug_id, 5, 'other')
+    edit(drug_id, 30)
+
+    db.session.expire_all()
+    assert db.session.get(Drug, drug_id).quantity == 30
+    assert batch_total(drug_id) == 30
+    assert reconcile() == []
+
+def test_edit_raises_into_the_named_batch_and_lowers_fefo(app):
+    drug_id = add_drug('Edited', [('A', 5, date(2030, 1, 1)), ('B', 5, FAR_EXPIRY)])
+    edit(drug_id, 14, batch_no='C')
+    assert batch_total(drug_id) == 14
+    edit(drug_id, 3, batch_no='C')
+
+    drug = db.session.get(Drug, drug_id)
+    batches = {batch.batch_no: batch.quantity for batch in drug.batches}
+    assert drug.quantity == 3
+    # the 11 units came off the earliest expiries first: A, then B, then C
+    assert batches == {'A': 0, 'B': 0, 'C': 3}
+    assert reconcile() == []
+
+def test_delete_after_concurrent_edit_leaves_ledger_balanced(app):
+    drug_id = add_drug('Deleted', [('A', 40, FAR_EXPIRY)])
+    loaded = db.session.get(Drug, drug_id)
+    assert loaded.quantity == 40
+
+    elsewhere(app, edit, drug_id, 35)
+    remove_drug(drug_id)
+
+    assert db.session.get(Drug, drug_id) is None
+    assert reconcile() == []
+
+def batches_of(drug_id):
+    return [(batch.batch_no, batch.quantity)
+            for batch in DrugBatch.query.filter_by(drug_id=drug_id).order_by(DrugBatch.id)]
+
+def test_draw_takes_earliest_expiry_first_and_breaks_ties_by_batch(app):
+    drug_id = add_drug('Fefo', [('LATE', 3, date(2031, 1, 1)), ('TIE1', 2, date(2030, 1, 1)),
+                                ('TIE2', 4, date(2030, 1, 1))])
+    assert draw_batches(drug_id, 5) is True  # TIE1 emptied
+    refresh_drug_summary([drug_id])
+    db.session.commit()
+
+    assert batches_of(drug_id) == [('LATE', 3), ('TIE1', 0), ('TIE2', 1)]
+    drug = db.session.get(Drug, drug_id)
+    assert (drug.batch_no, drug.expiry_date) == ('TIE2', date(2030, 1, 1))
+
+def test_draw_pages_through_more_batches_than_one_read(app):
+    lots = [(f'L{i:02}', 1, date(2030, 1, 1 + i)) for i in range(FEFO_PAGE + 3)]
+    drug_id = add_drug('Many lots', lots)
+    draw_batches(drug_id, FEFO_PAGE + 2)
+    db.session.commit()
+    assert [quantity for _, quantity in batches_of(drug_id)] == [0] * (FEFO_PAGE + 2) + [1]
+
+def test_draw_beyond_the_batches_raises(app):
+    drug_id = add_drug('Short', [('A', 2, FAR_EXPIRY)])
+    with pytest.raises(InsufficientStock):
+        draw_batches(drug_id, 3)
+    db.session.rollback()
+
+def test_checkout_draws_every_line_and_sells_nothing_when_one_is_short(app):
+    first = add_drug('First', [('A', 2, date(2030, 1, 1)), ('B', 5, FAR_EXPIRY)])
+    second = add_drug('Second', [('A', 1, FAR_EXPIRY)])
+
+    receipt = checkout_basket([{'drug_id': first, 'quantity': 3}, {'drug_id': second, 'quantity': 1},
+                               {'drug_id': first, 'quantity': 1}], 'tester')
+    assert receipt['total_items'] == 5
+    assert batches_of(first) == [('A', 0), ('B', 3)]
+    assert batches_of(second) == [('A', 0)]
+
+    with pytest.raises(InsufficientStock):
+        checkout_basket([{'drug_id': first, 'quantity': 1}, {'drug_id': second, 'quantity': 1}], 'tester')
+    assert db.session.get(Drug, first).quantity == batch_total(first) == 3
+    assert Sale.query.count() == 2
+    assert reconcile() == []
+
+def test_expired_batches_are_never_sold(app):
+    expired = date.today() - timedelta(days=1)
+    drug_id = add_drug('Lapsed', [('OLD', 6, expired), ('NEW', 4, FAR_EXPIRY)])
+
+    record_sale(drug_id, 3, 'till')
+    assert batches_of(drug_id) == [('OLD', 6), ('NEW', 1)]
+    with pytest.raises(InsufficientStock):
+        record_sale(drug_id, 2, 'till')
+    with pytest.raises(InsufficientStock):
+        checkout_basket([{'drug_id': drug_id, 'quantity': 2}], 'till')
+    with pytest.raises(InsufficientStock):
+        edit(drug_id, 0, batch_no='NEW')  # a correction cannot take expired units either
+
+    db.session.expire_all()
+    assert db.session.get(Drug, drug_id).quantity == batch_total(drug_id) == 7
+    assert Sale.query.filter_by(drug_id=drug_id).count() == 1
+    assert reconcile() == []
+
+def test_write_off_takes_only_expired_batches_out_of_stock(app):
+    expired = date.today() - timedelta(days=1)
+    lapsed = add_drug('Lapsed', [('OLD', 6, expired), ('NEW', 4, FAR_EXPIRY)])
+    fresh = add_drug('Fresh', [('A', 5, FAR_EXPIRY)])
+
+    assert write_off_expired([lapsed, fresh]) == {lapsed: 6}
+    assert write_off_expired([lapsed, fresh]) == {}
+    db.session.expire_all()
+    drug = db.session.get(Drug, lapsed)
+    assert drug.quantity == batch_total(lapsed) == 4
+    assert (drug.batch_no, drug.expiry_date) == ('NEW', FAR_EXPIRY)
+    assert db.session.get(Drug, fresh).quantity == 5
+    assert reconcile() == []
+
+def test_write_off_route_is_admin_only(app, client):
+    drug_id = add_drug('Lapsed', [('OLD', 6, date.today())])
+    login(client, 'pharmacist', 'pharma123')
+    client.post('/drugs/write_off_expired')
+    assert db.session.get(Drug, drug_id).quantity == 6
+
+    login(client)
+    response = client.post('/drugs/write_off_expired')
+    assert response.status_code == 302
+    assert '/reports?type=expiry' in response.location
+    db.session.expire_all()
+    assert db.session.get(Drug, drug_id).quantity == 0
+
+@pytest.mark.parametrize('quantity', [1.9, True, '1.5', None])
+def test_checkout_refuses_quantities_that_are_not_whole_numbers(app, client, quantity):
+    drug_id = add_drug('Whole', [('A', 5, FAR_EXPIRY)])
+    login(client)
+    response = client.post('/api/sales/checkout', json={'lines': [{'drug_id': drug_id, 'quantity': quantity}]})
+    assert response.status_code == 400
+    assert batch_total(drug_id) == 5
+
+def test_checkout_accepts_integral_json_numbers(app, client):
+    drug_id = add_drug('Whole', [('A', 5, FAR_EXPIRY)])
+    login(client)
+    response = client.post('/api/sales/checkout', json={'lines': [{'drug_id': drug_id, 'quantity': 2.0}]})
+    assert response.status_code == 201
+    assert response.get_json()['total_items'] == 2